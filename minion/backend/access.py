@@ -0,0 +1,111 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Materialized access index. For every user it stores the role and the sites and
+# plans the user can see through group membership, so that permission checks do
+# not have to walk users, groups and sites on every request.
+#
+# The views that change users, groups or sites call refresh_access() with the
+# users affected by the change. Every refresh bumps the 'access' version counter;
+# each process caches index entries and drops its cache when the token of the
+# counter changes. Unlike the counter, the token does not repeat when the
+# database is dropped and built again.
+#
+
+from minion.backend import membership
+from minion.backend.resources import bump_version, version_token
+from minion.backend.views.base import access, sites, users
+
+ACCESS_VERSION = 'access'
+
+_cache = {'token': None, 'entries': {}}
+
+def group_users(group_names):
+    """ Return the emails of all users in the given groups. """
+    return membership.members_of_groups(membership.USER, group_names)
+
+def site_users(urls):
+    """ Return the emails of all users that can see one of the given sites. """
+    group_names = set()
+    for names in membership.groups_of_members(membership.SITE, urls).itervalues():
+        group_names.update(names)
+    return group_users(group_names)
+
+def _build_entries(emails=None):
+    user_query = {}
+    if emails is not None:
+        user_query = {'email': {'$in': list(emails)}}
+
+    entries = {}
+    for user in users.find(user_query, {'_id': 0, 'email': 1, 'role': 1}):
+        entries[user['email']] = {'email': user['email'], 'role': user['role'], 'sites': set(), 'plans': set()}
+    if not entries:
+        return entries
+
+    user_groups = membership.groups_of_members(membership.USER, None if emails is None else entries.keys())
+    group_names = set()
+    for names in user_groups.itervalues():
+        group_names.update(names)
+    group_sites = {}
+    if group_names:
+        group_sites = membership.members_by_group(membership.SITE, None if emails is None else group_names)
+
+    urls = set()
+    for email, names in user_groups.iteritems():
+        if email in entries:
+            for group_name in names:
+                entries[email]['sites'].update(group_sites.get(group_name, []))
+            urls.update(entries[email]['sites'])
+
+    site_query = {}
+    if emails is not None:
+        site_query = {'url': {'$in': list(urls)}}
+    site_plans = {}
+    if urls:
+        for site in sites.find(site_query, {'_id': 0, 'url': 1, 'plans': 1}):
+            site_plans[site['url']] = site.get('plans', [])
+
+    for entry in entries.itervalues():
+        for url in entry['sites']:
+            entry['plans'].update(site_plans.get(url, []))
+        entry['sites'] = sorted(entry['sites'])
+        entry['plans'] = sorted(entry['plans'])
+    return entries
+
+def refresh_access(emails=None):
+    """ Recompute the index entries of the given users, or of all users when
+    emails is None. Entries of users that no longer exist are removed. """
+    if emails is not None:
+        emails = set(emails)
+        if not emails:
+            return
+    entries = _build_entries(emails)
+    if emails is None:
+        access.remove({'email': {'$nin': entries.keys()}})
+    else:
+        access.remove({'email': {'$in': list(emails - set(entries))}})
+    for email, entry in entries.iteritems():
+        access.update({'email': email}, entry, upsert=True)
+    bump_version(ACCESS_VERSION)
+
+def get_access(email):
+    """ Return the index entry for a user as a dictionary with the role, sites and plans
+    of the user, or None if the user does not exist. """
+    token = version_token(ACCESS_VERSION)
+    if token is None:
+        # The index was never built. Build it now for everybody.
+        refresh_access()
+        token = version_token(ACCESS_VERSION)
+    if _cache['token'] != token:
+        _cache['token'] = token
+        _cache['entries'] = {}
+    if email not in _cache['entries']:
+        entry = access.find_one({'email': email})
+        if entry is not None:
+            entry = {'role': entry['role'],
+                     'sites': frozenset(entry['sites']),
+                     'plans': frozenset(entry['plans'])}
+        _cache['entries'][email] = entry
+    return _cache['entries'][email]
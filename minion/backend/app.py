@@ -15,6 +15,9 @@ import minion.backend.views.sites
 import minion.backend.views.plans
 import minion.backend.views.plugins
 import minion.backend.views.issues
+import minion.backend.views.jobs
+import minion.backend.views.events
+import minion.backend.views.artifacts
 
 def configure_app(app, production=True, debug=False):
     app.debug = debug
@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Content addressed artifact store. Plugin workers upload the files that plugins
+# report as artifacts to the API, so that any API node can serve them. A file is
+# stored once per content, under the sha256 of its content:
+#
+#  artifacts        { '_id': '<sha256>', 'length': 1234567, 'chunk_size': 262144,
+#                     'chunks': 5, 'upload': '<upload id>', 'created': datetime }
+#  artifact_chunks  { 'sha256': '<sha256>', 'upload': '<upload id>', 'n': 0,
+#                     'data': Binary(...), 'compressed': True }
+#
+# Chunks are compressed one by one, when that makes them smaller, so that a range
+# of the file can be read without reading the chunks before it.
+#
+# Every upload stores its chunks under its own upload id, chosen by the uploader.
+# Committing an upload checks its chunks and, when the store does not have the
+# blob yet, makes them the chunks of the blob. The chunks of a committed blob are
+# never written again: later uploads of the same content are refused or dropped.
+# Blobs stored before upload ids existed have none; their chunks have no upload.
+#
+# The artifact_index collection maps the file names of the artifacts of a scan to
+# their content. It is written by the state worker when an artifact is reported:
+#
+#  artifact_index   { 'scan': '...', 'session': '...', 'name': 'report.xml',
+#                     'sha256': '<sha256>', 'length': 1234567 }
+#
+
+import datetime
+import hashlib
+import re
+import zlib
+
+import pymongo
+from bson.binary import Binary
+
+from minion.backend.views.base import artifact_chunks, artifact_index, artifacts
+
+COMPRESSION_LEVEL = 6
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+UPLOAD_RE = re.compile(r'^[0-9a-f]{32}$')
+
+_state = {'ready': False}
+
+def _ensure_ready():
+    if not _state['ready']:
+        if 'sha256_1_n_1' in artifact_chunks.index_information():
+            # Chunks were unique per blob before uploads were staged
+            artifact_chunks.drop_index('sha256_1_n_1')
+        artifact_chunks.ensure_index([('sha256', pymongo.ASCENDING), ('upload', pymongo.ASCENDING),
+                                      ('n', pymongo.ASCENDING)], unique=True)
+        artifact_index.ensure_index([('scan', pymongo.ASCENDING), ('name', pymongo.ASCENDING)], unique=True)
+        _state['ready'] = True
+
+def is_sha256(value):
+    return SHA256_RE.match(value) is not None
+
+def is_upload_id(value):
+    return isinstance(value, basestring) and UPLOAD_RE.match(value) is not None
+
+def find_blob(sha256):
+    """ Return the stored blob with the given content hash, or None. """
+    return artifacts.find_one({'_id': sha256})
+
+def put_chunk(sha256, upload, n, data):
+    """ Store chunk n of an upload of the blob with the given content hash. Storing
+    the same chunk again replaces it, so uploads can simply be retried. Returns None
+    on success, or 'artifact-exists' when the store already has the blob. """
+    _ensure_ready()
+    if find_blob(sha256):
+        return 'artifact-exists'
+    compressed = zlib.compress(data, COMPRESSION_LEVEL)
+    chunk = {'sha256': sha256, 'upload': upload, 'n': n, 'length': len(data)}
+    if len(compressed) < len(data):
+        chunk.update(data=Binary(compressed), compressed=True)
+    else:
+        chunk.update(data=Binary(data), compressed=False)
+    artifact_chunks.update({'sha256': sha256, 'upload': upload, 'n': n}, chunk, upsert=True)
+
+def _chunk_data(chunk):
+    data = str(chunk['data'])
+    return zlib.decompress(data) if chunk['compressed'] else data
+
+def commit_blob(sha256, upload, length, chunk_size):
+    """ Check the chunks of an upload against the content hash and length of the blob
+    and make the blob available. Returns None on success, also when another upload
+    stored the blob first, or the reason of the failure. """
+    _ensure_ready()
+    blob = find_blob(sha256)
+    if blob is None:
+        reason = _check_upload(sha256, upload, length, chunk_size)
+        if reason:
+            return reason
+        chunks = (length + chunk_size - 1) // chunk_size
+        artifact_chunks.remove({'sha256': sha256, 'upload': upload, 'n': {'$gte': chunks}})
+        # When uploads of the same content race, the first commit wins
+        artifacts.update({'_id': sha256}, {'$setOnInsert': {'length': length, 'chunk_size': chunk_size,
+                                                            'chunks': chunks, 'upload': upload,
+                                                            'created': datetime.datetime.utcnow()}},
+                         upsert=True)
+        blob = find_blob(sha256)
+    if blob.get('upload') != upload:
+        # The chunks of this upload are never read
+        artifact_chunks.remove({'sha256': sha256, 'upload': upload})
+    return None if blob['length'] == length else 'checksum-mismatch'
+
+def _check_upload(sha256, upload, length, chunk_size):
+    chunks = (length + chunk_size - 1) // chunk_size
+    digest, total = hashlib.sha256(), 0
+    cursor = artifact_chunks.find({'sha256': sha256, 'upload': upload,
+                                   'n': {'$lt': chunks}}).sort('n', pymongo.ASCENDING)
+    for n, chunk in enumerate(cursor):
+        if chunk['n'] != n or (n < chunks - 1 and chunk['length'] != chunk_size):
+            return 'missing-chunks'
+        data = _chunk_data(chunk)
+        digest.update(data)
+        total += len(data)
+    if total != length:
+        return 'missing-chunks'
+    if digest.hexdigest() != sha256:
+        return 'checksum-mismatch'
+
+def read_blob(blob, start=0, end=None):
+    """ Yield the bytes start to end (inclusive) of a blob, one chunk at a time. Only
+    the chunks that hold the range are read. """
+    if end is None:
+        end = blob['length'] - 1
+    chunk_size = blob['chunk_size']
+    cursor = artifact_chunks.find({'sha256': blob['_id'], 'upload': blob.get('upload'),
+                                   'n': {'$gte': start // chunk_size, '$lte': end // chunk_size}})
+    for chunk in cursor.sort('n', pymongo.ASCENDING):
+        data = _chunk_data(chunk)
+        offset = chunk['n'] * chunk_size
+        yield data[max(0, start - offset):end - offset + 1]
+
+def find_artifact(scan_id, name):
+    """ Return the index entry of the artifact file with the given name in a scan, or None. """
+    _ensure_ready()
+    return artifact_index.find_one({'scan': scan_id, 'name': name})
@@ -0,0 +1,158 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Group membership. Every member of a group is a small document in the
+# memberships collection:
+#
+#  { 'group': 'mozilla', 'type': 'site', 'member': 'https://www.mozilla.org' }
+#  { 'group': 'mozilla', 'type': 'user', 'member': 'someone@mozilla.com' }
+#
+# This replaces the users and sites arrays that used to live in the group
+# documents and that grew without bounds for large groups. Groups written by
+# older versions are migrated on first use, or with minion-db-migrate.
+#
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+from minion.backend.views.base import groups, memberships
+
+USER = 'user'
+SITE = 'site'
+
+_state = {'ready': False}
+
+def _ensure_ready():
+    if not _state['ready']:
+        memberships.ensure_index([('group', pymongo.ASCENDING), ('type', pymongo.ASCENDING),
+                                  ('member', pymongo.ASCENDING)], unique=True)
+        memberships.ensure_index([('type', pymongo.ASCENDING), ('member', pymongo.ASCENDING)])
+        migrate_groups()
+        _state['ready'] = True
+
+def migrate_groups():
+    """ Move the users and sites arrays of old style group documents into the
+    memberships collection. Returns the number of groups that were migrated. """
+    migrated = 0
+    for group in groups.find({'$or': [{'users': {'$exists': True}}, {'sites': {'$exists': True}}]}):
+        _insert(group['name'], USER, group.get('users', []))
+        _insert(group['name'], SITE, group.get('sites', []))
+        groups.update({'name': group['name']}, {'$unset': {'users': 1, 'sites': 1}})
+        migrated += 1
+    return migrated
+
+def _insert(group_name, member_type, members):
+    members = set(members)
+    if not members:
+        return 0
+    existing = memberships.find({'group': group_name, 'type': member_type, 'member': {'$in': list(members)}},
+                                {'_id': 0, 'member': 1})
+    new_members = members - set(m['member'] for m in existing)
+    if new_members:
+        try:
+            memberships.insert([{'group': group_name, 'type': member_type, 'member': member}
+                                for member in new_members], continue_on_error=True)
+        except DuplicateKeyError:
+            pass # Added concurrently by someone else, which is fine
+    return len(new_members)
+
+def add_members(group_name, member_type, members):
+    """ Add members to a group. Returns the number of members that were not yet in the group. """
+    _ensure_ready()
+    return _insert(group_name, member_type, members)
+
+def remove_members(group_name, member_type, members):
+    """ Remove members from a group. Returns the number of members removed. """
+    _ensure_ready()
+    members = list(set(members))
+    if not members:
+        return 0
+    result = memberships.remove({'group': group_name, 'type': member_type, 'member': {'$in': members}})
+    return result.get('n', 0)
+
+def apply_patch(group_name, patch):
+    """ Apply a group patch ({addSites, removeSites, addUsers, removeUsers}) with one
+    query per list, ignoring anything that is not a string. Returns the number of
+    changes per list. """
+    def _strings(values):
+        return [v for v in values if isinstance(v, unicode) or isinstance(v, str)]
+    return { 'addSites': add_members(group_name, SITE, _strings(patch.get('addSites', []))),
+             'removeSites': remove_members(group_name, SITE, _strings(patch.get('removeSites', []))),
+             'addUsers': add_members(group_name, USER, _strings(patch.get('addUsers', []))),
+             'removeUsers': remove_members(group_name, USER, _strings(patch.get('removeUsers', []))) }
+
+def set_member_groups(member_type, member, group_names):
+    """ Make the member part of exactly the given groups. """
+    _ensure_ready()
+    current = set(groups_of(member_type, member))
+    for group_name in set(group_names) - current:
+        _insert(group_name, member_type, [member])
+    removed = list(current - set(group_names))
+    if removed:
+        memberships.remove({'group': {'$in': removed}, 'type': member_type, 'member': member})
+
+def remove_member(member_type, member):
+    """ Remove the member from all groups. """
+    _ensure_ready()
+    memberships.remove({'type': member_type, 'member': member})
+
+def rename_member(member_type, old_member, new_member):
+    """ Replace a member by another one in all groups. """
+    for group_name in groups_of(member_type, old_member):
+        _insert(group_name, member_type, [new_member])
+    remove_member(member_type, old_member)
+
+def remove_group(group_name):
+    _ensure_ready()
+    memberships.remove({'group': group_name})
+
+def members(group_name, member_type):
+    """ Return the members of the given type of a group. """
+    _ensure_ready()
+    return [m['member'] for m in memberships.find({'group': group_name, 'type': member_type},
+                                                  {'_id': 0, 'member': 1})]
+
+def is_member(group_name, member_type, member):
+    _ensure_ready()
+    return memberships.find_one({'group': group_name, 'type': member_type, 'member': member}) is not None
+
+def groups_of(member_type, member):
+    """ Return the names of the groups the member is part of. """
+    _ensure_ready()
+    return [m['group'] for m in memberships.find({'type': member_type, 'member': member},
+                                                 {'_id': 0, 'group': 1})]
+
+def members_of_groups(member_type, group_names):
+    """ Return the set of members of the given type of any of the groups. """
+    _ensure_ready()
+    group_names = list(group_names)
+    if not group_names:
+        return set()
+    return set(m['member'] for m in memberships.find({'group': {'$in': group_names}, 'type': member_type},
+                                                     {'_id': 0, 'member': 1}))
+
+def groups_of_members(member_type, members=None):
+    """ Map members of the given type to the names of their groups, with a single
+    query. Covers all members when members is None. """
+    _ensure_ready()
+    query = {'type': member_type}
+    if members is not None:
+        query['member'] = {'$in': list(members)}
+    result = {}
+    for m in memberships.find(query, {'_id': 0, 'group': 1, 'member': 1}):
+        result.setdefault(m['member'], []).append(m['group'])
+    return result
+
+def members_by_group(member_type, group_names=None):
+    """ Map group names to their members of the given type, with a single query.
+    Covers all groups when group_names is None. """
+    _ensure_ready()
+    query = {'type': member_type}
+    if group_names is not None:
+        query['group'] = {'$in': list(group_names)}
+    result = {}
+    for m in memberships.find(query, {'_id': 0, 'group': 1, 'member': 1}):
+        result.setdefault(m['group'], []).append(m['member'])
+    return result
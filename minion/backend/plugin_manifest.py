@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Plugin manifest. Finding the plugins means importing every module under
+# minion.plugins, with all their dependencies. The API does not run plugins, so
+# it only reads the result from a manifest file:
+#
+#  { "fingerprint": "3f1c...",
+#    "plugins": { "minion.plugins.basic.XFrameOptionsPlugin": {
+#                   "descriptor": { "class": "minion.plugins.basic.XFrameOptionsPlugin",
+#                                   "name": "XFrame Options",
+#                                   "version": "0.1",
+#                                   "weight": "light" },
+#                   "capabilities": ["blocking"] },
+#                 ... } }
+#
+# The fingerprint is computed from the names, sizes and modification times of the
+# plugin modules. When it does not match, the manifest is written again by a
+# separate process, so that plugin code is never imported by the API itself. The
+# manifest can also be written up front with minion-plugin-manifest.
+#
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+
+MANIFEST_PATH = os.path.expanduser("~/.minion/plugins.json")
+
+BASE_CLASSES = ('AbstractPlugin', 'AsyncPlugin', 'BlockingPlugin', 'ExternalProcessPlugin')
+
+def _plugin_paths():
+    import minion.plugins
+    return [os.path.abspath(path) for path in minion.plugins.__path__]
+
+def fingerprint():
+    """ Return a fingerprint of the plugin modules that changes when a module is
+    added, removed or changed. Only looks at the files, nothing is imported. """
+    files = []
+    for path in _plugin_paths():
+        for directory, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                if filename.endswith('.py'):
+                    st = os.stat(os.path.join(directory, filename))
+                    files.append("%s %d %d" % (os.path.join(directory, filename), st.st_size, st.st_mtime))
+    return hashlib.sha1("\n".join(sorted(files))).hexdigest()
+
+def _capabilities(plugin_class):
+    from minion.plugins.base import AsyncPlugin, BlockingPlugin, ExternalProcessPlugin
+    capabilities = []
+    if issubclass(plugin_class, BlockingPlugin):
+        capabilities.append('blocking')
+    if issubclass(plugin_class, ExternalProcessPlugin):
+        capabilities.append('external-process')
+    if issubclass(plugin_class, AsyncPlugin):
+        capabilities.append('async')
+    return capabilities
+
+def build_manifest():
+    """ Import all plugin modules and describe the plugins in them. """
+    import importlib
+    import inspect
+    import pkgutil
+    from minion.plugins.base import AbstractPlugin
+
+    manifest = {'fingerprint': fingerprint(), 'plugins': {}}
+    base_package = importlib.import_module('minion.plugins')
+    prefix = base_package.__name__ + "."
+    for importer, package, ispkg in pkgutil.iter_modules(base_package.__path__, prefix):
+        try:
+            module = __import__(package, fromlist=['plugins'])
+        except ImportError as e:
+            logging.error("Unable to import %s: %s" % (package, str(e)))
+            continue
+        for name in dir(module):
+            obj = getattr(module, name)
+            # Plugins that a module imports from another one are listed with that one
+            if inspect.isclass(obj) and issubclass(obj, AbstractPlugin) and name not in BASE_CLASSES \
+                    and obj.__module__ == module.__name__:
+                plugin_name = module.__name__ + '.' + obj.__name__
+                manifest['plugins'][plugin_name] = {
+                    'descriptor': {
+                        'class': plugin_name,
+                        'name': obj.name(),
+                        'version': obj.version(),
+                        'weight': obj.weight()
+                    },
+                    'capabilities': _capabilities(obj)
+                }
+    return manifest
+
+def write_manifest(path=MANIFEST_PATH):
+    """ Build the manifest and write it to path. The file is replaced at once, so
+    readers never see a partial manifest. """
+    manifest = build_manifest()
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.plugins-')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+    return manifest
+
+def load_manifest(path=MANIFEST_PATH):
+    """ Return the plugins of the manifest. The manifest is written again first
+    when it is missing or when the plugin modules changed. """
+    manifest = None
+    if os.path.exists(path):
+        with open(path) as fp:
+            manifest = json.load(fp)
+    if manifest is None or manifest.get('fingerprint') != fingerprint():
+        subprocess.check_call([sys.executable, '-m', 'minion.backend.plugin_manifest', path])
+        with open(path) as fp:
+            manifest = json.load(fp)
+    return manifest['plugins']
+
+if __name__ == '__main__':
+    write_manifest(*sys.argv[1:2])
@@ -0,0 +1,95 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Resources shared by the API, the workers and the scripts. Each is created on
+# first use and then reused by the whole process:
+#
+#  config()         the backend configuration, read once
+#  database()       the minion database, through one MongoClient per process
+#  collection(name) a collection that can be defined at import time without
+#                   connecting to MongoDB
+#  send_task(...)   queue a task by name, without importing minion.backend.tasks
+#  bump_version(name), current_version(name), version_token(name)
+#                   the named version counters of the versions collection
+#
+# The MongoClient is created again in a forked child, for example in gunicorn
+# workers when the app is preloaded, because its sockets cannot be shared with
+# the parent process.
+#
+
+import os
+import uuid
+
+from pymongo import MongoClient
+
+from minion.backend.utils import backend_config
+
+_state = {'config': None, 'client': None, 'pid': None, 'celery': None}
+
+def config():
+    if _state['config'] is None:
+        _state['config'] = backend_config()
+    return _state['config']
+
+def mongo_client():
+    if _state['client'] is None or _state['pid'] != os.getpid():
+        mongodb = config()['mongodb']
+        _state['client'] = MongoClient(host=mongodb['host'], port=mongodb['port'])
+        _state['pid'] = os.getpid()
+    return _state['client']
+
+def database():
+    return mongo_client().minion
+
+class LazyCollection(object):
+
+    """ A collection of the minion database that is looked up when it is used. """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(database()[self.name], attr)
+
+def collection(name):
+    return LazyCollection(name)
+
+def celery_app():
+    """ Return the Celery app. Celery is only imported when this is first called. """
+    if _state['celery'] is None:
+        from celery import Celery
+        celery = config()['celery']
+        _state['celery'] = Celery('tasks', broker=celery['broker'], backend=celery['backend'])
+    return _state['celery']
+
+def send_task(name, args=None, **options):
+    """ Queue a task by name, for example send_task('minion.backend.tasks.scan', [scan_id], queue='scan') """
+    return celery_app().send_task(name, args=args, **options)
+
+#
+# Every bump of a version counter also stores a new random token. The counter
+# starts over when the database is dropped, the token never repeats, so caches
+# that outlive the database key on the token.
+#
+
+versions = collection('versions')
+
+def current_version(name):
+    """ Return the value of the named version counter, 0 if it was never bumped. """
+    version = versions.find_one({'_id': name})
+    return version['version'] if version else 0
+
+def version_token(name):
+    """ Return the token of the last bump of the named version counter, None if
+    it was never bumped. """
+    version = versions.find_one({'_id': name})
+    return version.get('token') if version else None
+
+def bump_version(name):
+    """ Increment the named version counter and return its new value. """
+    version = versions.find_and_modify({'_id': name},
+                                       {'$inc': {'version': 1}, '$set': {'token': uuid.uuid4().hex}},
+                                       upsert=True, new=True)
+    return version['version']
@@ -2,10 +2,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import Queue
+import contextlib
 import datetime
+import errno
+import hashlib
 import json
 import os
+import select
 import signal
 import socket
 import subprocess
@@ -14,34 +17,31 @@ import time
 import traceback
 import uuid
 
-from celery import Celery
-from celery.app.control import Control
 from celery.exceptions import TaskRevokedError
 from celery.execute import send_task
-from celery.signals import celeryd_after_setup
 from celery.task.control import revoke
 from celery.utils.log import get_task_logger
-from pymongo import MongoClient
+from pymongo.errors import CollectionInvalid
 import requests
-from twisted.internet import reactor
-from twisted.internet.error import ProcessDone, ProcessTerminated, ProcessExitedAlready
-from twisted.internet.protocol import ProcessProtocol
 
-from minion.backend import ownership
-from minion.backend.utils import backend_config, scan_config, scannable
+from minion.backend import ownership, resources
+from minion.backend.resources import bump_version
+from minion.backend.utils import (EVENTS_VERSION, ISSUES_VERSION, TERMINAL_SCAN_STATES,
+                                  scan_config, scannable)
+from minion.plugins.ipc import FrameReader
 
 
-cfg = backend_config()
-celery = Celery('tasks', broker=cfg['celery']['broker'], backend=cfg['celery']['backend'])
+cfg = resources.config()
+celery = resources.celery_app()
 
-# If the config does not mention mongo then we do not set it up. That is ok because
-# that will only happen in plugin-workers that do not need direct mongodb access.
-if cfg.get('mongodb') is not None:
-    mongodb = MongoClient(host=cfg['mongodb']['host'], port=cfg['mongodb']['port'])
-    db = mongodb.minion
-    plans = db.plans
-    scans = db.scans
-    issues = db.issues
+# Collections connect on first use. Plugin workers, whose config may not mention
+# mongo, never use them.
+plans = resources.collection('plans')
+scans = resources.collection('scans')
+issues = resources.collection('issues')
+jobs = resources.collection('jobs')
+reconciliations = resources.collection('reconciliations')
+artifact_index = resources.collection('artifact_index')
 
 logger = get_task_logger(__name__)
 
@@ -51,12 +51,86 @@ def find_session(scan, session_id):
         if session['id'] == session_id:
             return session
 
+#
+# Every change to a scan increments its 'version' field, which the API uses as ETag.
+# Issues are shared between scans, so changes to issues bump the global 'issues'
+# version counter instead, which is also part of the ETag of every scan.
+#
+# A changed session is stamped with the new version of the scan, and every issue id
+# added to a session gets the version in the parallel 'issue_versions' list. This
+# lets clients ask for only what changed since a version (GET /scans/<id>?since=).
+#
+
+def _update_scan(scan_id, update=None, session_id=None, added_issues=None):
+    """ Apply update to the scan, and to the session if session_id is given,
+    increment the version of the scan and stamp the changes with it. The state and
+    reconcile workers both change scans, so the update only applies to the version
+    that was read and is retried when another worker got there first. """
+    query = {"id": scan_id}
+    if session_id:
+        query["sessions.id"] = session_id
+    for attempt in range(10):
+        scan = scans.find_one(query, {"_id": 0, "version": 1})
+        if not scan:
+            logger.error("Cannot find scan %s (session %s)" % (scan_id, session_id))
+            return
+        version = scan.get('version', 0)
+        stamped = dict((op, dict(fields)) for op, fields in (update or {}).iteritems())
+        stamped["$inc"] = {"version": 1}
+        if session_id:
+            stamped.setdefault("$set", {})["sessions.$.version"] = version + 1
+        if added_issues:
+            stamped["$push"] = {"sessions.$.issues": {"$each": added_issues},
+                                "sessions.$.issue_versions": {"$each": [version + 1] * len(added_issues)}}
+        # Scans created before versions existed have no version field, which None matches
+        result = scans.update(dict(query, version=version or None), stamped)
+        if result.get('n'):
+            return
+    logger.error("Cannot update scan %s, it keeps changing" % scan_id)
+
+#
+# State changes are also appended to the 'events' collection, a capped collection
+# that the API tails to stream scan progress to clients. Every event has a sequence
+# number taken from the 'events' version counter. The state worker runs with a
+# concurrency of 1, so events are stored in sequence order.
+#
+#  { 'seq': 1234, 'type': 'session-state', 'scan': '...', 'session': '...',
+#    'state': 'STARTED', 'time': datetime }
+#
+
+EVENTS_SIZE = 64 * 1024 * 1024
+EVENTS_MAX = 250000
+
+_events = {'ready': False}
+
+def _event_log(seq):
+    # The first event ever also (re)creates the capped collection, in case the
+    # database was reset while this worker was running
+    if not _events['ready'] or seq == 1:
+        try:
+            resources.database().create_collection('events', capped=True, size=EVENTS_SIZE, max=EVENTS_MAX)
+        except CollectionInvalid:
+            pass # Already exists
+        _events['ready'] = True
+    return resources.database().events
+
+def emit_event(event_type, scan_id, session_id=None, **fields):
+    # Events only speed up clients, losing one must never fail a state change
+    try:
+        seq = bump_version(EVENTS_VERSION)
+        event = dict(fields, seq=seq, type=event_type, scan=scan_id, session=session_id,
+                     time=datetime.datetime.utcnow())
+        _event_log(seq).insert(event)
+    except Exception as e:
+        logger.exception("(Ignored) failure while recording %s event for scan %s" % (event_type, scan_id))
+
 
 @celery.task
 def scan_start(scan_id, t):
-    scans.update({"id": scan_id},
+    _update_scan(scan_id,
                  {"$set": {"state": "STARTED",
                            "started": datetime.datetime.utcfromtimestamp(t)}})
+    emit_event('scan-state', scan_id, state="STARTED")
 
 @celery.task
 def scan_finish(scan_id, state, t, failure=None):
@@ -77,15 +151,21 @@ def scan_finish(scan_id, state, t, failure=None):
         #
 
         if failure:
-            scans.update({"id": scan_id},
+            _update_scan(scan_id,
                          {"$set": {"state": state,
                                    "finished": datetime.datetime.utcfromtimestamp(t),
                                    "failure": failure}})
         else:
-            scans.update({"id": scan_id},
+            _update_scan(scan_id,
                          {"$set": {"state": state,
                                    "finished": datetime.datetime.utcfromtimestamp(t)}})
 
+        #
+        # Tell the clients that follow the scan
+        #
+
+        emit_event('scan-state', scan_id, state=state)
+
         #
         # Fire the callback
         #
@@ -107,15 +187,25 @@ def scan_finish(scan_id, state, t, failure=None):
         for s in scan['sessions']:
             if s['state'] == 'CREATED':
                 s['state'] = 'CANCELLED'
-                scans.update({"id": scan_id, "sessions.id": s['id']},
-                             {"$set": {"sessions.$.state": "CANCELLED"}})
+                _update_scan(scan_id,
+                             {"$set": {"sessions.$.state": "CANCELLED"}}, s['id'])
+                emit_event('session-state', scan_id, s['id'], state="CANCELLED")
+
+        #
+        # Now that all sessions are done, reconcile the issue status with the previous scan
+        #
+
+        try:
+            schedule_status_issues(scan)
+        except Exception as e:
+            logger.exception("(Ignored) failure while scheduling issue status reconciliation for scan %s" % scan['id'])
 
     except Exception as e:
 
         logger.exception("Error while finishing scan. Trying to mark scan as FAILED.")
 
         try:
-            scans.update({"id": scan_id},
+            _update_scan(scan_id,
                          {"$set": {"state": "FAILED",
                                    "finished": datetime.datetime.utcnow()}})
         except Exception as e:
@@ -141,7 +231,8 @@ def scan_stop(scan_id):
         # Set the scan to cancelled. Even though some plugins may still run.
         #
 
-        scans.update({"id": scan_id}, {"$set": {"state": "STOPPED", "started": datetime.datetime.utcnow()}})
+        _update_scan(scan_id, {"$set": {"state": "STOPPED", "started": datetime.datetime.utcnow()}})
+        emit_event('scan-state', scan_id, state="STOPPED")
 
         #
         # Set all QUEUED and STARTED sessions to STOPPED and revoke the sessions that have been queued
@@ -149,7 +240,8 @@ def scan_stop(scan_id):
 
         for session in scan['sessions']:
             if session['state'] in ('QUEUED', 'STARTED'):
-                scans.update({"id": scan_id, "sessions.id": session['id']}, {"$set": {"sessions.$.state": "STOPPED", "sessions.$.finished": datetime.datetime.utcnow()}})
+                _update_scan(scan_id, {"$set": {"sessions.$.state": "STOPPED", "sessions.$.finished": datetime.datetime.utcnow()}}, session['id'])
+                emit_event('session-state', scan_id, session['id'], state="STOPPED")
             if '_task' in session:
                 revoke(session['_task'], terminate=True, signal='SIGUSR1')
 
@@ -159,250 +251,289 @@ def scan_stop(scan_id):
 
         try:
             if scan:
-                scans.update({"id": scan_id}, {"$set": {"state": "FAILED", "finished": datetime.datetime.utcnow()}})
+                _update_scan(scan_id, {"$set": {"state": "FAILED", "finished": datetime.datetime.utcnow()}})
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
 
 @celery.task
 def session_queue(scan_id, session_id, t):
-    scans.update({"id": scan_id, "sessions.id": session_id},
+    _update_scan(scan_id,
                  {"$set": {"sessions.$.state": "QUEUED",
-                           "sessions.$.queued": datetime.datetime.utcfromtimestamp(t)}})
+                           "sessions.$.queued": datetime.datetime.utcfromtimestamp(t)}}, session_id)
+    emit_event('session-state', scan_id, session_id, state="QUEUED")
 
 @celery.task
 def session_start(scan_id, session_id, t):
-    scans.update({"id": scan_id, "sessions.id": session_id},
+    _update_scan(scan_id,
                  {"$set": {"sessions.$.state": "STARTED",
-                           "sessions.$.started": datetime.datetime.utcfromtimestamp(t)}})
+                           "sessions.$.started": datetime.datetime.utcfromtimestamp(t)}}, session_id)
+    emit_event('session-state', scan_id, session_id, state="STARTED")
 
 @celery.task
 def session_set_task_id(scan_id, session_id, task_id):
-    scans.update({"id": scan_id, "sessions.id": session_id},
-                 {"$set": {"sessions.$._task": task_id}})
-
-@celery.task
-def session_report_issue(scan_id, session_id, issue):
-    # Check if the issue already exists.
-    # If not, insert it in the collection then put the reference in the scan,
-    # else put the reference in the scan and update the severity and description
-    found_issue = issues.find_one({"Id": issue["Id"]})
-    if found_issue is None:
-        issues.insert(issue)
-    else:
+    _update_scan(scan_id,
+                 {"$set": {"sessions.$._task": task_id}}, session_id)
+
+# The plugin worker sends at most this many issues in one session_report_issues task
+ISSUE_BATCH_SIZE = 100
+
+def _report_issues(scan_id, session_id, new_issues):
+    # Insert the issues that do not exist yet, in one go. Update the severity,
+    # description and urls of the others. Then put all references in the scan.
+    existing = set(i["Id"] for i in issues.find({"Id": {"$in": [i["Id"] for i in new_issues]}},
+                                               {"_id": 0, "Id": 1}))
+    inserts, updates = [], []
+    for issue in new_issues:
+        if issue["Id"] in existing:
+            updates.append(issue)
+        else:
+            inserts.append(issue)
+            existing.add(issue["Id"])
+    if inserts:
+        issues.insert(inserts)
+    for issue in updates:
         description = issue["Description"] if "Description" in issue else "No Description available"
         issues.update({"Id": issue["Id"]}, {"$set": {"Severity": issue["Severity"],
                                                      "Description": description,
                                                      "URLs": issue["URLs"]}})
-    scans.update({"id": scan_id, "sessions.id": session_id},
-                 {"$push": {"sessions.$.issues": issue["Id"]}})
+    if updates:
+        bump_version(ISSUES_VERSION)
+    _update_scan(scan_id, session_id=session_id, added_issues=[issue["Id"] for issue in new_issues])
+    for issue in new_issues:
+        emit_event('issue', scan_id, session_id, issue=issue["Id"], severity=issue.get("Severity"))
+
+@celery.task
+def session_report_issue(scan_id, session_id, issue):
+    _report_issues(scan_id, session_id, [issue])
+
+@celery.task
+def session_report_issues(scan_id, session_id, new_issues):
+    if new_issues:
+        _report_issues(scan_id, session_id, new_issues)
+
+#
+# Plugins can report their progress often. The plugin worker coalesces progress
+# reports per session and sends at most one every PROGRESS_INTERVAL seconds, only
+# the latest. The session keeps the last one, with the time it was reported.
+#
+
+PROGRESS_INTERVAL = 5
+
+@celery.task(ignore_result=True)
+def session_progress(scan_id, session_id, progress, t):
+    _update_scan(scan_id,
+                 {"$set": {"sessions.$.progress": {"percentage": progress.get("percentage"),
+                                                   "description": progress.get("description", ""),
+                                                   "updated": datetime.datetime.utcfromtimestamp(t)}}}, session_id)
+    emit_event('session-progress', scan_id, session_id,
+               percentage=progress.get("percentage"), description=progress.get("description", ""))
 
 @celery.task
 def session_report_artifact(scan_id, session_id, artifact):
-    scans.update({"id": scan_id, "sessions.id": session_id},
-                 {"$push": {"sessions.$.artifacts": artifact}})
+    _update_scan(scan_id,
+                 {"$push": {"sessions.$.artifacts": artifact}}, session_id)
+    # Index the files that were uploaded to the artifact store by their name
+    for f in artifact.get('files', []):
+        artifact_index.update({"scan": scan_id, "name": f['name']},
+                              {"scan": scan_id, "session": session_id, "name": f['name'],
+                               "sha256": f['sha256'], "length": f['length']}, upsert=True)
 
 @celery.task
 def session_finish(scan_id, session_id, state, t, failure=None):
     if failure:
-        scans.update({"id": scan_id, "sessions.id": session_id},
+        _update_scan(scan_id,
                      {"$set": {"sessions.$.state": state,
                                "sessions.$.finished": datetime.datetime.utcfromtimestamp(t),
-                               "sessions.$.failure": failure}})
+                               "sessions.$.failure": failure}}, session_id)
     else:
-        scans.update({"id": scan_id, "sessions.id": session_id},
+        _update_scan(scan_id,
                      {"$set": {"sessions.$.state": state,
-                               "sessions.$.finished": datetime.datetime.utcfromtimestamp(t)}})
-
-@celery.task
-def set_status_issues(scan_id):
-    scan = scans.find_one({"id": scan_id})
-    list_scan = list(scans.find({'configuration.target': scan['configuration']['target'], 'plan.name': scan['plan']['name']}).sort("created", -1))
-    last_scan = list_scan[0]
-
-    if len(list_scan) > 1:
-
-        second_to_last_scan = list_scan[1]
-
-        # For each session in last scan
-        for session in last_scan['sessions']:
-            # For each issue in last scan (in each session)
-            for issue in session['issues']:
-                # Check if issue is in second_to_last_scan :
-                in_second_to_last = False
-                for second_session in second_to_last_scan['sessions']:
-                    if issue in second_session['issues']:
-                        old_issue = issues.find_one({"Id": issue})
-                        issues.update({"Id": issue},
-                                      {"$set": {"Status": old_issue["Status"], "OldStatus": old_issue['Status']}})
-                        in_second_to_last = True
-                        break
-
-                # Else it's a new issue
-                if not in_second_to_last:
-                    issues.update({"Id": issue},
-                                  {"$set": {"Status": "Current", "OldStatus": "-"}})
-
-        for second_session in second_to_last_scan['sessions']:
-            # For each issue in last scan (in each session)
-            for issue in second_session['issues']:
-                # Check if issue is in second_to_last_scan :
-                issue_found = False
-                last_session_id = None
-                for session in last_scan['sessions']:
-                    if session['plugin']['name'] == second_session['plugin']['name']:
-                        last_session_id = session["id"]
-                        if issue in session['issues']:
-                            issue_found = True
-                            break
-
-                # Else the issue is fixed if the scan ended well
-                if not issue_found and last_session_id is not None: #
-                    # if not issue_found and last_session_id is not None:
-                    scans.update({"id": scan_id, "sessions.id": last_session_id},
-                                 {"$push": {"sessions.$.issues": issue}})
-
-                    old_issue = issues.find_one({"Id": issue})
-
-                    state = "Fixed"
-
-                    # Fix only if scan finished well
-                    if session["state"] == "FINISHED":
-                        state = "Fixed"
-                    else:
-                        state = old_issue['Status']
-                        
-                    issues.update({"Id": issue}, {"$set": {"Status": state, "OldStatus": old_issue['Status']}})
-
-    else:
-        # It's the first scan, all issues are new
-        for session in last_scan['sessions']:
-            for issue in session['issues']:
-                issues.update({"Id": issue},
-                              {"$set": {"Status": "Current", "OldStatus": "-"}})
-
-
-# plugin_worker
-
-
-
-
-
-
-
-plugin_runner_process = None
+                               "sessions.$.finished": datetime.datetime.utcfromtimestamp(t)}}, session_id)
+    emit_event('session-state', scan_id, session_id, state=state)
 
+def _issue_ids_by_plugin(scan):
+    """ Map each plugin name of a scan to its last session and the set of issue ids
+    of all its sessions. A plan can run the same plugin more than once. """
+    result = {}
+    for session in scan['sessions']:
+        name = session['plugin']['name']
+        issue_ids = result[name][1] if name in result else set()
+        result[name] = (session, issue_ids | set(session.get('issues', [])))
+    return result
+
+def _set_issues_status(issue_ids, status=None):
+    """ Set the status of the given issues, remembering their previous status. When
+    status is None the issues keep their current status. One update is done per
+    distinct previous status rather than one per issue. """
+    by_old_status = {}
+    for issue in issues.find({"Id": {"$in": list(issue_ids)}}, {"_id": 0, "Id": 1, "Status": 1}):
+        by_old_status.setdefault(issue.get('Status'), []).append(issue['Id'])
+    for old_status, ids in by_old_status.iteritems():
+        issues.update({"Id": {"$in": ids}},
+                      {"$set": {"Status": status if status is not None else old_status, "OldStatus": old_status}},
+                      multi=True)
 
 #
+# Issue status reconciliation runs once per finished scan on its own 'reconcile' queue.
+# Requests for the same target and plan are coalesced: while one is pending, new requests
+# only mark it pending again and the running task picks that up when it is done.
 #
-#
-
-class Runner(ProcessProtocol):
-
-    def __init__(self, plugin_class, configuration, session_id, callback):
-        self._plugin_class = plugin_class
-        self._configuration = configuration
-        self._session_id = session_id
-        self._callback = callback
-        self._exit_status = None
-        self._process = None
-        self._buffer = ""
-
-    # ProcessProtocol Methods
-
-    def _parseLines(self, buffer):
-        lines = buffer.split("\n")
-        if len(lines) == 1:
-            return ([], buffer)
-        elif buffer.endswith("\n"):
-            return (lines[0:-1],"")
-        else:
-            return (lines[0:-1],lines[-1])
-
-    def outReceived(self, data):
-        # Parse incoming data, taking incomplete lines into account
-        buffer = self._buffer + data
-        lines, self._buffer = self._parseLines(buffer)
-        # Process all the complete lines that we received
-        for line in lines:
-            self._process_message(line)
 
-    def errReceived(self, data):
-        pass # TODO What to do with stderr?
-
-    def processEnded(self, reason):
-        if isinstance(reason.value, ProcessTerminated):
-            self._exit_status = reason.value.status
-        if isinstance(reason.value, ProcessDone):
-            self._exit_status = reason.value.status
-        self._process = None
-        reactor.stop()
-
-    # Runner
-
-    def _process_message(self, message):
-        # TODO Harden this by catching JSON parse errors and invalid messages
-        m = json.loads(message)
-        self._callback(m)
+# A pending reconciliation that has not been picked up after this many seconds is
+# assumed to be lost and is dispatched again.
+RECONCILE_TIMEOUT = 3600
+
+def schedule_status_issues(scan):
+    key = {'target': scan['configuration']['target'], 'plan': scan['plan']['name']}
+    now = datetime.datetime.utcnow()
+    previous = reconciliations.find_and_modify(key, {'$set': {'pending': True}}, upsert=True)
+    if previous and previous.get('pending'):
+        dispatched = previous.get('dispatched')
+        if dispatched and (now - dispatched).total_seconds() < RECONCILE_TIMEOUT:
+            return
+    reconciliations.update(key, {'$set': {'dispatched': now}})
+    send_task("minion.backend.tasks.set_status_issues",
+              args=[scan['id']],
+              queue='reconcile')
 
-    def _locate_program(self, program_name):
-        for path in os.getenv('PATH').split(os.pathsep):
-            program_path = os.path.join(path, program_name)
-            if os.path.isfile(program_path) and os.access(program_path, os.X_OK):
-                return program_path
+@celery.task(ignore_result=True)
+def set_status_issues(scan_id):
+    scan = scans.find_one({"id": scan_id}, {"_id": 0, "configuration.target": 1, "plan.name": 1})
+    if not scan:
+        logger.error("Cannot find scan %s" % scan_id)
+        return
+    target, plan_name = scan['configuration']['target'], scan['plan']['name']
+    while reconciliations.find_and_modify({'target': target, 'plan': plan_name, 'pending': True},
+                                          {'$set': {'pending': False}}):
+        _reconcile_issues(target, plan_name)
+        bump_version(ISSUES_VERSION)
+
+def _reconcile_issues(target, plan_name):
+
+    #
+    # Only the two most recent finished scans of the target and plan matter, and only
+    # the plugin names, session states and issue ids of those.
+    #
+
+    fields = {"_id": 0, "id": 1, "sessions.id": 1, "sessions.state": 1,
+              "sessions.plugin.name": 1, "sessions.issues": 1}
+    list_scan = list(scans.find({'configuration.target': target, 'plan.name': plan_name,
+                                 'state': {'$in': list(TERMINAL_SCAN_STATES)}}, fields).sort("created", -1).limit(2))
+    if not list_scan:
+        return
+    last_scan = list_scan[0]
+    last_sessions = _issue_ids_by_plugin(last_scan)
+    last_issues = set()
+    for session, issue_ids in last_sessions.itervalues():
+        last_issues |= issue_ids
 
-    def run(self):
+    if len(list_scan) == 1:
+        # It's the first scan, all issues are new
+        if last_issues:
+            issues.update({"Id": {"$in": list(last_issues)}},
+                          {"$set": {"Status": "Current", "OldStatus": "-"}}, multi=True)
+        return
+
+    second_to_last_sessions = _issue_ids_by_plugin(list_scan[1])
+    second_to_last_issues = set()
+    for session, issue_ids in second_to_last_sessions.itervalues():
+        second_to_last_issues |= issue_ids
+
+    # Issues seen in both scans keep their status, new issues are Current
+    _set_issues_status(last_issues & second_to_last_issues)
+    new_issues = last_issues - second_to_last_issues
+    if new_issues:
+        issues.update({"Id": {"$in": list(new_issues)}},
+                      {"$set": {"Status": "Current", "OldStatus": "-"}}, multi=True)
+
+    #
+    # Issues that a plugin reported last time but not this time are carried over to the
+    # last session of that plugin. They are Fixed only when that session finished well.
+    #
+
+    for plugin_name, (second_session, second_issue_ids) in second_to_last_sessions.iteritems():
+        if plugin_name not in last_sessions:
+            continue
+        session, issue_ids = last_sessions[plugin_name]
+        missing = second_issue_ids - issue_ids
+        if not missing:
+            continue
+        _update_scan(last_scan['id'], session_id=session['id'], added_issues=list(missing))
+        _set_issues_status(missing, "Fixed" if session['state'] == "FINISHED" else None)
+
+
+# delete_worker
 
-        #
-        # Setup the arguments
-        #
+#
+# Cascading deletes can touch thousands of scans and issues. They run as jobs on the
+# 'delete' queue so that the API can return immediately. Scans are fetched and removed
+# in batches so that the worker never holds the complete scan history in memory.
+#
 
-        self._arguments = [ "minion-plugin-runner",
-                           "-c", json.dumps(self._configuration),
-                           "-p", self._plugin_class,
-                           "-s", self._session_id ]
+DELETE_BATCH_SIZE = 250
+
+def _delete_scan_batch(batch):
+    scan_ids = [s['id'] for s in batch]
+    issue_ids = set()
+    for s in batch:
+        for session in s.get('sessions', []):
+            issue_ids.update(session.get('issues', []))
+    # Issues that are also referenced by a scan outside of this batch must survive
+    orphans = issue_ids
+    if issue_ids:
+        shared = scans.find({"sessions.issues": {"$in": list(issue_ids)},
+                             "id": {"$nin": scan_ids}}).distinct("sessions.issues")
+        orphans = issue_ids - set(shared)
+    if orphans:
+        issues.remove({"Id": {"$in": list(orphans)}})
+    scans.remove({"id": {"$in": scan_ids}})
+    artifact_index.remove({"scan": {"$in": scan_ids}})
+    return len(scan_ids), len(orphans)
 
-        #
-        # Spawn a plugin-runner process
-        #
+@celery.task(ignore_result=True)
+def delete_scans(job_id, query):
 
-        plugin_runner_path = self._locate_program("minion-plugin-runner")
-        if plugin_runner_path is None:
-            # TODO EMIT FAILURE
-            return False
+    try:
 
-        self._process = reactor.spawnProcess(self, plugin_runner_path, self._arguments, env=None)
+        jobs.update({"id": job_id},
+                    {"$set": {"state": "STARTED",
+                              "started": datetime.datetime.utcnow(),
+                              "progress.total": scans.find(query).count()}})
 
         #
-        # Run the twisted reactor. It will be stopped either when the plugin-runner has
-        # finished or when it has timed out.
+        # Always take the first batch of matching scans; the previous batch is gone by then.
         #
 
-        reactor.run()
-
-        return self._exit_status
+        while True:
+            batch = list(scans.find(query, {"_id": 0, "id": 1, "sessions.issues": 1}).limit(DELETE_BATCH_SIZE))
+            if not batch:
+                break
+            removed_scans, removed_issues = _delete_scan_batch(batch)
+            jobs.update({"id": job_id},
+                        {"$inc": {"progress.scans": removed_scans,
+                                  "progress.issues": removed_issues}})
+
+        jobs.update({"id": job_id},
+                    {"$set": {"state": "FINISHED",
+                              "finished": datetime.datetime.utcnow()}})
 
-    def terminate(self):
-        if self._process is not None:
-            try:
-                self._process.signalProcess('KILL')
-            except ProcessExitedAlready as e:
-                pass
-        if self._terminate_id is not None:
-            if self._terminate_id.active():
-                self._terminate_id.cancel()
-            self._terminate_id = None
+    except Exception as e:
 
-    def schedule_stop(self):
+        logger.exception("Error while deleting scans. Marking job %s as FAILED." % job_id)
 
-        #
-        # Send the plugin runner a USR1 signal to tell it to stop. Also
-        # start a timer to force kill the runner if it does not stop
-        # on time.
-        #
+        try:
+            failure = { "hostname": socket.gethostname(),
+                        "message": str(e),
+                        "exception": traceback.format_exc() }
+            jobs.update({"id": job_id},
+                        {"$set": {"state": "FAILED",
+                                  "finished": datetime.datetime.utcnow(),
+                                  "failure": failure}})
+        except Exception as e:
+            logger.exception("Error when marking job as FAILED")
 
-        self._process.signalProcess(signal.SIGUSR1)
-        self._terminate_id = reactor.callLater(10, self.terminate)
 
+# plugin_worker
 
 def get_scan(api_url, scan_id):
     r = requests.get(api_url + "/scans/" + scan_id)
@@ -416,6 +547,42 @@ def get_site_info(api_url, url):
     j = r.json()
     return j['sites'][0]
 
+#
+# Artifacts are uploaded to the artifact store of the API in chunks, unless the
+# store already has a file with the same content.
+#
+
+ARTIFACT_CHUNK_SIZE = 256 * 1024
+
+def _file_chunks(path):
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(ARTIFACT_CHUNK_SIZE), b''):
+            yield chunk
+
+def upload_artifact(api_url, path):
+    digest, length = hashlib.sha256(), 0
+    for chunk in _file_chunks(path):
+        digest.update(chunk)
+        length += len(chunk)
+    sha256 = digest.hexdigest()
+    r = requests.get(api_url + "/artifacts/" + sha256)
+    r.raise_for_status()
+    if not r.json()['success']:
+        upload = uuid.uuid4().hex
+        for n, chunk in enumerate(_file_chunks(path)):
+            r = requests.put(api_url + "/artifacts/%s/uploads/%s/chunks/%d" % (sha256, upload, n), data=chunk,
+                             headers={'Content-Type': 'application/octet-stream'})
+            r.raise_for_status()
+            if not r.json()['success']:
+                # Another worker stored the same file meanwhile
+                break
+        r = requests.put(api_url + "/artifacts/" + sha256, headers={'Content-Type': 'application/json'},
+                         data=json.dumps({'upload': upload, 'length': length, 'chunk_size': ARTIFACT_CHUNK_SIZE}))
+        r.raise_for_status()
+        if not r.json()['success']:
+            raise Exception("Cannot store artifact %s: %s" % (path, r.json()['reason']))
+    return {'name': os.path.basename(path), 'sha256': sha256, 'length': length}
+
 def set_finished(scan_id, state, failure=None):
     send_task("minion.backend.tasks.scan_finish",
               [scan_id, state, time.time(), failure],
@@ -430,8 +597,55 @@ def find_session(scan, session_id):
         if session['id'] == session_id:
             return session
 
+#
+# Plugin workers run many sessions in the same process, so run_plugin must leave
+# nothing behind: the plugin-runner is always waited for, its pipe is always closed
+# and the SIGUSR1 handler is only installed while the session runs. Every session
+# checks that it did not leave pipes or threads behind.
+#
+
+@contextlib.contextmanager
+def _plugin_runner(arguments):
+    """ Spawn a plugin-runner and forward SIGUSR1 to it, which is how celery tells us
+    that the session was revoked. When the block exits, the runner is gone and the
+    previous SIGUSR1 handler is back, whatever happened in the block. """
+    p = subprocess.Popen(arguments, stdout=subprocess.PIPE, close_fds=True)
+    def forward_signal(signum, frame):
+        if p.returncode is None:
+            p.send_signal(signum)
+    previous_handler = signal.signal(signal.SIGUSR1, forward_signal)
+    try:
+        yield p
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+        p.stdout.close()
+        if p.poll() is None:
+            try:
+                p.kill()
+            except OSError:
+                pass # Exited just now
+            p.wait()
+
+def _open_pipes():
+    """ Return the number of pipes this process has open, or None when that
+    cannot be found out on this platform. """
+    try:
+        return sum(1 for fd in os.listdir('/proc/self/fd')
+                   if os.readlink(os.path.join('/proc/self/fd', fd)).startswith('pipe:'))
+    except OSError:
+        return None
+
 @celery.task
 def run_plugin(scan_id, session_id):
+    pipes, threads = _open_pipes(), threading.active_count()
+    try:
+        return _run_plugin(scan_id, session_id)
+    finally:
+        if _open_pipes() != pipes or threading.active_count() != threads:
+            logger.error("Plugin session %s/%s leaked resources: %s pipes and %d threads before, %s and %d after"
+                         % (scan_id, session_id, pipes, threads, _open_pipes(), threading.active_count()))
+
+def _run_plugin(scan_id, session_id):
 
     logger.debug("This is run_plugin " + str(scan_id) + " " + str(session_id))
 
@@ -478,88 +692,107 @@ def run_plugin(scan_id, session_id):
 
         finished = None
 
+        progress = {'pending': None, 'sent': 0}
+
+        def send_progress():
+            if progress['pending'] is not None:
+                send_task("minion.backend.tasks.session_progress",
+                          [scan_id, session_id, progress['pending'], time.time()],
+                          queue='state')
+                progress['pending'], progress['sent'] = None, time.time()
+
+        def report_issues(batch):
+            for n in range(0, len(batch), ISSUE_BATCH_SIZE):
+                send_task("minion.backend.tasks.session_report_issues",
+                          args=[scan_id, session_id, batch[n:n + ISSUE_BATCH_SIZE]],
+                          queue='state').get()
+
         #
-        # This is an experiment to see if removing Twisted makes the celery workers more stable.
+        # The plugin-runner writes framed messages to its stdout (see minion.plugins.ipc),
+        # which are read by a single poll loop. The issues that arrive together are stored
+        # with a single task. While we wait for the state worker the pipe fills up, which
+        # makes the plugin wait too.
         #
 
-        def enqueue_output(fd, queue):
-            try:
-                for line in iter(fd.readline, b''):
-                    queue.put(line)
-            except Exception as e:
-                logger.exception("Error while reading a line from the plugin-runner")
-            finally:
-                fd.close()
-                queue.put(None)
-
-        def make_signal_handler(p):
-            def signal_handler(signum, frame):
-                p.send_signal(signal.SIGUSR1)
-            return signal_handler
-
-        arguments = [ "minion-plugin-runner",
+        arguments = [ "minion-plugin-runner", "--framed",
                       "-c", json.dumps(session['configuration']),
                       "-p", session['plugin']['class'],
                       "-s", session_id ]
 
-        p = subprocess.Popen(arguments, bufsize=1, stdout=subprocess.PIPE, close_fds=True)
+        with _plugin_runner(arguments) as p:
 
-        signal.signal(signal.SIGUSR1, make_signal_handler(p))
+            reader = FrameReader(p.stdout.fileno())
+            poller = select.poll()
+            poller.register(reader.fd, select.POLLIN)
 
-        q = Queue.Queue()
-        t = threading.Thread(target=enqueue_output, args=(p.stdout, q))
-        t.daemon = True
-        t.start()
+            while not reader.closed:
 
-        while True:
-            try:
-                line = q.get(timeout=0.25)
-                if line is None:
-                    break
-
-                line = line.strip()
-
-                if finished is not None:
-                    logger.error("Plugin emitted (ignored) message after finishing: " + line)
-                    return
+                # Only wake up without messages when there is progress left to send
+                timeout = None
+                if progress['pending'] is not None:
+                    timeout = max(0, progress['sent'] + PROGRESS_INTERVAL - time.time()) * 1000
 
                 try:
-                    msg = json.loads(line)
-                except Exception as e:
-                    logger.error("Could not decode: " + line)
-
-                    # raise Exception(e.message + str(line))
-
-                # Issue: persist it
-                if msg['msg'] == 'issue':
-                    send_task("minion.backend.tasks.session_report_issue",
-                              args=[scan_id, session_id, msg['data']],
-                              queue='state').get()
-
-                # Progress: update the progress
-                if msg['msg'] == 'progress':
-                    pass # TODO
-
-                # Artifact: save the report
-                if msg['msg'] == 'artifact':
-                    send_task("minion.backend.tasks.session_report_artifact",
-                              args=[scan_id, session_id, msg['data']],
-                              queue='state').get()
-
-                # Finish: update the session state, wait for the plugin runner to finish, return the state
-                if msg['msg'] == 'finish':
-                    finished = msg['data']['state']
-                    if msg['data']['state'] in ('FINISHED', 'FAILED', 'STOPPED', 'TERMINATED', 'TIMEOUT', 'ABORTED'):
-                        send_task("minion.backend.tasks.session_finish",
-                                  [scan['id'], session['id'], msg['data']['state'], time.time(), msg['data']['failure']],
+                    ready = poller.poll(timeout)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                # A corrupt stream raises FrameError, which fails the session
+                messages = reader.read() if ready else []
+
+                issues = []
+
+                for msg in messages:
+
+                    if finished is not None:
+                        logger.error("Plugin emitted (ignored) message after finishing: %r" % msg)
+                        continue
+
+                    # Issues: persist them, together with the others that arrived at the same time
+                    if msg['msg'] == 'issue':
+                        issues.append(msg['data'])
+                    if msg['msg'] == 'issues':
+                        issues.extend(msg['data'])
+
+                    # Progress: keep only the latest, it is sent below
+                    if msg['msg'] == 'progress':
+                        progress['pending'] = msg['data']
+
+                    # Artifact: upload the files, then save the report. Files that cannot be
+                    # uploaded can only be served by an API node that shares this filesystem.
+                    if msg['msg'] == 'artifact':
+                        msg['data']['files'] = []
+                        for path in msg['data']['paths']:
+                            try:
+                                msg['data']['files'].append(upload_artifact(cfg['api']['url'], path))
+                            except Exception as e:
+                                logger.exception("Cannot upload artifact %s" % path)
+                        send_task("minion.backend.tasks.session_report_artifact",
+                                  args=[scan_id, session_id, msg['data']],
                                   queue='state').get()
 
-            except Queue.Empty:
-                pass
+                    # Finish: update the session state, wait for the plugin runner to finish, return the state
+                    if msg['msg'] == 'finish':
+                        finished = msg['data']['state']
+                        report_issues(issues)
+                        issues = []
+                        send_progress()
+                        if msg['data']['state'] in ('FINISHED', 'FAILED', 'STOPPED', 'TERMINATED', 'TIMEOUT', 'ABORTED'):
+                            send_task("minion.backend.tasks.session_finish",
+                                      [scan['id'], session['id'], msg['data']['state'], time.time(), msg['data']['failure']],
+                                      queue='state').get()
+
+                report_issues(issues)
 
-        return_code = p.wait()
+                if time.time() - progress['sent'] >= PROGRESS_INTERVAL:
+                    send_progress()
 
-        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            if reader.malformed:
+                logger.error("Plugin session %s/%s emitted %d malformed messages" % (scan_id, session_id, reader.malformed))
+
+            return_code = p.wait()
 
         if not finished:
             failure = { "hostname": socket.gethostname(),
@@ -569,10 +802,6 @@ def run_plugin(scan_id, session_id):
                       [scan['id'], session['id'], 'FAILED', time.time(), failure],
                       queue='state').get()
 
-        send_task("minion.backend.tasks.set_status_issues",
-                  args=[scan_id],
-                  queue='state').get()
-
         return finished
 
     except Exception as e:
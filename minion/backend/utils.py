@@ -31,6 +31,14 @@ DEFAULT_SCAN_CONFIG = {
     'blacklist': DEFAULT_BLACKLIST
 }
 
+# Shared by the API and the workers: the names of the version counters that
+# the workers bump, and the states in which a scan is done
+
+ISSUES_VERSION = 'issues'
+EVENTS_VERSION = 'events'
+
+TERMINAL_SCAN_STATES = ('FINISHED', 'FAILED', 'STOPPED', 'ABORTED', 'TERMINATED', 'TIMEOUT')
+
 DEFAULT_BACKEND_CONFIG = {
     'api': {
         'url': 'http://127.0.0.1:8383',
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+from flask import jsonify, request
+
+from minion.backend import artifacts
+from minion.backend.app import app
+from minion.backend.views.base import api_guard
+
+# A chunk larger than this is refused, to keep chunk documents well below the
+# maximum document size of MongoDB
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# API Methods used by the plugin workers to upload artifacts
+
+#
+# Check whether the store already has a file with the given content
+#
+#  GET /artifacts/<sha256>
+#
+# Returns:
+#
+#  { 'success': True, 'artifact': { 'sha256': '...', 'length': 1234567 } }
+#
+# or 'no-such-artifact' when the file still needs to be uploaded.
+#
+
+@app.route('/artifacts/<sha256>', methods=['GET'])
+@api_guard
+def get_stored_artifact(sha256):
+    blob = artifacts.find_blob(sha256)
+    if not blob:
+        return jsonify(success=False, reason='no-such-artifact')
+    return jsonify(success=True, artifact={'sha256': blob['_id'], 'length': blob['length']})
+
+#
+# Upload chunk n of a file. The upload id is 32 hex digits that the uploader
+# picks, for example uuid.uuid4().hex. The body holds the raw bytes of the chunk:
+#
+#  PUT /artifacts/<sha256>/uploads/<upload>/chunks/<n>
+#  Content-Type: application/octet-stream
+#
+# Fails with 'artifact-exists' when the store already has the file; it can then
+# be committed right away.
+#
+
+@app.route('/artifacts/<sha256>/uploads/<upload>/chunks/<int:n>', methods=['PUT'])
+@api_guard('application/octet-stream')
+def put_artifact_chunk(sha256, upload, n):
+    if not artifacts.is_sha256(sha256):
+        return jsonify(success=False, reason='invalid-sha256')
+    if not artifacts.is_upload_id(upload):
+        return jsonify(success=False, reason='invalid-upload')
+    data = request.data
+    if not data or len(data) > MAX_CHUNK_SIZE:
+        return jsonify(success=False, reason='invalid-chunk')
+    reason = artifacts.put_chunk(sha256, upload, n, data)
+    if reason:
+        return jsonify(success=False, reason=reason)
+    return jsonify(success=True)
+
+#
+# Make an uploaded file available, after checking its chunks against its
+# content hash:
+#
+#  PUT /artifacts/<sha256>
+#  Content-Type: application/json
+#
+#  { 'upload': '<upload>', 'length': 1234567, 'chunk_size': 262144 }
+#
+# Fails with 'missing-chunks' or 'checksum-mismatch' when the chunks do not
+# add up to the file. Succeeds without looking at the chunks when the store
+# already has the file.
+#
+
+@app.route('/artifacts/<sha256>', methods=['PUT'])
+@api_guard('application/json')
+def put_artifact(sha256):
+    if not artifacts.is_sha256(sha256):
+        return jsonify(success=False, reason='invalid-sha256')
+    upload = request.json.get('upload')
+    if not artifacts.is_upload_id(upload):
+        return jsonify(success=False, reason='invalid-upload')
+    length, chunk_size = request.json.get('length'), request.json.get('chunk_size')
+    if not isinstance(length, int) or length < 0:
+        return jsonify(success=False, reason='invalid-length')
+    if not isinstance(chunk_size, int) or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        return jsonify(success=False, reason='invalid-chunk-size')
+    reason = artifacts.commit_blob(sha256, upload, length, chunk_size)
+    if reason:
+        return jsonify(success=False, reason=reason)
+    return jsonify(success=True, artifact={'sha256': sha256, 'length': length})
@@ -2,28 +2,42 @@
 
 import calendar
 import functools
-import importlib
-import inspect
-import pkgutil
+import json
+import zlib
 
-from pymongo import MongoClient
-
-import minion.backend.utils as backend_utils
 import os
-from flask import abort, request
-from minion.backend.app import app
-from minion.plugins.base import AbstractPlugin
-
-backend_config = backend_utils.backend_config()
-
-mongo_client = MongoClient(host=backend_config['mongodb']['host'], port=backend_config['mongodb']['port'])
-invites = mongo_client.minion.invites
-groups = mongo_client.minion.groups
-plans = mongo_client.minion.plans
-scans = mongo_client.minion.scans
-sites = mongo_client.minion.sites
-users = mongo_client.minion.users
-issues = mongo_client.minion.issues
+from flask import Response, abort, request
+from minion.backend import plugin_manifest, resources
+from minion.backend.resources import bump_version, current_version # Used by the views
+
+backend_config = resources.config()
+
+invites = resources.collection('invites')
+groups = resources.collection('groups')
+plans = resources.collection('plans')
+scans = resources.collection('scans')
+sites = resources.collection('sites')
+users = resources.collection('users')
+issues = resources.collection('issues')
+jobs = resources.collection('jobs')
+access = resources.collection('access')
+memberships = resources.collection('memberships')
+events = resources.collection('events')
+artifacts = resources.collection('artifacts')
+artifact_chunks = resources.collection('artifact_chunks')
+artifact_index = resources.collection('artifact_index')
+
+def not_modified(etag):
+    """ Return a 304 response if the client already has the version of the
+    resource identified by etag, or None if the resource should be sent. """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    return response
 
 def api_guard(*decor_args):
     """ Decorate a view function to be protected by requiring
@@ -61,45 +75,33 @@ def api_guard(*decor_args):
         return decorator
 
 #
-# Build the plugin registry
+# The plugin registry. It is read from the plugin manifest the first time it is
+# used, so the API never imports plugin code (see minion.backend.plugin_manifest).
 #
 
-plugins = {}
-
-def load_plugin():
-    """ Load plugins if they are subclass of AbstractPlugin and
-    are not known base subclasses such as BlockingPlugin. """
-
-    DEFAULT_BASE_CLASSES = ('AbstractPlugin', 'BlockingPlugin', 'ExternalProcessPlugin')
-    candidates = {}
-    base_package = importlib.import_module('minion.plugins')
-    prefix = base_package.__name__ + "."
-    for importer, package, ispkg in pkgutil.iter_modules(base_package.__path__, prefix):
-        module = __import__(package, fromlist=['plugins'])
-        for name in dir(module):
-            obj = getattr(module, name)
-            if inspect.isclass(obj) and issubclass(obj, AbstractPlugin) and name not in DEFAULT_BASE_CLASSES:
-                app.logger.info("Found %s" % str(obj))
-                plugin_name = module.__name__ + '.' + obj.__name__
-                candidates[plugin_name] = obj
-
-    for plugin_name, plugin_obj in candidates.iteritems():
-        try:
-            _register_plugin(plugin_name, plugin_obj)
-        except ImportError as e:
-            app.logger.error("Unable to import %s" % plugin_name)
-            pass
-
-def _register_plugin(plugin_name, plugin_class):
-    plugins[plugin_name] = {
-        'clazz': plugin_class,
-        'descriptor': {
-            'class': plugin_name,
-            'name': plugin_class.name(),
-            'version': plugin_class.version(),
-            'weight': plugin_class.weight()
-        }
-    }
+class PluginRegistry(object):
+
+    def __init__(self):
+        self._plugins = None
+
+    def _load(self):
+        if self._plugins is None:
+            self._plugins = plugin_manifest.load_manifest()
+        return self._plugins
+
+    def __getitem__(self, plugin_name):
+        return self._load()[plugin_name]
+
+    def __contains__(self, plugin_name):
+        return plugin_name in self._load()
+
+    def get(self, plugin_name, default=None):
+        return self._load().get(plugin_name, default)
+
+    def values(self):
+        return self._load().values()
+
+plugins = PluginRegistry()
 
 def _check_required_fields(expected, fields):
     if isinstance(fields, dict):
@@ -114,10 +116,17 @@ def sanitize_session(session):
     for field in ('created', 'queued', 'started', 'finished'):
         if session.get(field) is not None:
             session[field] = calendar.timegm(session[field].utctimetuple())
-    if session.get('issues') is not None:
-        for idx, issue_id in enumerate(session['issues']):
-            session['issues'][idx] = issues.find_one({"Id": issue_id})
-            del session['issues'][idx]["_id"]
+    if session.get('progress') and session['progress'].get('updated') is not None:
+        session['progress']['updated'] = calendar.timegm(session['progress']['updated'].utctimetuple())
+    for field in ('version', 'issue_versions'):
+        if field in session:
+            del session[field]
+    if session.get('issues'):
+        # Fetch all issues of the session at once and keep the session order
+        found = {}
+        for issue in issues.find({"Id": {"$in": session['issues']}}, {"_id": 0}):
+            found[issue['Id']] = issue
+        session['issues'] = [found[issue_id] for issue_id in session['issues'] if issue_id in found]
     for artifact in session['artifacts']:
         for idx, path in enumerate(artifact['paths']):
             artifact['paths'][idx] = os.path.basename(path)
@@ -128,4 +137,78 @@ def sanitize_session(session):
 def sanitize_time(t):
     return calendar.timegm(t.utctimetuple())
 
-load_plugin()
+#
+# Streaming JSON responses. Views that return large lists wrap them in a
+# JSONStream and return stream_json(...) instead of jsonify(...):
+#
+#  return stream_json(success=True, users=JSONStream(sanitize_user(u) for u in users.find()))
+#
+# The items are serialized while the cursor is iterated and sent in chunks,
+# so neither the complete list nor the complete JSON document is ever held
+# in memory. The response is gzip compressed when the client accepts it.
+#
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class JSONStream(object):
+    """ A list in a streamed JSON response whose items are produced by an iterable. """
+    def __init__(self, iterable):
+        self.iterable = iterable
+
+def _json_key(key):
+    """ Return a dictionary key as json.dumps writes it. Other keys than strings
+    are converted by json.dumps itself, which also rejects the ones it cannot
+    convert, so that they come out the same as with jsonify. """
+    if isinstance(key, basestring):
+        return json.dumps(key)
+    return json.dumps({key: 0}, separators=(',', ':'))[1:-3]
+
+def _json_chunks(value):
+    if isinstance(value, JSONStream):
+        yield '['
+        for idx, item in enumerate(value.iterable):
+            if idx:
+                yield ','
+            for chunk in _json_chunks(item):
+                yield chunk
+        yield ']'
+    elif isinstance(value, dict):
+        yield '{'
+        for idx, (key, item) in enumerate(value.iteritems()):
+            if idx:
+                yield ','
+            yield _json_key(key) + ':'
+            for chunk in _json_chunks(item):
+                yield chunk
+        yield '}'
+    else:
+        yield json.dumps(value)
+
+def _buffered(chunks, size):
+    buf, length = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buf)
+            buf, length = [], 0
+    if buf:
+        yield ''.join(buf)
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def stream_json(*args, **kwargs):
+    """ Like jsonify, but streams the JSON document. JSONStream values, also
+    nested in dictionaries, are serialized one item at a time. """
+    chunks = _buffered(_json_chunks(dict(*args, **kwargs)), STREAM_CHUNK_SIZE)
+    headers = {'Vary': 'Accept-Encoding'}
+    if 'gzip' in request.accept_encodings:
+        chunks = _gzipped(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, mimetype='application/json', headers=headers)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import calendar
+import json
+import time
+from flask import Response, jsonify, request
+
+from minion.backend.access import get_access
+from minion.backend.app import app
+from minion.backend.utils import EVENTS_VERSION, TERMINAL_SCAN_STATES
+from minion.backend.views.base import api_guard, current_version, events, scans
+from minion.backend.views.scans import permission
+
+# A stream ends before the gunicorn worker timeout (30 seconds by default). Clients
+# reconnect on their own and resume after the last event they received.
+EVENT_STREAM_DURATION = 25
+HEARTBEAT_INTERVAL = 10
+RETRY_INTERVAL = 1000 # milliseconds
+
+def _since():
+    """ Return the sequence number of the last event the client has seen, from the
+    Last-Event-ID header that browsers send when they reconnect or from ?since= """
+    value = request.headers.get('Last-Event-ID') or request.args.get('since')
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return -1
+
+def _format_event(event_id, event_type, data):
+    return "id: %d\nevent: %s\ndata: %s\n\n" % (event_id, event_type, json.dumps(data))
+
+def _format_logged_event(event):
+    data = dict((k, v) for k, v in event.iteritems() if k not in ('_id', 'seq', 'type'))
+    data['time'] = calendar.timegm(event['time'].utctimetuple())
+    return _format_event(event['seq'], event['type'], data)
+
+def _event_stream(query, since, first=None, until_finished=False):
+    """ Tail the event log for events that match query and that come after since. """
+    started = last_sent = time.time()
+    yield "retry: %d\n\n" % RETRY_INTERVAL
+    if first:
+        yield first
+    while time.time() - started < EVENT_STREAM_DURATION:
+        # A tailable cursor dies when the collection is empty or when it falls behind the
+        # start of the capped collection, in which case it is simply opened again.
+        cursor = events.find(dict(query, seq={'$gt': since}), tailable=True, await_data=True)
+        while cursor.alive and time.time() - started < EVENT_STREAM_DURATION:
+            try:
+                event = cursor.next()
+            except StopIteration:
+                if time.time() - last_sent >= HEARTBEAT_INTERVAL:
+                    last_sent = time.time()
+                    yield ": heartbeat\n\n"
+                continue
+            since, last_sent = event['seq'], time.time()
+            yield _format_logged_event(event)
+            if until_finished and event['type'] == 'scan-state' and event['state'] in TERMINAL_SCAN_STATES:
+                return
+        time.sleep(1)
+
+def _event_response(stream):
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# API Methods to follow scans
+
+#
+# Stream the state changes of a scan as server-sent events
+#
+#  GET /scans/<scan_id>/events
+#
+# A new subscription starts with a 'scan' event that holds the current state
+# of the scan and its sessions. After that every change is sent as it happens:
+#
+#  id: 1234
+#  event: session-state
+#  data: {"scan": "...", "session": "...", "state": "STARTED", "time": 1371044067}
+#
+#  id: 1235
+#  event: issue
+#  data: {"scan": "...", "session": "...", "issue": "...", "severity": "High", "time": 1371044068}
+#
+#  id: 1236
+#  event: session-progress
+#  data: {"scan": "...", "session": "...", "percentage": 40, "description": "...", "time": 1371044073}
+#
+# Event types are 'scan-state', 'session-state', 'session-progress' and 'issue'. The stream ends
+# after the scan reached a final state, or after EVENT_STREAM_DURATION seconds.
+# A client resumes with the Last-Event-ID header or with ?since=<id>.
+#
+
+@app.route("/scans/<scan_id>/events", methods=['GET'])
+@api_guard
+@permission
+def get_scan_events(scan_id):
+    since = _since()
+    first = None
+    if since is None:
+        # Remember where the log is before reading the scan, so that no change is lost
+        since = current_version(EVENTS_VERSION)
+        scan = scans.find_one({'id': scan_id}, {'_id': 0, 'state': 1, 'sessions.id': 1,
+                                                'sessions.state': 1, 'sessions.plugin.name': 1})
+        if not scan:
+            return jsonify(success=False, reason='not-found')
+        first = _format_event(since, 'scan', { 'scan': scan_id,
+                                               'state': scan['state'],
+                                               'sessions': [{ 'id': s['id'],
+                                                              'plugin': s['plugin']['name'],
+                                                              'state': s['state'] } for s in scan['sessions']] })
+        if scan['state'] in TERMINAL_SCAN_STATES:
+            return _event_response(iter([first]))
+    elif not scans.find_one({'id': scan_id}, {'_id': 1}):
+        return jsonify(success=False, reason='not-found')
+    return _event_response(_event_stream({'scan': scan_id}, since, first, until_finished=True))
+
+#
+# Stream the state changes of all scans as server-sent events
+#
+#  GET /events
+#
+# Sends the same events as /scans/<scan_id>/events, without the initial
+# 'scan' event. A new subscription only receives new events. Only available
+# to administrators when an email is given.
+#
+
+@app.route("/events", methods=['GET'])
+@api_guard
+def get_events():
+    email = request.args.get('email')
+    if email:
+        user = get_access(email)
+        if not user:
+            return jsonify(success=False, reason='user-does-not-exist')
+        if user['role'] != 'administrator':
+            return jsonify(success=False, reason='not-allowed')
+    since = _since()
+    if since is None:
+        since = current_version(EVENTS_VERSION)
+    return _event_response(_event_stream({}, since))
@@ -6,18 +6,27 @@ import uuid
 from flask import jsonify, request
 
 import minion.backend.utils as backend_utils
-import minion.backend.tasks as tasks
+from minion.backend import membership
+from minion.backend.access import group_users, refresh_access
 from minion.backend.app import app
 from minion.backend.views.base import _check_required_fields, api_guard, groups, users, sites
 
 def _check_group_exists(group_name):
     return groups.find_one({'name': group_name}) is not None
 
-def sanitize_group(group):
+def sanitize_group(group, sitez=None, userz=None):
+    """ Sanitize a group and add its sites and users. The members can be passed in
+    when they were already looked up for many groups at once. """
     if '_id' in group:
         del group['_id']
     if 'created' in group:
         group['created'] = calendar.timegm(group['created'].utctimetuple())
+    if sitez is None:
+        sitez = membership.members(group['name'], membership.SITE)
+    if userz is None:
+        userz = membership.members(group['name'], membership.USER)
+    group['sites'] = sitez
+    group['users'] = userz
     return group
 
 # Retrieve all groups in minion
@@ -36,7 +45,11 @@ def sanitize_group(group):
 @app.route('/groups', methods=['GET'])
 @api_guard
 def list_groups():
-    return jsonify(success=True, groups=[sanitize_group(group) for group in groups.find()])
+    all_sites = membership.members_by_group(membership.SITE)
+    all_users = membership.members_by_group(membership.USER)
+    return jsonify(success=True, groups=[sanitize_group(group, all_sites.get(group['name'], []),
+                                                        all_users.get(group['name'], []))
+                                         for group in groups.find()])
 
 #
 # Expects a partially filled out site as POST data:
@@ -68,16 +81,18 @@ def create_group():
     if not group.get('name'):
         return jsonify(success=False, reason='name-field-is-required')
 
-    userz = group.get('users')
-    sitez = group.get('sites')
+    userz = group.get('users') or []
+    sitez = group.get('sites') or []
 
     if userz:
+        known = set(u['email'] for u in users.find({'email': {'$in': userz}}, {'_id': 0, 'email': 1}))
         for user in userz:
-            if not users.find_one({'email': user}):
+            if user not in known:
                 return jsonify(success=False, reason='user %s does not exist'%user)
     if sitez:
+        known = set(s['url'] for s in sites.find({'url': {'$in': sitez}}, {'_id': 0, 'url': 1}))
         for site in sitez:
-            if not sites.find_one({'url': site}):
+            if site not in known:
                 return jsonify(success=False, reason='site %s does not exist'%site)
 
     if groups.find_one({'name': group['name']}) is not None:
@@ -87,10 +102,11 @@ def create_group():
     new_group = { 'id': str(uuid.uuid4()),
                   'name':  group['name'],
                   'description': group.get('description', ""),
-                  'sites': group.get('sites', []),
-                  'users': group.get('users', []),
                   'created': datetime.datetime.utcnow() }
     groups.insert(new_group)
+    membership.add_members(new_group['name'], membership.SITE, sitez)
+    membership.add_members(new_group['name'], membership.USER, userz)
+    refresh_access(userz)
     return jsonify(success=True, group=sanitize_group(new_group))
 
 @app.route('/groups/<group_name>', methods=['GET'])
@@ -113,7 +129,10 @@ def delete_group(group_name):
     group = groups.find_one({'name': group_name})
     if not group:
         return jsonify(success=False, reason='no-such-group')
+    affected_users = group_users([group_name])
     groups.remove({'name': group_name})
+    membership.remove_group(group_name)
+    refresh_access(affected_users)
     return jsonify(success=True)
 
 #
@@ -135,21 +154,51 @@ def patch_group(group_name):
     group = groups.find_one({'name': group_name})
     if not group:
         return jsonify(success=False, reason='no-such-group')
-    # Process the edits. These can probably be done in one operation.
     patch = request.json
-    for site in patch.get('addSites', []):
-        if isinstance(site, unicode) or isinstance(site, str):
-            groups.update({'name':group_name},{'$push': {'sites': site}})
-    for site in patch.get('removeSites', []):
-        if isinstance(site, unicode) or isinstance(site, str):
-            groups.update({'name':group_name},{'$pull': {'sites': site}})
-    for user in patch.get('addUsers', []):
-        if isinstance(user, unicode) or isinstance(user, str):
-            groups.update({'name':group_name},{'$push': {'users': user}})
-    for user in patch.get('removeUsers', []):
-        if isinstance(user, unicode) or isinstance(user, str):
-            groups.update({'name':group_name},{'$pull': {'users': user}})
+    # Site changes affect every member, user changes the users added or removed
+    affected_users = group_users([group_name])
+    membership.apply_patch(group_name, patch)
+    refresh_access(affected_users | group_users([group_name]))
     # Return the modified group
-    group = groups.find_one({'name': group_name})
     return jsonify(success=True, group=sanitize_group(group))
 
+#
+# Patch the membership of many groups at once
+#
+#  PATCH /groups/membership
+#
+# Expects a JSON structure that maps group names to the same patch
+# operations as PATCH /groups/:groupName:
+#
+#  { "groups": { "mozilla": { "addSites": ["http://foo.com"],
+#                             "removeUsers": ["bar@bacon"] },
+#                "mozilla-qa": { "addUsers": ["foo@cheese"] } } }
+#
+# Returns the number of changes that were made to every group:
+#
+#  { "success": True,
+#    "groups": { "mozilla": { "addSites": 1, "removeSites": 0,
+#                             "addUsers": 0, "removeUsers": 1 },
+#                "mozilla-qa": { ... } } }
+#
+# Or returns an error without changing anything if one of the groups is unknown:
+#
+#  { 'success': False, 'reason': 'no-such-group' }
+#
+
+@app.route('/groups/membership', methods=['PATCH'])
+@api_guard('application/json')
+def patch_groups_membership():
+    patches = request.json.get('groups')
+    if not isinstance(patches, dict):
+        return jsonify(success=False, reason='groups-field-is-required')
+    group_names = patches.keys()
+    if groups.find({'name': {'$in': group_names}}).count() != len(group_names):
+        return jsonify(success=False, reason='no-such-group')
+    affected_users = group_users(group_names)
+    results = {}
+    for group_name, patch in patches.iteritems():
+        results[group_name] = membership.apply_patch(group_name, patch)
+    refresh_access(affected_users | group_users(group_names))
+    return jsonify(success=True, groups=results)
+
@@ -7,7 +7,6 @@ import smtplib
 from flask import jsonify, request
 
 import minion.backend.utils as backend_utils
-import minion.backend.tasks as tasks
 from minion.backend.app import app
 from minion.backend.views.base import api_guard, backend_config, invites, users, groups, sites
 from minion.backend.views.users import _find_groups_for_user, _find_sites_for_user, update_group_association, remove_group_association
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
 from flask import jsonify, request
-from minion.backend.views.base import api_guard, groups, scans, issues, sanitize_time
+from minion.backend import membership
+from minion.backend.views.base import api_guard, bump_version, groups, scans, issues, sanitize_time
 from minion.backend.app import app
+from minion.backend.utils import ISSUES_VERSION
 from minion.backend.views.scans import permission
 
 #
@@ -45,7 +47,7 @@ def get_issues():
 
     group = groups.find_one({'name': request.args.get('group_name')})
     if group is not None:
-        for target in group['sites']:
+        for target in membership.members(group['name'], membership.SITE):
             scan = scans.find_one({"plan.name": request.args.get('plan_name'),
                                    "configuration.target": target,
                                    "state": "FINISHED",
@@ -90,34 +92,6 @@ def tag_issue():
     if issue is None:
         return jsonify(success=False, reason="no-such-issue")
 
+    bump_version(ISSUES_VERSION)
     return jsonify(success=True)
 
-
-# Find issues of scan
-# param scan_id : string id of the scan
-# returns : array containing id of issues from the scan
-def find_issues(scan_id):
-    return scans.find({"id": scan_id}).distinct("sessions.issues")
-
-
-# Delete issues only existing in scan (no other dependencies)
-# param scan_id : string id of the scan
-def delete_issues(scan_id):
-    # Get issues from the scan
-    scan_issues = find_issues(scan_id)
-
-    # Browse each issue
-    to_delete = []
-    for issue in scan_issues:
-        # Find others scan for this issue
-        res = scans.find({"sessions.issues": issue, "id": {"$ne": scan_id}}, {"id": 1, "_id": 0})
-
-        # Add issue to delete list if no other scan is linked
-        if res.count() == 0:
-            to_delete.append(issue)
-
-    # Delete issues
-    for delete in to_delete:
-        issues.remove({"Id": delete})
-
-    return to_delete
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import calendar
+import datetime
+import uuid
+from flask import jsonify
+
+from minion.backend import resources
+from minion.backend.app import app
+from minion.backend.views.base import api_guard, jobs
+
+
+def sanitize_job(job):
+    if '_id' in job:
+        del job['_id']
+    for field in ('created', 'started', 'finished'):
+        if job.get(field) is not None:
+            job[field] = calendar.timegm(job[field].utctimetuple())
+    return job
+
+
+def create_delete_job(job_type, resource, query):
+    """ Queue a background job that removes all scans matching query,
+    together with the issues that only those scans refer to. """
+    job = { 'id': str(uuid.uuid4()),
+            'type': job_type,
+            'resource': resource,
+            'state': 'QUEUED',
+            'created': datetime.datetime.utcnow(),
+            'started': None,
+            'finished': None,
+            'progress': { 'total': None, 'scans': 0, 'issues': 0 },
+            'failure': None }
+    jobs.insert(job)
+    resources.send_task("minion.backend.tasks.delete_scans", [job['id'], query], queue='delete')
+    return job
+
+# API Methods to follow background jobs
+
+#
+# Return the state and progress of a background job
+#
+#  GET /jobs/<job_id>
+#
+# Returns the job record:
+#
+#  { 'success': True,
+#    'job': { 'id': 'b263bdc6-8692-4ace-aa8b-922b9ec0fc37',
+#             'type': 'remove-plan',
+#             'resource': { 'plan': 'basic' },
+#             'state': 'STARTED',
+#             'created': 1371044067,
+#             'started': 1371044068,
+#             'finished': None,
+#             'progress': { 'total': 1200, 'scans': 500, 'issues': 3411 },
+#             'failure': None } }
+#
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@api_guard
+def get_job(job_id):
+    job = jobs.find_one({'id': job_id})
+    if not job:
+        return jsonify(success=False, reason='no-such-job')
+    return jsonify(success=True, job=sanitize_job(job))
@@ -3,15 +3,24 @@
 import calendar
 import datetime
 import functools
-import importlib
 import uuid
 
 from flask import jsonify, request
 
 import minion.backend.utils as backend_utils
-import minion.backend.tasks as tasks
+from minion.backend.access import ACCESS_VERSION, get_access, refresh_access, site_users
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, plans, plugins, users, sites, groups
+from minion.backend.views.base import (api_guard, bump_version, current_version, not_modified, plans, plugins, sites,
+                                       with_etag)
+from minion.backend.views.jobs import create_delete_job, sanitize_job
+
+# Bumped on every change to a plan. Plans are small and rarely change, so one
+# counter for all plans is enough for the ETags of /plans and /plans/<plan_name>.
+PLANS_VERSION = 'plans'
+
+def _plans_etag():
+    # The plans a user can see depend on the access index
+    return "plans-%d-%d" % (current_version(PLANS_VERSION), current_version(ACCESS_VERSION))
 
 
 def _plan_description(plan):
@@ -31,23 +40,15 @@ def get_sanitized_plans():
 
 
 def _check_plan_by_email(email, plan_name):
-    plan = plans.find_one({'name': plan_name})
-    if not plan:
-        return False
-    sitez = sites.find({'plans': plan_name})
-    if sitez.count():
-        matches = 0
-        for site in sitez:
-            groupz = groups.find({'users': email, 'sites': site['url']})
-            if groupz.count():
-                matches += 1
-        return matches
+    user = get_access(email)
+    return user is not None and plan_name in user['plans']
 
 
 def get_plans_by_email(email):
-    plans = get_sanitized_plans()
-    matched_plans = [plan for plan in plans if _check_plan_by_email(email, plan["name"])]
-    return matched_plans
+    user = get_access(email)
+    if not user or not user['plans']:
+        return []
+    return [sanitize_plan(_plan_description(plan)) for plan in plans.find({'name': {'$in': list(user['plans'])}})]
 
 
 def permission(view):
@@ -55,14 +56,14 @@ def permission(view):
     def has_permission(*args, **kwargs):
         email = request.args.get('email')
         if email:
-            user = users.find_one({'email': email})
+            user = get_access(email)
             if not user:
                 return jsonify(success=False, reason='User does not exist.')
             if user['role'] == 'user':
                 plan_name = request.view_args['plan_name']
-                if not _check_plan_by_email(email, plan_name):
+                if plan_name not in user['plans']:
                     return jsonify(success=False, reason="Plan does not exist.")
-        return view(*args, **kwargs) # if groupz.count is not zero, or user is admin
+        return view(*args, **kwargs) # if the user can see the plan, or user is admin
     return has_permission
 
 
@@ -75,17 +76,6 @@ def sanitize_plan(plan):
     return plan
 
 
-def _split_plugin_class_name(plugin_class_name):
-    e = plugin_class_name.split(".")
-    return '.'.join(e[:-1]), e[-1]
-
-
-def _import_plugin(plugin_class_name):
-    package_name, class_name = _split_plugin_class_name(plugin_class_name)
-    plugin_module = importlib.import_module(package_name, class_name)
-    return getattr(plugin_module, class_name)
-
-
 def _check_plan_workflow(workflow):
     """ Ensure plan workflow contain valid structure. """
     if not all(isinstance(plugin, dict) for plugin in workflow):
@@ -100,9 +90,7 @@ def _check_plan_workflow(workflow):
             return False
         if not isinstance(plugin['configuration'], dict):
             return False
-        try:
-            _import_plugin(plugin['plugin_name'])
-        except (AttributeError, ImportError):
+        if plugin['plugin_name'] not in plugins:
             return False
     return True
 
@@ -129,6 +117,13 @@ def _check_plan_exists(plan_name):
 @app.route("/plans", methods=['GET'])
 @api_guard
 def get_plans():
+    etag = _plans_etag()
+    response = not_modified(etag)
+    if response:
+        return response
+    return with_etag(_get_plans(), etag)
+
+def _get_plans():
     name = request.args.get('name')
     if name:
         plan = get_plan_by_plan_name(name)
@@ -160,11 +155,12 @@ def delete_plan(plan_name):
         return jsonify(success=False, reason="Plan does not exist.")
     # Remove the plan
     plans.remove({'name': plan_name})
+    bump_version(PLANS_VERSION)
 
     # Delete cascade mentions of plan
-    remove_plan(plan_name)
+    job = remove_plan(plan_name)
 
-    return jsonify(success=True)
+    return jsonify(success=True, job=sanitize_job(job))
 
 
 
@@ -190,6 +186,7 @@ def create_plan():
                  'workflow': plan['workflow'],
                  'created': datetime.datetime.utcnow() }
     plans.insert(new_plan)
+    bump_version(PLANS_VERSION)
 
     # Return the new plan
     plan = plans.find_one({"name": plan['name']})
@@ -218,6 +215,7 @@ def update_plan(plan_name):
     if 'workflow' in new_plan:
         changes['workflow'] = new_plan['workflow']
     plans.update({'name': plan_name}, {'$set': changes})
+    bump_version(PLANS_VERSION)
     # Return the plan
     plan = plans.find_one({"name": plan_name})
     return jsonify(success=True, plan=sanitize_plan(plan))
@@ -245,12 +243,16 @@ def update_plan(plan_name):
 @api_guard
 @permission
 def get_plan(plan_name):
+    etag = _plans_etag()
+    response = not_modified(etag)
+    if response:
+        return response
     plan = get_plan_by_plan_name(plan_name)
     if plan:
         # Fill in the details of the plugin
         for step in plan['workflow']:
             plugin = plugins.get(step['plugin_name'])
-        return jsonify(success=True, plan=sanitize_plan(plan))
+        return with_etag(jsonify(success=True, plan=sanitize_plan(plan)), etag)
     else:
         return jsonify(success=False, reason="Plan does not exist")
 
@@ -258,23 +260,12 @@ def get_plan(plan_name):
 # Delete every trace of existing plan
 # Warning no coming back, this removes permanently the plan and results from the data-base
 # param : name of the plan
+# return : the background job that removes the scans and issues of the plan
 def remove_plan(plan):
-    from minion.backend.views.scans import get_scans_ids, remove_similar_scan
-
-    # Get id of scan containing this plan
-    to_delete = get_scans_ids(plan)
-
-    # Delete every instance of each scan
-    for line in to_delete:
-        remove_similar_scan(line)
-
-    # Get id of every site containing the plan
-    res = list(sites.find({'plans': plan}, {"id": 1, "_id": 0, "plans": 1}))
-
-    for site in res:
-        # Remove old plan from their list
-        site_plans = site["plans"]
-        site_plans.remove(plan)
+    # Remove old plan from the sites
+    urls = [site['url'] for site in sites.find({'plans': plan}, {'_id': 0, 'url': 1})]
+    sites.update({'plans': plan}, {'$pull': {'plans': plan}}, multi=True)
+    refresh_access(site_users(urls))
 
-        # Update the record of the site
-        sites.update({"id": site["id"]}, {"$set": {"plans": site_plans}})
+    # Delete every scan of the plan in the background
+    return create_delete_job('remove-plan', {'plan': plan}, {'plan.name': plan})
@@ -1,8 +1,21 @@
 #!/usr/bin/env python
+import hashlib
+import json
 from flask import jsonify
 
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, plugins
+from minion.backend.views.base import api_guard, not_modified, plugins, with_etag
+
+
+# The plugin registry does not change while the API runs, so its ETag is
+# computed once from the plugin descriptors.
+_etag = {}
+
+def _plugins_etag():
+    if 'value' not in _etag:
+        descriptors = sorted(json.dumps(plugin['descriptor'], sort_keys=True) for plugin in plugins.values())
+        _etag['value'] = "plugins-" + hashlib.sha1("\n".join(descriptors)).hexdigest()
+    return _etag['value']
 
 
 # API Methods to manage plugins
@@ -16,5 +29,9 @@ from minion.backend.views.base import api_guard, plugins
 @app.route("/plugins")
 @api_guard
 def get_plugins():
-    return jsonify(success=True, plugins=[plugin['descriptor'] for plugin in plugins.values()])
+    etag = _plugins_etag()
+    response = not_modified(etag)
+    if response:
+        return response
+    return with_etag(jsonify(success=True, plugins=[plugin['descriptor'] for plugin in plugins.values()]), etag)
 
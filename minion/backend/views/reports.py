@@ -8,9 +8,8 @@ import uuid
 from flask import jsonify, request
 
 import minion.backend.utils as backend_utils
-import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, scans, sites, users, issues
+from minion.backend.views.base import api_guard, scans, sites, users, issues, stream_json, JSONStream
 from minion.backend.views.users import _find_sites_for_user, _find_sites_for_user_by_group_name
 from minion.backend.views.scans import sanitize_scan, summarize_scan
 
@@ -26,18 +25,15 @@ from minion.backend.views.scans import sanitize_scan, summarize_scan
 @app.route('/reports/history', methods=['GET'])
 @api_guard
 def get_reports_history():
-    history = []
+    query = {}
     user_email = request.args.get('user')
     if user_email is not None:
         user = users.find_one({'email': user_email})
         if user is None:
             return jsonify(success=False, reason='no-such-user')
-        for s in scans.find({'configuration.target': {'$in': _find_sites_for_user(user_email)}}).sort("created", -1).limit(100):
-            history.append(summarize_scan(sanitize_scan(s)))
-    else:
-        for s in scans.find({}).sort("created", -1).limit(100):
-            history.append(summarize_scan(sanitize_scan(s)))
-    return jsonify(success=True, report=history)
+        query = {'configuration.target': {'$in': _find_sites_for_user(user_email)}}
+    history = scans.find(query).sort("created", -1).limit(100)
+    return stream_json(success=True, report=JSONStream(summarize_scan(sanitize_scan(s)) for s in history))
 
 #
 # Returns a status report that lists each site and attached plans
@@ -3,37 +3,101 @@
 import calendar
 import datetime
 import functools
+import mimetypes
+import re
 import uuid
-from flask import jsonify, request, send_file
+from flask import Response, jsonify, request, send_file
 
 import minion.backend.utils as backend_utils
-import minion.backend.tasks as tasks
+from minion.backend import artifacts, membership, resources
+from minion.backend.access import get_access
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, groups, plans, plugins, scans, sanitize_session, users, sites
+from minion.backend.utils import ISSUES_VERSION
+from minion.backend.views.base import (api_guard, backend_config, current_version, groups, not_modified, plans,
+                                       plugins, scans, sanitize_session, sites, stream_json, with_etag, JSONStream)
 from minion.backend.views.plans import sanitize_plan
 
+# Seconds over which the scans of a batch are started, unless the request
+# or the scan section of the backend config says otherwise
+DEFAULT_DISPATCH_WINDOW = 60
+
+# The target of a scan never changes, so it is safe to remember it
+_scan_targets = {}
+_SCAN_TARGETS_MAX = 10000
+
+def _scan_target(scan_id):
+    if scan_id not in _scan_targets:
+        scan = scans.find_one({"id": scan_id}, {"_id": 0, "configuration.target": 1})
+        if not scan:
+            return None
+        if len(_scan_targets) >= _SCAN_TARGETS_MAX:
+            _scan_targets.clear()
+        _scan_targets[scan_id] = scan['configuration']['target']
+    return _scan_targets[scan_id]
 
 def permission(view):
     @functools.wraps(view)
     def has_permission(*args, **kwargs):
         email = request.args.get('email')
         if email:
-            user = users.find_one({'email': email})
+            user = get_access(email)
             if not user:
                 return jsonify(success=False, reason='user-does-not-exist')
-            scan = scans.find_one({"id": kwargs['scan_id']})
-            if user['role'] == 'user':
-                groupz = groups.find({'users': email, 'sites': scan['configuration']['target']})
-                if not groupz.count():
+            if user['role'] == 'user' and 'scan_id' in kwargs:
+                if _scan_target(kwargs['scan_id']) not in user['sites']:
                     return jsonify(success=False, reason='not-found')
-        return view(*args, **kwargs) # if groupz.count is not zero, or user is admin
+        return view(*args, **kwargs) # if the user can see the target, or user is admin
     return has_permission
 
+def _scan_etag(scan_id):
+    """ Return the ETag of the current version of a scan, or None if the scan
+    does not exist. Only the version field of the scan is read. """
+    scan = scans.find_one({"id": scan_id}, {"_id": 0, "version": 1})
+    if not scan:
+        return None
+    return "scan-%s-%d-%d" % (scan_id, scan.get('version', 0), current_version(ISSUES_VERSION))
+
+def _scan_changes(scan_id, since):
+    """ Return the current version of a scan and the parts of the scan that changed
+    after the given version: the state and times of the scan, and only the sessions
+    that changed with the ids of the issues that were added to them. """
+    fields = dict((field, 1) for field in ('id', 'state', 'version', 'created', 'queued', 'started',
+                                           'finished', 'failure', 'sessions.id', 'sessions.state',
+                                           'sessions.queued', 'sessions.started', 'sessions.finished',
+                                           'sessions.failure', 'sessions.progress', 'sessions.artifacts',
+                                           'sessions.version', 'sessions.issues', 'sessions.issue_versions'))
+    fields['_id'] = 0
+    scan = scans.find_one({"id": scan_id}, fields)
+    if not scan:
+        return None, None
+    sessions = []
+    for session in scan.pop('sessions', []):
+        if session.get('version', 0) <= since:
+            continue
+        # The issue versions are appended together with the issues, so both lists
+        # line up from the end. Issues from before versions existed have none.
+        issue_ids = session.pop('issues', [])
+        issue_versions = session.pop('issue_versions', [])
+        added = []
+        for issue_id, version in zip(reversed(issue_ids), reversed(issue_versions)):
+            if version <= since:
+                break
+            added.append(issue_id)
+        session = sanitize_session(session)
+        session['issues'] = list(reversed(added))
+        sessions.append(session)
+    version = scan.get('version', 0)
+    scan = sanitize_scan(scan)
+    scan['sessions'] = sessions
+    return version, scan
+
 def sanitize_scan(scan):
     if scan.get('plan'):
         sanitize_plan(scan['plan'])
     if scan.get('_id'):
         del scan['_id']
+    if 'version' in scan:
+        del scan['version']
     for field in ('created', 'queued', 'started', 'finished'):
         if scan.get(field) is not None:
             scan[field] = calendar.timegm(scan[field].utctimetuple())
@@ -68,37 +132,117 @@ def summarize_scan(scan):
     for session in scan['sessions']:
         summary['sessions'].append({ 'plugin': session['plugin'],
                                      'id': session['id'],
-                                     'state': session['state'] })
+                                     'state': session['state'],
+                                     'progress': session.get('progress') })
     return summary
 
+def _build_scan(plan, configuration, user, now):
+    """ Build a new scan document for the plan and configuration. """
+    scan = { "id": str(uuid.uuid4()),
+             "state": "CREATED",
+             "created": now,
+             "queued": None,
+             "started": None,
+             "finished": None,
+             "plan": { "name": plan['name'], "revision": 0 },
+             "configuration": configuration,
+             "sessions": [],
+             "meta": { "user": user, "tags": [] } }
+    for step in plan['workflow']:
+        session_configuration = dict(step['configuration'])
+        session_configuration.update(configuration)
+        session = { "id": str(uuid.uuid4()),
+                    "state": "CREATED",
+                    "plugin": plugins[step['plugin_name']]['descriptor'],
+                    "configuration": session_configuration, # TODO Do recursive merging here, not just at the top level
+                    "description": step["description"],
+                    "artifacts": [],
+                    "issues": [],
+                    "created": now,
+                    "queued": None,
+                    "started": None,
+                    "finished": None,
+                    "progress": None }
+        scan['sessions'].append(session)
+    return scan
+
 # API Methods to manage scans
 
 #
-# Return a scan. Returns the full scan including all issues.
+# Return a scan. Returns the full scan including all issues. The issues
+# are looked up and streamed one session at a time.
+# The response includes the version of the scan. A client that already has
+# the scan can ask for only what changed after that version:
+#
+#  GET /scans/<scan_id>?since=57
+#
+# This returns the state and times of the scan, and only the sessions that
+# changed. Their issues are the ids of the issues added after the version:
+#
+#  { "success": True, "version": 61, "since": 57,
+#    "scan": { "id": "...", "state": "STARTED", "created": ..., "queued": ...,
+#              "started": ..., "finished": None,
+#              "sessions": [ { "id": "...", "state": "FINISHED", "queued": ...,
+#                              "started": ..., "finished": ..., "progress": None,
+#                              "artifacts": [...], "issues": ["...", "..."] } ] } }
+#
+# The response has an ETag. When the If-None-Match header of the request
+# matches the current version of the scan, a 304 is returned without
+# loading the scan or its issues.
 #
 
 @app.route("/scans/<scan_id>")
 @api_guard
 @permission
 def get_scan(scan_id):
+    etag = _scan_etag(scan_id)
+    if etag is None:
+        return jsonify(success=False, reason='not-found')
+    response = not_modified(etag)
+    if response:
+        return response
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify(success=False, reason='invalid-since')
+        version, scan = _scan_changes(scan_id, since)
+        if not scan:
+            return jsonify(success=False, reason='not-found')
+        return with_etag(jsonify(success=True, version=version, since=since, scan=scan), etag)
     scan = scans.find_one({"id": scan_id})
     if not scan:
         return jsonify(success=False, reason='not-found')
-    return jsonify(success=True, scan=sanitize_scan(scan))
+    version = scan.get('version', 0)
+    sessions = scan.pop('sessions', [])
+    scan = sanitize_scan(scan)
+    scan['sessions'] = JSONStream(sanitize_session(session) for session in sessions)
+    return with_etag(stream_json(success=True, version=version, scan=scan), etag)
 
 #
 # Return a scan summary. Returns just the basic info about a scan
 # and no issues. Also includes a summary of found issues. (count)
+# Every session includes the last progress its plugin reported, as
+# { "percentage": 40, "description": "...", "updated": 1371044073 },
+# or None when it did not report any.
+# Supports conditional requests like GET /scans/<scan_id>.
 #
 
 @app.route("/scans/<scan_id>/summary")
 @api_guard
 @permission
 def get_scan_summary(scan_id):
+    etag = _scan_etag(scan_id)
+    if etag is None:
+        return jsonify(success=False, reason='not-found')
+    response = not_modified(etag)
+    if response:
+        return response
     scan = scans.find_one({"id": scan_id})
     if not scan:
         return jsonify(success=False, reason='not-found')
-    return jsonify(success=True, summary=summarize_scan(sanitize_scan(scan)))
+    return with_etag(jsonify(success=True, summary=summarize_scan(sanitize_scan(scan))), etag)
 
 #
 # Create a scan by POSTING a configuration to the /scan
@@ -126,40 +270,107 @@ def post_scan_create():
     # Get additional tags for target
     res = sites.find_one({'url': configuration['configuration']['target']}, {"_id": 0, "tags": 1})
 
-    if res:
+    if res and 'tags' in res:
         configuration['configuration']['tags'] = res["tags"]
 
     # Merge the configuration
     # Create a scan object
-    now = datetime.datetime.utcnow()
-    scan = { "id": str(uuid.uuid4()),
-             "state": "CREATED",
-             "created": now,
-             "queued": None,
-             "started": None,
-             "finished": None,
-             "plan": { "name": plan['name'], "revision": 0 },
-             "configuration": configuration['configuration'],
-             "sessions": [],
-             "meta": { "user": configuration['user'], "tags": [] } }
-    for step in plan['workflow']:
-        session_configuration = step['configuration']
-        session_configuration.update(configuration['configuration'])
-        session = { "id": str(uuid.uuid4()),
-                    "state": "CREATED",
-                    "plugin": plugins[step['plugin_name']]['descriptor'],
-                    "configuration": session_configuration, # TODO Do recursive merging here, not just at the top level
-                    "description": step["description"],
-                    "artifacts": [],
-                    "issues": [],
-                    "created": now,
-                    "queued": None,
-                    "started": None,
-                    "finished": None,
-                    "progress": None }
-        scan['sessions'].append(session)
+    scan = _build_scan(plan, configuration['configuration'], configuration['user'], datetime.datetime.utcnow())
     scans.insert(scan)
-    return jsonify(success=True, scan=sanitize_scan(scan))
+    return jsonify(success=True, version=0, scan=sanitize_scan(scan))
+
+#
+# Create, and optionally start, one scan per site of a group or of a list
+# of sites:
+#
+#   POST /scans/batch
+#
+#   {
+#      "plan": "basic",
+#      "user": "someone@mozilla.com",
+#      "group": "mozilla",                    # or "sites": ["http://foo", ...]
+#      "configuration": { ... },              # optional, merged into every scan
+#      "start": true,                         # optional, default false
+#      "window": 300                          # optional, seconds
+#   }
+#
+# All scans are inserted at once. Started scans are queued together and
+# their dispatch is spread evenly over the window, so that the plugin
+# queues and the target networks do not get all scans at the same time.
+# The window defaults to the 'dispatch_window' of the 'scan' section of
+# the backend config, or 60 seconds.
+#
+# Returns the summaries of the new scans:
+#
+#   { "success": True, "scans": [ { "id": "...", "state": "QUEUED", ... }, ... ] }
+#
+# Or returns an error:
+#
+#   { "success": False, "reason": "no-such-plan" }
+#   { "success": False, "reason": "invalid-window" }
+#   { "success": False, "reason": "invalid-configuration" }
+#   { "success": False, "reason": "invalid-sites" }
+#   { "success": False, "reason": "no-such-group" }
+#   { "success": False, "reason": "no-sites" }
+#
+
+@app.route("/scans/batch", methods=["POST"])
+@api_guard('application/json')
+@permission
+def post_scan_batch():
+    batch = request.json
+    plan = plans.find_one({"name": batch.get('plan')})
+    if not plan:
+        return jsonify(success=False, reason='no-such-plan')
+
+    window = batch.get('window')
+    if window is None:
+        window = backend_config.get('scan', {}).get('dispatch_window', DEFAULT_DISPATCH_WINDOW)
+    if not isinstance(window, (int, long, float)) or window < 0:
+        return jsonify(success=False, reason='invalid-window')
+
+    if not isinstance(batch.get('configuration') or {}, dict):
+        return jsonify(success=False, reason='invalid-configuration')
+
+    if batch.get('group'):
+        if not groups.find_one({'name': batch['group']}):
+            return jsonify(success=False, reason='no-such-group')
+        targets = membership.members(batch['group'], membership.SITE)
+    else:
+        targets = batch.get('sites') or []
+        if not isinstance(targets, list) or not all(isinstance(t, basestring) for t in targets):
+            return jsonify(success=False, reason='invalid-sites')
+    # Keep the order of the targets but scan every target only once
+    seen = set()
+    targets = [t for t in targets if not (t in seen or seen.add(t))]
+    if not targets:
+        return jsonify(success=False, reason='no-sites')
+
+    # Get additional tags for all targets at once
+    tags = {}
+    for site in sites.find({'url': {'$in': targets}}, {"_id": 0, "url": 1, "tags": 1}):
+        if 'tags' in site:
+            tags[site['url']] = site['tags']
+
+    now = datetime.datetime.utcnow()
+    scanz = []
+    for target in targets:
+        configuration = dict(batch.get('configuration') or {}, target=target)
+        if target in tags:
+            configuration['tags'] = tags[target]
+        scanz.append(_build_scan(plan, configuration, batch.get('user'), now))
+    scans.insert(scanz)
+
+    if batch.get('start'):
+        scan_ids = [scan['id'] for scan in scanz]
+        scans.update({"id": {"$in": scan_ids}}, {"$set": {"state": "QUEUED", "queued": now}, "$inc": {"version": 1}},
+                     multi=True)
+        for i, scan in enumerate(scanz):
+            scan['state'], scan['queued'] = "QUEUED", now
+            countdown = 3 + float(window) * i / len(scanz)
+            resources.send_task("minion.backend.tasks.scan", [scan['id']], countdown=countdown, queue='scan')
+
+    return jsonify(success=True, scans=[summarize_scan(sanitize_scan(scan)) for scan in scanz])
 
 @app.route("/scans", methods=["GET"])
 @permission
@@ -190,18 +401,69 @@ def put_scan_control(scan_id):
         if scan['state'] != 'CREATED':
             return jsonify(success=False, error='invalid-state-transition')
         # Queue the scan to start
-        scans.update({"id": scan_id}, {"$set": {"state": "QUEUED", "queued": datetime.datetime.utcnow()}})
-        tasks.scan.apply_async([scan['id']], countdown=3, queue='scan')
+        scans.update({"id": scan_id}, {"$set": {"state": "QUEUED", "queued": datetime.datetime.utcnow()},
+                                       "$inc": {"version": 1}})
+        resources.send_task("minion.backend.tasks.scan", [scan['id']], countdown=3, queue='scan')
     # Handle stop
     if state == 'STOP':
-        scans.update({"id": scan_id}, {"$set": {"state": "STOPPING", "queued": datetime.datetime.utcnow()}})
-        tasks.scan_stop.apply_async([scan['id']], queue='state')
+        scans.update({"id": scan_id}, {"$set": {"state": "STOPPING", "queued": datetime.datetime.utcnow()},
+                                       "$inc": {"version": 1}})
+        resources.send_task("minion.backend.tasks.scan_stop", [scan['id']], queue='state')
     return jsonify(success=True)
 
 
+def _parse_range(header, length):
+    """ Parse a single byte range (bytes=0-499, bytes=500- or bytes=-500) into the
+    inclusive (start, end) offsets it asks for. Returns None when there is no
+    usable range, and False when the range cannot be satisfied. """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        start, end = max(0, length - int(last)), length - 1
+    else:
+        start, end = int(first), min(int(last), length - 1) if last else length - 1
+    if start > end or start >= length:
+        return False
+    return start, end
+
+#
+# Download an artifact of a scan:
+#
+#  GET /scans/<scan_id>/artifact/<artifact_name>
+#
+# The artifact is streamed from the artifact store, so any API node can serve
+# it. A single byte range can be asked for with the Range header, which is
+# answered with 206 Partial Content. The ETag is the sha256 of the content.
+# Artifacts of scans from before the store existed are sent from the local
+# path the plugin reported.
+#
+
 @app.route("/scans/<scan_id>/artifact/<artifact_name>", methods=["GET"])
 @permission
 def get_artifact(scan_id, artifact_name):
+    entry = artifacts.find_artifact(scan_id, artifact_name)
+    if entry:
+        blob = artifacts.find_blob(entry['sha256'])
+        if not blob:
+            return jsonify(success=False, error='no-such-artifact')
+        response = not_modified(blob['_id'])
+        if response:
+            return response
+        length = blob['length']
+        byte_range = _parse_range(request.headers.get('Range'), length)
+        if byte_range is False:
+            return Response(status=416, headers={'Content-Range': 'bytes */%d' % length})
+        start, end = byte_range or (0, length - 1)
+        mimetype = mimetypes.guess_type(artifact_name)[0] or 'application/octet-stream'
+        response = Response(artifacts.read_blob(blob, start, end), mimetype=mimetype,
+                            status=206 if byte_range else 200, direct_passthrough=True)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Content-Length'] = str(end - start + 1)
+        if byte_range:
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, length)
+        return with_etag(response, blob['_id'])
     # Find the scan
     scan = scans.find_one({"id": scan_id})
     if not scan:
@@ -214,53 +476,3 @@ def get_artifact(scan_id, artifact_name):
                     return send_file(path)
     return jsonify(success=False, error='no-such-artifact')
 
-
-# Delete every issues and scan with the same target and plan
-# param scan_id : id of the scan to delete
-def remove_similar_scan(scan_id):
-    # Obtain information about the scan and its target
-    scan = scans.find_one({"id": scan_id})
-
-    # Check the scan exists
-    if scan is None:
-        print "No entry found"
-        return
-
-    # Get every scan with the same configuration and target
-    list_scan = list(
-        scans.find({'configuration.target': scan['configuration']['target'], 'plan.name': scan['plan']['name']}).sort(
-            "created", -1))
-
-    # Get the ID of every scan with the same configuration
-    for prev_scan in list_scan:
-        # Delete the scan
-        delete_scan(prev_scan["id"])
-
-
-# Get every existing scan for a given plan
-# param plan : string containing name of the plan
-# return : array of scan id
-def get_scans_ids(plan):
-    # Get every scan with this plan
-    res = list(scans.find({'plan.name': plan}, {"id": 1, "_id": 0}))
-
-    # Format result
-    ids = []
-    for myid in res:
-        ids.append(myid["id"])
-
-    return ids
-
-
-# Delete every issue only linked to the scan, then delete the scan
-# param : scan_id to delete
-def delete_scan(scan_id):
-    from minion.backend.views.issues import delete_issues
-
-    # Remove the issues
-    removed = delete_issues(scan_id)
-
-    # Remove the scan
-    scans.remove({"id": scan_id})
-
-    return "removed " + str(len(removed)) + " issues and scan " + scan_id
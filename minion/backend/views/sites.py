@@ -6,10 +6,13 @@ import re
 import uuid
 from flask import jsonify, request
 
+from minion.backend import membership
+from minion.backend.access import group_users, refresh_access, site_users
 from minion.backend.app import app
-from minion.backend.views.base import _check_required_fields, api_guard, groups, sites, scans
-from minion.backend.views.scans import remove_similar_scan
+from minion.backend.views.base import (_check_required_fields, api_guard, groups, plans, sites, scans,
+                                       stream_json, JSONStream)
 from minion.backend.views.groups import _check_group_exists
+from minion.backend.views.jobs import create_delete_job, sanitize_job
 from minion.backend.views.plans import _check_plan_exists
 
 def _check_site_url(url):
@@ -26,7 +29,24 @@ def _check_site_url(url):
 
 def _find_groups_for_site(site):
     """Find all the groups the site is part of"""
-    return [g['name'] for g in groups.find({"sites":site})]
+    return membership.groups_of(membership.SITE, site)
+
+def _find_groups_for_sites():
+    """Map every site to the groups it is part of, with a single query"""
+    return membership.groups_of_members(membership.SITE)
+
+def _new_site(site):
+    """ Build the site record for a validated incoming site. """
+    new_site = { 'id': str(uuid.uuid4()),
+                 'url':  site['url'],
+                 'plans': site.get('plans', []),
+                 'created': datetime.datetime.utcnow()}
+
+    if site.get('verification',{}).get('enabled',False):
+        new_site['verification'] = {'enabled': True, 'value': str(uuid.uuid4())}
+    else:
+        new_site['verification'] = {'enabled': False, 'value': None}
+    return new_site
 
 def sanitize_site(site):
     if '_id' in site:
@@ -107,25 +127,111 @@ def create_site():
     if sites.find_one({'url': site['url']}) is not None:
         return jsonify(success=False, reason='site-already-exists')
     # Create the site
-    new_site = { 'id': str(uuid.uuid4()),
-                 'url':  site['url'],
-                 'plans': site.get('plans', []),
-                 'created': datetime.datetime.utcnow()}
-
-    if site.get('verification',{}).get('enabled',False):
-        new_site['verification'] = {'enabled': True, 'value': str(uuid.uuid4())}
-    else:
-        new_site['verification'] = {'enabled': False, 'value': None}
-
+    new_site = _new_site(site)
     sites.insert(new_site)
-    # Add the site to the groups - group membership is stored in the group object, not in the site
-    for group_name in site.get('groups', []):
-        # No need to check if the site is already in the group as we just added the site
-        groups.update({'name':group_name},{'$addToSet': {'sites': site['url']}})
+    # Add the site to the groups - group membership is stored in the memberships collection, not in the site
+    membership.set_member_groups(membership.SITE, site['url'], site.get('groups', []))
     new_site['groups'] = site.get('groups', [])
+    refresh_access(group_users(new_site['groups']))
     # Return the new site
     return jsonify(success=True, site=sanitize_site(new_site))
 
+#
+# Create many sites at once. Expects a list of partially filled out sites,
+# in the same format as POST /sites:
+#
+#  POST /sites/bulk
+#
+#  { 'sites': [ { 'url': 'https://www.mozilla.com',
+#                 'plans': ['basic', 'nmap'],
+#                 'groups': ['mozilla', 'key-initiatives'] },
+#               ... ] }
+#
+# Groups, plans and existing sites are looked up once for the whole list,
+# the valid sites are inserted together and added to their groups with one
+# query per group. Returns a result for every site, in the same order:
+#
+#  { 'success': True,
+#    'sites': [ { 'success': True,
+#                 'site': { 'id': 'b263bdc6-8692-4ace-aa8b-922b9ec0fc37',
+#                           'url': 'https://www.mozilla.com',
+#                           'plans': ['basic', 'nmap'],
+#                           'groups': ['mozilla', 'key-initiatives'] } },
+#               { 'success': False, 'url': 'https://www.mozilla.com',
+#                 'reason': 'site-already-exists' },
+#               ... ] }
+#
+# Items fail with the same reasons as POST /sites, or with 'invalid-groups'
+# or 'invalid-plans' when those are not lists of names.
+#
+
+def _is_list_of_strings(value):
+    return isinstance(value, list) and all(isinstance(v, basestring) for v in value)
+
+def _bulk_site_error(site):
+    """ Return why a site of a bulk request is malformed, or None """
+    if not isinstance(site.get('url'), basestring) or not _check_site_url(site['url']):
+        return 'invalid-url'
+    if not _is_list_of_strings(site.get('groups', [])):
+        return 'invalid-groups'
+    if not _is_list_of_strings(site.get('plans', [])):
+        return 'invalid-plans'
+
+@app.route('/sites/bulk', methods=['POST'])
+@api_guard('application/json')
+def create_sites():
+    sitez = request.json.get('sites')
+    if not isinstance(sitez, list):
+        return jsonify(success=False, reason='sites-field-is-required')
+    sitez = [site if isinstance(site, dict) else {} for site in sitez]
+    errors = [_bulk_site_error(site) for site in sitez]
+
+    group_names, plan_names, urls = set(), set(), set()
+    for site, error in zip(sitez, errors):
+        if error is None:
+            group_names.update(site.get('groups', []))
+            plan_names.update(site.get('plans', []))
+            urls.add(site['url'])
+    known_groups = set(g['name'] for g in groups.find({'name': {'$in': list(group_names)}}, {'_id': 0, 'name': 1}))
+    known_plans = set(p['name'] for p in plans.find({'name': {'$in': list(plan_names)}}, {'_id': 0, 'name': 1}))
+    existing = set(s['url'] for s in sites.find({'url': {'$in': list(urls)}}, {'_id': 0, 'url': 1}))
+
+    results = []
+    new_sites = []
+    group_members = {}
+    for site, error in zip(sitez, errors):
+        if error is not None:
+            reason = error
+        elif not set(site.get('groups', [])) <= known_groups:
+            reason = 'unknown-group'
+        elif not set(site.get('plans', [])) <= known_plans:
+            reason = 'unknown-plan'
+        elif site['url'] in existing:
+            reason = 'site-already-exists'
+        else:
+            reason = None
+        if reason:
+            results.append({'success': False, 'url': site.get('url'), 'reason': reason})
+            continue
+        # A url that appears twice in the list is only created once
+        existing.add(site['url'])
+        new_site = _new_site(site)
+        new_sites.append(new_site)
+        for group_name in site.get('groups', []):
+            group_members.setdefault(group_name, []).append(site['url'])
+        results.append({'success': True, 'site': dict(new_site, groups=site.get('groups', []))})
+
+    if new_sites:
+        sites.insert(new_sites)
+    for group_name, members in group_members.iteritems():
+        membership.add_members(group_name, membership.SITE, members)
+    refresh_access(group_users(group_members.keys()))
+
+    for result in results:
+        if 'site' in result:
+            sanitize_site(result['site'])
+    return jsonify(success=True, sites=results)
+
 #
 # Expects a partially filled out site as POST data. The site with the
 # specified site_id (in the URL) will be updated.
@@ -163,6 +269,7 @@ def update_site(site_id):
     if not site:
         return jsonify(success=False, reason='no-such-site')
     site['groups'] = _find_groups_for_site(site['url'])
+    affected_users = site_users([site['url']])
     for group in new_site.get('groups', []):
         if not _check_group_exists(group):
             return jsonify(success=False, reason='unknown-group')
@@ -170,14 +277,7 @@ def update_site(site_id):
         if not _check_plan_exists(plan_name):
             return jsonify(success=False, reason='unknown-plan')
     if 'groups' in new_site:
-        # Add new groups
-        for group_name in new_site.get('groups', []):
-            if group_name not in site['groups']:
-                groups.update({'name':group_name},{'$addToSet': {'sites': site['url']}})
-        # Remove old groups
-        for group_name in site['groups']:
-            if group_name not in new_site.get('groups', []):
-                groups.update({'name':group_name},{'$pull': {'sites': site['url']}})
+        membership.set_member_groups(membership.SITE, site['url'], new_site.get('groups', []))
 
     if 'plans' in new_site:
         # Update the site. At this point we can only update plans.
@@ -195,6 +295,8 @@ def update_site(site_id):
                     'enabled': new_verification['enabled'],
                     'value': str(uuid.uuid4())}}})
 
+    refresh_access(affected_users | site_users([site['url']]))
+
     # Return the updated site
     site = sites.find_one({'id': site_id})
     if not site:
@@ -208,6 +310,12 @@ def update_site(site_id):
 #
 #  DELETE /sites/<site_id>
 #
+# The site is removed immediately. Its scans and issues are removed by a
+# background job that can be followed at /jobs/<job_id>:
+#
+#  { 'success': True, 'reason': '', 'job': { 'id': '...', 'state': 'QUEUED', ... } }
+#
+
 @app.route('/sites/<site_id>', methods=['DELETE'])
 @api_guard
 def remove_site(site_id):
@@ -220,40 +328,24 @@ def remove_site(site_id):
 
     # Get url of the target
     target = site.get("url")
-    delete_plans = []
-
-    # Find a scan id for every plan
-    for plan in site.get("plans"):
-        res = scans.find_one({'plan.name': plan, 'configuration.target': target}, {"id": 1, "_id": 0})
-
-        # Check if result
-        if not res:
-            continue
-
-        scan_id = res.get("id")
-
-        delete_plans.append(scan_id)
-
-    # Remove_all plan scan
-    for scan_id in delete_plans:
-        remove_similar_scan(scan_id)
 
     # Remove site from groups
-    for group_name in _find_groups_for_site(target):
-        groups.update({'name': group_name}, {'$pull': {'sites': target}})
+    affected_users = site_users([target])
+    membership.remove_member(membership.SITE, target)
+    refresh_access(affected_users)
 
     # Remove site for existence
     res = sites.remove({"id": site_id})
 
     # Check the deletion worked
     if res.get('n') != 1:
-        err = "Something went wrong during deletion of site"
-        success = False
-    else:
-        err = ""
-        success = True
+        return jsonify(success=False, reason="Something went wrong during deletion of site")
 
-    return jsonify(success=success, reason=err)
+    # Remove every scan of the site's plans in the background
+    job = create_delete_job('remove-site', {'site': target},
+                            {'configuration.target': target, 'plan.name': {'$in': site.get('plans', [])}})
+
+    return jsonify(success=True, reason="", job=sanitize_job(job))
 
 #
 # Returns a list of sites or return the site matches the query. Currently
@@ -277,7 +369,14 @@ def get_sites():
     url = request.args.get('url')
     if url:
         query['url'] = url
-    sitez = [sanitize_site(site) for site in sites.find(query)]
-    for site in sitez:
-        site['groups'] = _find_groups_for_site(site['url'])
-    return jsonify(success=True, sites=sitez)
+    if url:
+        sitez = [sanitize_site(site) for site in sites.find(query)]
+        for site in sitez:
+            site['groups'] = _find_groups_for_site(site['url'])
+        return jsonify(success=True, sites=sitez)
+    site_groups = _find_groups_for_sites()
+    def _sites():
+        for site in sites.find(query):
+            site['groups'] = site_groups.get(site['url'], [])
+            yield sanitize_site(site)
+    return stream_json(success=True, sites=JSONStream(_sites()))
@@ -5,38 +5,45 @@ import datetime
 import uuid
 from flask import jsonify, request
 
+from minion.backend import membership
+from minion.backend.access import refresh_access
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, groups, sites, users
+from minion.backend.views.base import api_guard, sites, users, stream_json, JSONStream
 from minion.backend.views.groups import _check_group_exists
 
 def _find_groups_for_user(email):
     """Find all the groups the user is in. """
-    return [g['name'] for g in groups.find({"users":email})]
+    return membership.groups_of(membership.USER, email)
 
 def _find_sites_for_user_by_group_name(email, group_name):
     """ Find all sites that user has access to in a
     given group. """
-    group = groups.find_one({'name': group_name, 'users': email})
-    if not group:
+    if not membership.is_member(group_name, membership.USER, email):
         return jsonify(success=False, reason="Group not found.")
-    return group['sites']
+    return membership.members(group_name, membership.SITE)
 
 def _find_sites_for_user(email):
     """Find all sites that the user has access to"""
-    sitez = set()
-    for g in groups.find({"users":email}):
-        for s in g['sites']:
-            sitez.add(s)
-    return list(sitez)
+    return list(membership.members_of_groups(membership.SITE, _find_groups_for_user(email)))
+
+def _find_memberships_for_users():
+    """ Map every user email to the groups the user is in and the sites
+    the user has access to, with one query per member type. """
+    group_sites = membership.members_by_group(membership.SITE)
+    memberships = {}
+    for email, groupz in membership.groups_of_members(membership.USER).iteritems():
+        sitez = set()
+        for group_name in groupz:
+            sitez.update(group_sites.get(group_name, []))
+        memberships[email] = (groupz, sitez)
+    return memberships
 
 def update_group_association(old_email, new_email):
     """ Update all associations with the old email
     to the new email. """
 
-    groups.update({'users': old_email},
-        {'$set': {'users.$': new_email}},
-        upsert=False,
-        multi=True)
+    membership.rename_member(membership.USER, old_email, new_email)
+    refresh_access([old_email, new_email])
 
 def remove_group_association(email):
     """ Remove all associations with the recipient.
@@ -45,14 +52,11 @@ def remove_group_association(email):
 
     In case we have found a user in the same
     membership list multiple time (should not
-    happen), we better to pull all the
-    occurences out. Hence why we use
-    $pull over $pop."""
+    happen), we better to remove all the
+    occurences."""
 
-    groups.update({'users': email},
-        {'$pull': {'users': email}},
-        upsert=False,
-        multi=True)
+    membership.remove_member(membership.USER, email)
+    refresh_access([email])
 
 def sanitize_user(user):
     if '_id' in user:
@@ -144,10 +148,10 @@ def create_user():
                  'api_key': str(uuid.uuid4()) }
     users.insert(new_user)
 
-    # Add the user to the groups - group membership is stored in the group objet, not in the user
-    for group_name in user.get('groups', []):
-        groups.update({'name':group_name},{'$addToSet': {'users': user['email']}})
+    # Add the user to the groups - group membership is stored in the memberships collection, not in the user
+    membership.set_member_groups(membership.USER, user['email'], user.get('groups', []))
     new_user['groups'] = user.get('groups', [])
+    refresh_access([new_user['email']])
     return jsonify(success=True, user=sanitize_user(new_user))
 
 #
@@ -190,14 +194,7 @@ def update_user(user_email):
             return jsonify(success=False, reason='unknown-status-option')
     # Update the group memberships
     if 'groups' in new_user:
-        # Add new groups
-        for group_name in new_user.get('groups', []):
-            if group_name not in old_user['groups']:
-                groups.update({'name':group_name},{'$addToSet': {'users': user_email}})
-        # Remove old groups
-        for group_name in old_user['groups']:
-            if group_name not in new_user.get('groups', []):
-                groups.update({'name':group_name},{'$pull': {'users': user_email}})
+        membership.set_member_groups(membership.USER, user_email, new_user.get('groups', []))
     # Modify the user
     changes = {}
     if 'name' in new_user:
@@ -209,6 +206,7 @@ def update_user(user_email):
     if 'status' in new_user:
         changes['status'] = new_user['status']
     users.update({'email': user_email}, {'$set': changes})
+    refresh_access([user_email])
     # Return the updated user
     user = users.find_one({'email': user_email})
     if not user:
@@ -234,12 +232,14 @@ def update_user(user_email):
 @app.route('/users', methods=['GET'])
 @api_guard
 def list_users():
-    userz = []
-    for user in users.find():
-        user['groups'] = _find_groups_for_user(user['email'])
-        user['sites'] = _find_sites_for_user(user['email'])
-        userz.append(sanitize_user(user))
-    return jsonify(success=True, users=userz)
+    memberships = _find_memberships_for_users()
+    def _users():
+        for user in users.find():
+            groupz, sitez = memberships.get(user['email'], ([], set()))
+            user['groups'] = groupz
+            user['sites'] = list(sitez)
+            yield sanitize_user(user)
+    return stream_json(success=True, users=JSONStream(_users()))
 
 #
 # Delete a user
@@ -3,19 +3,20 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import copy
+import itertools
 import logging
 import os
+import Queue
 import sys
 import urlparse
 import uuid
 import hashlib
-import socket
+import threading
+import time
 import traceback
+import xml.etree.cElementTree as ElementTree
+from collections import namedtuple
 
-from twisted.internet import reactor
-from twisted.internet.threads import deferToThread
-from twisted.internet.error import ProcessDone, ProcessTerminated
-from twisted.internet.protocol import ProcessProtocol
 import zope.interface
 
 
@@ -90,6 +91,18 @@ class AbstractPlugin:
     EXIT_STATE_FAILED   = "FAILED"
     EXIT_STATE_ABORTED  = "ABORTED"
 
+    # Progress is sent at most once per PROGRESS_INTERVAL seconds. Reports made in
+    # between replace the pending one, which is sent when the interval is over.
+
+    PROGRESS_INTERVAL = 5
+
+    # The reactor is set by the PluginRunner. It stays None when a blocking
+    # plugin runs without one, see BlockingPlugin.run_blocking().
+
+    reactor = None
+
+    _progress_lock = threading.Lock()
+
     # Plugin methods. By default these do nothing.
 
     def do_configure(self):
@@ -138,9 +151,43 @@ class AbstractPlugin:
     def report_start(self):
         self.callbacks.report_start()
 
-    def report_progress(self, percentage, description):
+    def report_progress(self, percentage, description=""):
+        if self.reactor is None:
+            # Without a reactor there is nothing to schedule the pending report
+            # with. It is sent with the next report after the interval, or when
+            # the plugin finishes.
+            with self._progress_lock:
+                self._pending_progress = (percentage, description)
+                if getattr(self, '_progress_sent', 0) + self.PROGRESS_INTERVAL <= time.time():
+                    self._send_progress()
+            return
+        from twisted.python.threadable import isInIOThread
+        if not isInIOThread():
+            self.reactor.callFromThread(self.report_progress, percentage, description)
+            return
+        self._pending_progress = (percentage, description)
+        if getattr(self, '_progress_call', None) is None:
+            delay = getattr(self, '_progress_sent', 0) + self.PROGRESS_INTERVAL - time.time()
+            self._progress_call = self.reactor.callLater(max(0, delay), self._send_progress)
+
+    def _send_progress(self):
+        self._progress_call = None
+        self._progress_sent = time.time()
+        percentage, description = self._pending_progress
+        self._pending_progress = None
         self.callbacks.report_progress(percentage, description)
 
+    def _flush_progress(self):
+        if self.reactor is None:
+            with self._progress_lock:
+                if getattr(self, '_pending_progress', None) is not None:
+                    self._send_progress()
+            return
+        from twisted.python.threadable import isInIOThread
+        if getattr(self, '_progress_call', None) is not None and isInIOThread():
+            self._progress_call.cancel()
+            self._send_progress()
+
     def report_issues(self, issues):
         if issues:
             for issue in issues:
@@ -188,11 +235,10 @@ class AbstractPlugin:
         self.callbacks.report_artifacts(name, paths)
 
     def report_finish(self, state=EXIT_STATE_FINISHED, failure=""):
+        self._flush_progress()
         self.callbacks.report_finish(state=state, failure=failure)
-        try:
-            reactor.stop()
-        except Exception as e:
-            pass  # TODO FIXME : investigate why it is needed
+        if self.reactor is not None and self.reactor.running:
+            self.reactor.stop()
 
     def format_report(self, issue_key, format_list):
         issue = copy.deepcopy(self.REPORTS[issue_key])
@@ -201,6 +247,16 @@ class AbstractPlugin:
                 issue[component_name] = issue[component_name].format(**kwargs)
         return issue
 
+class ItemTimeout(Exception):
+    """ The item was not done within the timeout of BlockingPlugin.parallel_map() """
+
+
+# A result of BlockingPlugin.parallel_map(). Error is the exception that fn
+# raised for the item, or an ItemTimeout, in which case result is None.
+
+MapResult = namedtuple('MapResult', ['item', 'result', 'error'])
+
+
 class BlockingPlugin(AbstractPlugin):
 
     """
@@ -209,8 +265,20 @@ class BlockingPlugin(AbstractPlugin):
     variable. This variable can be checked from the thread. If that
     is not sufficuent then a different strategy can be implemented
     by overriding do_stop and doing something different.
+
+    Plugins that do not override do_start() are run by the PluginRunner
+    through run_blocking() instead, in the main thread and without a
+    reactor. do_stop() is then called from a signal handler.
+
+    Use parallel_map() to work on many items at once, for example to check
+    a list of URLs, instead of starting threads that do not know about
+    stopped.
     """
 
+    # How often parallel_map() looks at stopped and at the item timeouts
+
+    PARALLEL_POLL_INTERVAL = 0.25
+
     def __init__(self):
         self.stopped = False
 
@@ -227,78 +295,254 @@ class BlockingPlugin(AbstractPlugin):
 
     def _finish_with_failure(self, failure):
         logging.debug("BlockingPlugin._finish_with_failure: %s" % str(failure))
-        self.report_issue({"Severity": "Error", "Summary": str(failure.value)}) # TODO Return a failure structure? {message, exception, etc...} ?
+        self._finish_with_exception(failure.value)
+
+    def _finish_with_exception(self, e):
+        self.report_issue({"Severity": "Error", "Summary": str(e)}) # TODO Return a failure structure? {message, exception, etc...} ?
         self.report_finish(state = AbstractPlugin.EXIT_STATE_FAILED)
 
     def do_start(self):
+        from twisted.internet.threads import deferToThread
         deferred = deferToThread(self.do_run)
         deferred.addCallback(self._finish_with_success)
         deferred.addErrback(self._finish_with_failure)
         return deferred
 
+    def run_blocking(self):
+        """ Run do_run() in the calling thread and report how it finished. This
+        is do_start() without the reactor and the thread pool. """
+        try:
+            result = self.do_run()
+        except Exception as e:
+            logging.debug("BlockingPlugin.run_blocking: %s" % traceback.format_exc())
+            self._finish_with_exception(e)
+        else:
+            self._finish_with_success(result)
+
     def do_stop(self):
         self.stopped = True
 
+    def parallel_map(self, fn, items, concurrency=4, timeout=None):
+        """
+        Call fn(item) for the items, in at most concurrency threads at a
+        time, and yield a MapResult for every item as soon as it is done. The
+        results come in the order in which the items finish.
+
+          for r in self.parallel_map(self.check_url, urls, concurrency=8, timeout=30):
+              if r.error is None and r.result:
+                  self.report_issues(r.result)
+
+        An item that takes longer than timeout seconds is yielded with an
+        ItemTimeout error. Its thread cannot be interrupted, so it is left
+        to finish on its own and its result is dropped. It keeps its place
+        until then, so there are never more than concurrency threads. When
+        the plugin is stopped no new items are started and
+        the iteration ends right away. Items that are still running see
+        stopped as well, so fn should check it between slow steps.
+        """
+        items = iter(items)
+        results = Queue.Queue()
+        running = {} # token -> (item, started)
+        abandoned = set() # tokens of items that timed out but are still running
+        tokens = itertools.count()
+        exhausted = False
+
+        def work(token, item):
+            try:
+                results.put((token, fn(item), None))
+            except Exception as e:
+                logging.debug("BlockingPlugin.parallel_map: %s" % traceback.format_exc())
+                results.put((token, None, e))
+
+        while not self.stopped:
+            while not exhausted and len(running) + len(abandoned) < concurrency:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                token = next(tokens)
+                running[token] = (item, time.time())
+                thread = threading.Thread(target=work, args=(token, item))
+                thread.daemon = True
+                thread.start()
+
+            if exhausted and not running:
+                return
+
+            wait = self.PARALLEL_POLL_INTERVAL
+            if timeout is not None and running:
+                first_deadline = min(started for item, started in running.values()) + timeout
+                wait = max(0, min(wait, first_deadline - time.time()))
+            try:
+                token, result, error = results.get(timeout=wait)
+            except Queue.Empty:
+                pass
+            else:
+                if self.stopped:
+                    return
+                # The results of items that timed out are no longer expected,
+                # but their place is free now
+                abandoned.discard(token)
+                if token in running:
+                    item, started = running.pop(token)
+                    yield MapResult(item, result, error)
+
+            if timeout is not None:
+                now = time.time()
+                for token, (item, started) in running.items():
+                    if now - started >= timeout:
+                        del running[token]
+                        abandoned.add(token)
+                        yield MapResult(item, None, ItemTimeout("Item took longer than %d seconds" % timeout))
+
+
+class AsyncPlugin(AbstractPlugin):
+
+    """
+    Plugin that runs on the reactor, in a single thread. do_run() returns a
+    Deferred that fires when the plugin is done, with the exit state or with
+    None. Use self.http to make requests; many of them can be in flight at
+    the same time:
 
-class ExternalProcessProtocol(ProcessProtocol):
+      def do_run(self):
+          return gatherResults([self.http.get(url).addCallback(self.check) for url in self.urls()])
 
+    When asked to stop, all requests and the Deferred of do_run() are
+    cancelled. The Deferred of a request then fails with a CancelledError,
+    and the plugin finishes as stopped whatever do_run() makes of that.
     """
-    Protocol that delegates incoming data on stdout and stderr to the plugin. The
-    plugin can capture the data and wait until the process is finished or process
-    it immediately and report results back.
+
+    # The number of requests that self.http has in flight at most
+
+    HTTP_CONCURRENCY = 10
+
+    def __init__(self):
+        self.stopped = False
+        self.http = None
+        self.deferred = None
+
+    def do_run(self):
+        self.report_issue({"Severity": "Error", "Summary": "You forgot to override AsyncPlugin.do_run()"})
+        return AbstractPlugin.EXIT_STATE_FAILED
+
+    def _finish_with_success(self, result):
+        logging.debug("AsyncPlugin._finish_with_success: %s" % str(result))
+        self.http.close()
+        if self.stopped:
+            self.report_finish(state = result or AbstractPlugin.EXIT_STATE_STOPPED)
+        else:
+            self.report_finish(state = result or AbstractPlugin.EXIT_STATE_FINISHED)
+
+    def _finish_with_failure(self, failure):
+        logging.debug("AsyncPlugin._finish_with_failure: %s" % str(failure))
+        self.http.close()
+        if self.stopped:
+            self.report_finish(state = AbstractPlugin.EXIT_STATE_STOPPED)
+        else:
+            self.report_issue({"Severity": "Error", "Summary": str(failure.value)})
+            self.report_finish(state = AbstractPlugin.EXIT_STATE_FAILED)
+
+    def create_http_client(self):
+        """ Return the client for self.http. Override to change its limits. """
+        from minion.plugins.webclient import HTTPClient
+        return HTTPClient(self.reactor, concurrency=self.HTTP_CONCURRENCY)
+
+    def do_start(self):
+        from twisted.internet.defer import maybeDeferred
+        self.http = self.create_http_client()
+        self.deferred = maybeDeferred(self.do_run)
+        self.deferred.addCallbacks(self._finish_with_success, self._finish_with_failure)
+        return self.deferred
+
+    def do_stop(self):
+        self.stopped = True
+        # Cancelling the requests first lets do_run() see the CancelledErrors
+        # and finish on its own. Otherwise its Deferred is cancelled as well.
+        # Both are None when the plugin is stopped before it started.
+        if self.http is not None:
+            self.http.close()
+        if self.deferred is not None and not self.deferred.called:
+            self.deferred.cancel()
+
+
+class LineParser:
+
+    """
+    Incremental parser for line based tool output. Feed it chunks of output
+    as they arrive and it calls callback(line) for every complete line,
+    without the line ending. Only the unfinished last line is kept.
     """
 
-    def __init__(self, plugin):
-        self.plugin = plugin
+    def __init__(self, callback):
+        self.callback = callback
+        self.buffer = ""
+
+    def feed(self, data):
+        lines = (self.buffer + data).split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            self.callback(line.rstrip("\r"))
+
+    def close(self):
+        if self.buffer:
+            line, self.buffer = self.buffer, ""
+            self.callback(line.rstrip("\r"))
+
+
+class _RecordTarget:
+
+    """ Parser target that builds the tree with a TreeBuilder and hands out
+    the records when they end. """
+
+    def __init__(self, tags, callback):
+        self.tags = tags
+        self.callback = callback
+        self.builder = ElementTree.TreeBuilder()
+        self.elements = []
+
+    def start(self, tag, attrib):
+        self.elements.append(self.builder.start(tag, attrib))
+
+    def data(self, data):
+        self.builder.data(data)
+
+    def end(self, tag):
+        element = self.builder.end(tag)
+        self.elements.pop()
+        if tag in self.tags:
+            self.callback(element)
+            if self.elements:
+                self.elements[-1].remove(element)
+        return element
+
+    def close(self):
+        return self.builder.close()
+
+
+class XMLRecordParser:
+
+    """
+    Incremental parser for XML tool output. Feed it chunks of output as they
+    arrive and it calls callback(element) for every element with one of the
+    given tags, as soon as the element is complete. The element is removed
+    from the tree after the callback, so a large report is never in memory
+    at once. For example, for the hosts in an nmap report:
+
+      XMLRecordParser(['host'], self.report_host)
+
+    Parse errors are raised from feed() and close().
+    """
+
+    def __init__(self, tags, callback):
+        self.parser = ElementTree.XMLParser(target=_RecordTarget(set(tags), callback))
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+    def close(self):
+        self.parser.close()
 
-    def outReceived(self, data):
-        try:
-            self.plugin.do_process_stdout(data)
-        except Exception as e:
-            logging.exception("Plugin threw an uncaught exception in do_process_stdout: " + str(e))
-            fail = {
-                "hostname": socket.gethostname(),
-                "exception": traceback.format_exc(),
-                "message": "Plugin failed"
-            }
-            self.plugin.report_finish(AbstractPlugin.EXIT_STATE_FAILED, fail)
-
-    def errReceived(self, data):
-        try:
-            self.plugin.do_process_stderr(data)
-        except Exception as e:
-            logging.exception("Plugin threw an uncaught exception in do_process_stderr: " + str(e))
-            fail = {
-                "hostname": socket.gethostname(),
-                "exception": traceback.format_exc(),
-                "message": "Plugin failed"
-            }
-            self.plugin.report_finish(AbstractPlugin.EXIT_STATE_FAILED, fail)
-
-    def processEnded(self, reason):
-        logging.debug("ExternalProcessProtocol.processEnded: " + str(reason.value))
-        if isinstance(reason.value, ProcessTerminated):
-            try:
-                self.plugin.do_process_ended(reason.value.status)
-            except Exception as e:
-                logging.exception("Plugin threw an uncaught exception in do_process_ended: " + str(e))
-                fail = {
-                    "hostname": socket.gethostname(),
-                    "exception": traceback.format_exc(),
-                    "message": "Plugin failed"
-                }
-                self.plugin.report_finish(AbstractPlugin.EXIT_STATE_FAILED, fail)
-        elif isinstance(reason.value, ProcessDone):
-            try:
-                self.plugin.do_process_ended(reason.value.status)
-            except Exception as e:
-                logging.exception("Plugin threw an uncaught exception in do_process_ended: " + str(e))
-                fail = {
-                    "hostname": socket.gethostname(),
-                    "exception": traceback.format_exc(),
-                    "message": "Plugin failed"
-                }
-                self.plugin.report_finish(AbstractPlugin.EXIT_STATE_FAILED, fail)
 
 class ExternalProcessPlugin(AbstractPlugin):
 
@@ -308,8 +552,16 @@ class ExternalProcessPlugin(AbstractPlugin):
 
     The default behaviour of do_stop() is to simply kill the external tool. When the
     tool is killed and exits,
+
+    Output is passed to do_process_stdout() and do_process_stderr() as it
+    arrives. Plugins that set stdout_parser or stderr_parser to a LineParser
+    or XMLRecordParser get their records as soon as they are complete instead.
+    The parsers are closed before do_process_ended() is called.
     """
 
+    stdout_parser = None
+    stderr_parser = None
+
     def __init__(self):
         self.stopping = False
 
@@ -320,10 +572,11 @@ class ExternalProcessPlugin(AbstractPlugin):
                 return program_path
 
     def spawn(self, path, arguments):
+        from minion.plugins.process import ExternalProcessProtocol
         protocol = ExternalProcessProtocol(self)
         name = path.split('/')[-1]
         logging.debug("Executing %s %s" % (path, " ".join([name] + arguments)))
-        self.process = reactor.spawnProcess(protocol, path, [name] + arguments)
+        self.process = self.reactor.spawnProcess(protocol, path, [name] + arguments)
 
     def do_process_ended(self, status):
         logging.debug("ExternalProcessPlugin.do_process_ended")
@@ -332,11 +585,23 @@ class ExternalProcessPlugin(AbstractPlugin):
         else:
             self.report_finish()
 
+    def close_parsers(self):
+        for parser in (self.stdout_parser, self.stderr_parser):
+            if parser is not None:
+                try:
+                    parser.close()
+                except ElementTree.ParseError:
+                    # The output of a tool that was killed ends anywhere
+                    if not self.stopping:
+                        raise
+
     def do_process_stdout(self, data):
-        pass
+        if self.stdout_parser is not None:
+            self.stdout_parser.feed(data)
 
     def do_process_stderr(self, data):
-        pass
+        if self.stderr_parser is not None:
+            self.stderr_parser.feed(data)
 
     def do_stop(self):
         logging.debug("ExternalProcessPlugin.do_stop")
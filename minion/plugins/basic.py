@@ -4,6 +4,7 @@
 
 
 import collections
+import copy
 import logging
 import os
 import re
@@ -12,7 +13,6 @@ import sys
 import urlparse
 
 from collections import namedtuple
-from twisted.internet.task import LoopingCall
 from robots_scanner.scanner import scan
 
 import minion.curly
@@ -164,37 +164,29 @@ by ensuring that their content is not embedded into other sites.",
                 return False
             return True
 
+    def check_response(self, url, headers):
+        """ Return the issues for a response with these headers. Also used by
+        the CrawlerPlugin for every page it finds. """
+        if not 'x-frame-options' in headers:
+            return [self.format_report('not-set', [])]
+        xfo_value = headers['x-frame-options']
+        # 'DENY' and 'SAMEORIGIN' don't carry extra values
+        if xfo_value.upper() in ('DENY', 'SAMEORIGIN'):
+            report = 'set'
+        # only strict ALLOW-FROM syntax is allowed
+        elif 'ALLOW-FROM' in xfo_value.upper():
+            report = 'set' if self._allow_from_validator(xfo_value) else 'invalid'
+        # found invalid/unknown option value
+        else:
+            report = 'invalid'
+        return [self.format_report(report, [
+            {"Description": {"header": xfo_value}}
+        ])]
+
     def do_run(self):
         r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15)
         r.raise_for_status()
-        if 'x-frame-options' in r.headers:
-            xfo_value = r.headers['x-frame-options']
-            # 'DENY' and 'SAMEORIGIN' don't carry extra values
-            if xfo_value.upper() in ('DENY', 'SAMEORIGIN'):
-                issue = self.format_report('set', [
-                    {"Description": {"header": xfo_value}}
-                ])
-                self.report_issue(issue)
-            # only strict ALLOW-FROM syntax is allowed
-            elif 'ALLOW-FROM' in xfo_value.upper():
-                if self._allow_from_validator(xfo_value):
-                    issue = self.format_report('set', [
-                        {"Description": {"header": xfo_value}}
-                    ])
-                    self.report_issue(issue)
-                else:
-                    issue = self.format_report('invalid', [
-                        {"Description": {"header": xfo_value}}
-                    ])
-                    self.report_issue(issue)
-           # found invalid/unknown option value
-            else:
-                issue = self.format_report('invalid', [
-                    {"Description": {"header": xfo_value}}
-                ])
-                self.report_issue(issue)
-        else:
-            self.report_issue(self.REPORTS['not-set'])
+        self.report_issues(self.check_response(r.url, r.headers))
 
 class HSTSPlugin(BlockingPlugin):
 
@@ -263,32 +255,30 @@ max-age=31536000 tells the browser to apply HSTS for one year.",
             },
     }
 
+    def check_response(self, url, headers):
+        """ Return the issues for a response from url with these headers. Also
+        used by the CrawlerPlugin for every page it finds. """
+        if not url.startswith("https://"):
+            return [self.format_report('non-https', [])]
+        if not 'strict-transport-security' in headers:
+            return [self.format_report('not-set', [])]
+        hsts_value = headers['strict-transport-security']
+        regex = re.compile(r"^max-age=(?P<delta>\d+)(\s)?(;)?(?P<option> includeSubDomains)?$")
+        match = regex.match(hsts_value)
+        if not match:
+            return [self.format_report('invalid', [
+                {"Description": {"header": hsts_value}}
+            ])]
+        if int(match.groupdict()['delta']) < 0:
+            return [self.format_report('negative', [])]
+        return [self.format_report('set', [
+            {"Description": {"header": hsts_value}}
+        ])]
+
     def do_run(self):
         r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15)
         r.raise_for_status()
-        if r.url.startswith("https://"):
-            if 'strict-transport-security' in r.headers:
-                hsts_value = r.headers['strict-transport-security']
-                regex = re.compile(r"^max-age=(?P<delta>\d+)(\s)?(;)?(?P<option> includeSubDomains)?$")
-                match = regex.match(hsts_value)
-                if match:
-                    groups = match.groupdict()
-                    if int(groups['delta']) < 0:
-                        self.report_issue(self.REPORTS["negative"])
-                    else:
-                        issue = self.format_report('set', [
-                            {"Description": {"header": hsts_value}}
-                        ])
-                        self.report_issue(issue)
-                else:
-                    issue = self.format_report('invalid', [
-                        {"Description": {"header": hsts_value}}
-                    ])
-                    self.report_issue(issue)
-            else:
-                self.report_issue(self.REPORTS["not-set"])
-        else:
-            self.report_issue(self.REPORTS["non-https"])
+        self.report_issues(self.check_response(r.url, r.headers))
 
 class XContentTypeOptionsPlugin(BlockingPlugin):
 
@@ -868,7 +858,7 @@ remove unsafe-eval from the Content-Security-Policy header.",
         elif xcsp_ro and not xcsp:
             issues.append(self.REPORTS["xcsp-ro-only-set"])
 
-        self.report_issues(issues)
+        return [copy.deepcopy(issue) for issue in issues]
 
     def _split_policy(self, csp):
         r1 = re.compile(';\s*')
@@ -881,16 +871,17 @@ remove unsafe-eval from the Content-Security-Policy header.",
         
         # split by space so directive name is first element
         # follows by a list of source expressions
-        self.policies = []
+        policies = []
         for index, directive_group in enumerate(dir_split_list):
             d = r2.split(directive_group)
-            self.policies.append(self.Policy(d[0], d[1:], " ".join(d)))
+            policies.append(self.Policy(d[0], d[1:], " ".join(d)))
+        return policies
 
-    def _check_directives(self):
+    def _check_directives(self, policies):
         issues = []
         depr_dirs = []
         unknown_dirs = []
-        for policy in self.policies:
+        for policy in policies:
             if policy.directive in self.DEPRECATED_DIRECTIVES:
                 depr_dirs.append(policy)
             elif policy.directive not in self.DIRECTIVES:
@@ -920,13 +911,13 @@ remove unsafe-eval from the Content-Security-Policy header.",
                 {"Solution": {"solution": "\n".join(solutions)}}
             ]))
 
-        self.report_issues(issues)
+        return issues
 
-    def _check_source_lists(self):
+    def _check_source_lists(self, policies):
         bad_none = []
         inline = []
         eval = []
-        for policy in self.policies:
+        for policy in policies:
             if "'none'" in policy.source_list:
                 if len(policy.source_list) > 1:
                     bad_none.append(policy)
@@ -955,15 +946,19 @@ remove unsafe-eval from the Content-Security-Policy header.",
                 {'Description': {"policies": "\n".join(p.str for p in eval)}}
             ]))
 
-        self.report_issues(issues)
+        return issues
+
+    def check_response(self, url, headers):
+        """ Return the issues for a response with these headers. Also used by
+        the CrawlerPlugin for every page it finds. """
+        issues = self._check_headers(headers)
+        if "content-security-policy" in headers:
+            policies = self._split_policy(headers["content-security-policy"])
+            issues += self._check_directives(policies)
+            issues += self._check_source_lists(policies)
+        return issues
 
     def do_run(self):
         r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15)
         r.raise_for_status()
-
-        self._check_headers(r.headers)
-        if "content-security-policy" in r.headers:
-            csp = r.headers["content-security-policy"]
-            self._split_policy(csp)
-            self._check_directives()
-            self._check_source_lists()
+        self.report_issues(self.check_response(r.url, r.headers))
@@ -0,0 +1,226 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import logging
+import urlparse
+from HTMLParser import HTMLParser, HTMLParseError
+
+from minion.curly import BadResponseError
+from minion.plugins.base import AsyncPlugin
+from minion.plugins.basic import CSPPlugin, HSTSPlugin, XFrameOptionsPlugin
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+def _origin(url):
+    parsed = urlparse.urlparse(url)
+    return (parsed.scheme, parsed.hostname, parsed.port or DEFAULT_PORTS.get(parsed.scheme))
+
+
+def _same_site(url, other):
+    """ Whether two urls are on the same host, ignoring the scheme, the port and
+    a www. in front of the hostname """
+    def name(u):
+        hostname = (urlparse.urlparse(u).hostname or '').lower()
+        return hostname[4:] if hostname.startswith('www.') else hostname
+    return name(url) == name(other)
+
+
+class _LinkParser(HTMLParser):
+
+    """ Collects the links of a page: a and area href, frame and iframe src """
+
+    LINK_ATTRIBUTES = {'a': 'href', 'area': 'href', 'frame': 'src', 'iframe': 'src'}
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        name = self.LINK_ATTRIBUTES.get(tag)
+        if name:
+            for attr, value in attrs:
+                if attr == name and value:
+                    self.links.append(value.strip())
+
+
+def _is_page(status, headers):
+    """ Whether the body of a response can hold links to crawl """
+    return 200 <= status < 300 and 'html' in headers.get('content-type', '')
+
+
+def find_links(url, body):
+    """ Return the absolute urls, without fragment, that the page links to """
+    parser = _LinkParser()
+    try:
+        parser.feed(body)
+        parser.close()
+    except HTMLParseError as e:
+        logging.debug("Stopped parsing %s: %s" % (url, str(e)))
+    links = []
+    for link in parser.links:
+        link = urlparse.urldefrag(urlparse.urljoin(url, link))[0]
+        if link.startswith('http://') or link.startswith('https://'):
+            links.append(link)
+    return links
+
+
+class CrawlerPlugin(AsyncPlugin):
+
+    """
+    This plugin crawls the pages of the target site and runs the header
+    checks of the XFrameOptions, HSTS and CSP plugins on each of them. The
+    issues of a page are reported together, with the url of the page.
+
+    Only pages with the same origin as the target are crawled, up to
+    max_depth links away from the target and up to max_pages pages. The
+    crawl ends after max_duration seconds in any case. Pages are fetched
+    concurrently, at most per_host at a time. Only the bodies of html pages
+    are read, up to max_page_size bytes; other responses are only checked.
+    """
+
+    PLUGIN_NAME = "Crawler"
+    PLUGIN_VERSION = "0.1"
+
+    CHECKS = (XFrameOptionsPlugin, HSTSPlugin, CSPPlugin)
+
+    DEFAULTS = {
+        'max_depth': 2,
+        'max_pages': 50,
+        'max_duration': 300,
+        'concurrency': 10,
+        'per_host': 4,
+        'timeout': 15,
+        'max_page_size': 2 * 1024 * 1024
+    }
+
+    REPORTS = {
+        "crawled":
+            {
+                "Code": "CRAWL-0",
+                "Summary": "Crawled {pages} pages",
+                "Description": "The header checks ran on {checked} pages. {failed} pages could not be fetched. {budget}",
+                "Severity": "Info",
+                "URLs": [ {"URL": None, "Extra": None} ]
+            }
+    }
+
+    def do_configure(self):
+        self.options = dict(self.DEFAULTS)
+        for name in self.DEFAULTS:
+            if name in self.configuration:
+                self.options[name] = int(self.configuration[name])
+        self.checks = [check() for check in self.CHECKS]
+
+    def create_http_client(self):
+        from minion.plugins.webclient import HTTPClient
+        return HTTPClient(self.reactor, concurrency=self.options['concurrency'], per_host=self.options['per_host'],
+                          timeout=self.options['timeout'], max_body_size=self.options['max_page_size'])
+
+    def do_run(self):
+        from twisted.internet.defer import Deferred
+        self.target = self.configuration['target']
+        self.origin = _origin(self.target)
+        self.seen = set([self.target])
+        self.outstanding = 0
+        self.checked = 0
+        self.failed = 0
+        self.out_of_time = False
+        self.done = Deferred()
+        self.timer = self.reactor.callLater(self.options['max_duration'], self._out_of_time)
+        self._fetch(self.target, 0)
+        return self.done
+
+    def _out_of_time(self):
+        logging.info("Crawl of %s ran out of time" % self.target)
+        self.out_of_time = True
+        self.http.close()
+
+    def _enqueue(self, url, depth):
+        if url in self.seen or _origin(url) != self.origin:
+            return
+        if self.stopped or self.out_of_time or len(self.seen) >= self.options['max_pages']:
+            return
+        self.seen.add(url)
+        self._fetch(url, depth)
+
+    def _fetch(self, url, depth):
+        self.outstanding += 1
+        d = self.http.get(url, want_body=_is_page)
+        d.addCallback(self._fetched, url, depth)
+        d.addErrback(self._fetch_failed, url, depth)
+        d.addBoth(self._fetch_done)
+
+    def _fetched(self, response, url, depth):
+        if response.status in REDIRECT_CODES and 'location' in response.headers:
+            location = urlparse.urldefrag(urlparse.urljoin(url, response.headers['location']))[0]
+            # Follow the target to where it lives, for example from http to https,
+            # but not to another site such as a login service
+            if self.checked == 0 and depth == 0:
+                if _same_site(self.target, location):
+                    self.origin = _origin(location)
+                else:
+                    logging.info("Not following %s to another site: %s" % (url, location))
+            self._enqueue(location, depth)
+            return
+        if not 200 <= response.status < 300:
+            if depth == 0 and self.checked == 0:
+                raise BadResponseError(status_code=response.status)
+            self.failed += 1
+            return
+        self.checked += 1
+        issues = []
+        for check in self.checks:
+            issues += check.check_response(response.url, response.headers)
+        for issue in issues:
+            issue['URLs'] = [{'URL': response.url}]
+        self.report_issues(issues)
+        if depth < self.options['max_depth'] and response.body is not None:
+            for link in find_links(response.url, response.body):
+                self._enqueue(link, depth + 1)
+
+    def _fetch_failed(self, failure, url, depth):
+        from minion.plugins.webclient import BodyTooLarge
+        if self.stopped or self.out_of_time:
+            return
+        if failure.check(BodyTooLarge):
+            # The headers can still be checked, only the links are lost
+            logging.info("Not reading %s: %s" % (url, str(failure.value)))
+            return self._fetched(failure.value.response, url, depth)
+        if depth == 0 and self.checked == 0 and not self.done.called:
+            # Nothing to crawl when the target itself cannot be fetched
+            self.done.errback(failure)
+            return
+        logging.info("Failed to fetch %s: %s" % (url, str(failure.value)))
+        self.failed += 1
+
+    def _fetch_done(self, result):
+        self.outstanding -= 1
+        self.report_progress(100 * (len(self.seen) - self.outstanding) / len(self.seen),
+                             "Crawled %d of %d pages" % (len(self.seen) - self.outstanding, len(self.seen)))
+        if self.outstanding == 0:
+            if self.timer.active():
+                self.timer.cancel()
+            if not self.done.called:
+                if not self.stopped:
+                    self._report_crawl()
+                self.done.callback(None)
+
+    def _report_crawl(self):
+        if self.out_of_time:
+            budget = "The crawl ran out of time after %d seconds." % self.options['max_duration']
+        elif len(self.seen) >= self.options['max_pages']:
+            budget = "The crawl stopped at the limit of %d pages." % self.options['max_pages']
+        else:
+            budget = "All pages up to %d links away from the target were crawled." % self.options['max_depth']
+        issue = self.format_report('crawled', [
+            {"Summary": {"pages": len(self.seen)}},
+            {"Description": {"checked": self.checked, "failed": self.failed, "budget": budget}}
+        ])
+        issue['URLs'] = [{'URL': self.target}]
+        self.report_issue(issue)
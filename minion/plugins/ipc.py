@@ -0,0 +1,129 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Framed messages between minion-plugin-runner and the plugin worker. Every
+# message is a JSON object prefixed with its length as a 4 byte big endian
+# integer:
+#
+#  \x00\x00\x00\x1f{"msg": "start", "data": null}
+#
+# The length prefix lets the reader find the end of a message without scanning
+# for newlines, and keeps the stream in sync when a message cannot be decoded.
+#
+# The runner writes frames with blocking writes. When the worker falls behind
+# the pipe fills up and the plugin waits, instead of the worker buffering an
+# unbounded amount of messages.
+#
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+
+HEADER = struct.Struct('>I')
+
+# Anything larger is not a message but a corrupt stream
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+READ_SIZE = 64 * 1024
+
+# A reader hands out messages after reading at most this much, even when more is
+# available, so that a busy writer cannot keep it reading forever
+MAX_READ_SIZE = 16 * READ_SIZE
+
+
+class FrameError(Exception):
+    """ The stream is corrupt and cannot be read any further. """
+
+
+def encode_frame(message):
+    payload = json.dumps(message)
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError("Message of %d bytes is too large" % len(payload))
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameWriter:
+
+    """
+    Writes framed messages to a file descriptor. Plugins report from the reactor
+    and from their own threads, so writes are serialized to keep frames whole.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()
+
+    def write(self, message):
+        data = encode_frame(message)
+        with self.lock:
+            while data:
+                try:
+                    data = data[os.write(self.fd, data):]
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+
+
+class FrameReader:
+
+    """
+    Reads framed messages from a non-blocking file descriptor. Call read() when
+    the descriptor is readable; it returns the messages of all complete frames
+    received so far. Frames that do not hold a JSON object with a 'msg' field
+    are skipped and counted in malformed.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = ""
+        self.closed = False
+        self.malformed = 0
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def read(self):
+        received = 0
+        while received < MAX_READ_SIZE:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                self.closed = True
+                break
+            self.buffer += data
+            received += len(data)
+        return self._decode()
+
+    def _decode(self):
+        messages, offset = [], 0
+        while len(self.buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise FrameError("Frame of %d bytes is too large" % length)
+            end = offset + HEADER.size + length
+            if end > len(self.buffer):
+                break
+            payload = self.buffer[offset + HEADER.size:end]
+            offset = end
+            try:
+                message = json.loads(payload)
+                if not isinstance(message, dict) or 'msg' not in message:
+                    raise ValueError("Not a message")
+            except ValueError as e:
+                logging.error("Skipping malformed frame (%s): %r" % (str(e), payload[:256]))
+                self.malformed += 1
+                continue
+            messages.append(message)
+        self.buffer = self.buffer[offset:]
+        if self.closed and self.buffer:
+            raise FrameError("Stream ended in the middle of a frame")
+        return messages
@@ -0,0 +1,257 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import heapq
+import logging
+import resource
+import urlparse
+
+from netaddr import AddrFormatError, IPNetwork
+
+from minion.plugins.base import AsyncPlugin
+
+
+def parse_ports(ports):
+    """ Return the ports of a list like [22, 80] or of a string like
+    "22,80,8000-8100", in the order given and without duplicates """
+    if not isinstance(ports, list):
+        ports = str(ports).split(',')
+    result, seen = [], set()
+    for part in ports:
+        part = str(part).strip()
+        if '-' in part:
+            first, last = part.split('-', 1)
+            numbers = range(int(first), int(last) + 1)
+        else:
+            numbers = [int(part)]
+        for port in numbers:
+            if not 0 < port < 65536:
+                raise ValueError("Invalid port %d" % port)
+            if port not in seen:
+                seen.add(port)
+                result.append(port)
+    return result
+
+
+def target_hosts(target):
+    """ Return the addresses of a CIDR network or address, or the hostname of a url """
+    try:
+        network = IPNetwork(target)
+    except (AddrFormatError, ValueError):
+        hostname = urlparse.urlparse(target).hostname
+        if not hostname:
+            raise ValueError("Cannot find a host or network in %s" % target)
+        return 1, lambda: iter([hostname])
+    if network.size == 1:
+        return 1, lambda: iter([str(network.ip)])
+    # Without the network and broadcast addresses, see IPNetwork.iter_hosts()
+    size = network.size - 2 if network.version == 4 and network.prefixlen < 31 else network.size
+    return size, lambda: (str(address) for address in network.iter_hosts())
+
+
+class PortSweepPlugin(AsyncPlugin):
+
+    """
+    This plugin finds the open TCP ports of the target, which can be a
+    host, a url or a CIDR network. It tries to connect to every port of
+    every address and reports each port that accepts the connection.
+
+    The ports are tried one port at a time over all addresses, which
+    spreads the connections over the network. At most concurrency
+    connections are open at the same time, at most rate are started per
+    second, and at most host_rate per second to the same address. With the
+    defaults ten ports of a /16 network are swept in about six minutes.
+    """
+
+    PLUGIN_NAME = "Port Sweep"
+    PLUGIN_VERSION = "0.1"
+
+    DEFAULT_PORTS = "21,22,23,25,80,443,3306,5432,8080,8443"
+
+    DEFAULTS = {
+        'concurrency': 2000,
+        'rate': 2000,
+        'host_rate': 20,
+        'timeout': 2.0
+    }
+
+    # File descriptors that are kept for other uses than the connections
+
+    RESERVED_FILES = 64
+
+    # How often the plugin starts new connections, in seconds
+
+    PUMP_INTERVAL = 0.01
+
+    REPORTS = {
+        "swept":
+            {
+                "Code": "PORTS-0",
+                "Summary": "Found {count} open TCP ports",
+                "Description": "Tried {ports} ports on {hosts} addresses in {duration} seconds. {closed} ports were \
+closed and {filtered} did not answer within {timeout} seconds.",
+                "Severity": "Info",
+                "URLs": [ {"URL": None, "Extra": None} ]
+            },
+        "open":
+            {
+                "Code": "PORTS-1",
+                "Summary": "Open TCP port {port}",
+                "Description": "TCP port {port} on {host} accepts connections.",
+                "Severity": "Info",
+                "URLs": [ {"URL": None, "Extra": None} ],
+                "Ports": []
+            }
+    }
+
+    def do_configure(self):
+        self.options = dict(self.DEFAULTS)
+        for name in self.DEFAULTS:
+            if name in self.configuration:
+                self.options[name] = type(self.DEFAULTS[name])(self.configuration[name])
+        self.ports = parse_ports(self.configuration.get('ports', self.DEFAULT_PORTS))
+        self.host_count, self.hosts = target_hosts(self.configuration['target'])
+        self.concurrency = self._file_limit(self.options['concurrency'])
+
+    def _file_limit(self, concurrency):
+        """ Raise the limit of open files to fit the connections. Returns the
+        number of connections that fit. """
+        needed = concurrency + self.RESERVED_FILES
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            soft = needed if hard == resource.RLIM_INFINITY else min(hard, needed)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+            if soft < needed:
+                logging.warning("Limited to %d connections by the open file limit" % (soft - self.RESERVED_FILES))
+                return max(1, soft - self.RESERVED_FILES)
+        return concurrency
+
+    def _probes(self):
+        for port in self.ports:
+            for host in self.hosts():
+                yield host, port
+
+    def do_run(self):
+        from twisted.internet.defer import Deferred
+        self.started = self.reactor.seconds()
+        self.probes = self._probes()
+        self.exhausted = False
+        self.delayed = [] # (ready, host, port) of probes that wait for their host
+        self.host_ready = {} # host -> when the next connection to it may start
+        self.connecting = set()
+        self.tokens = 0.0
+        self.last_pump = self.started
+        self.open = self.closed = self.filtered = 0
+        self.total = self.host_count * len(self.ports)
+        self.done = Deferred()
+        self.pump_call = None
+        self._pump()
+        return self.done
+
+    def do_stop(self):
+        self.stopped = True
+        if self.pump_call is not None and self.pump_call.active():
+            self.pump_call.cancel()
+        for d in list(self.connecting):
+            d.cancel()
+        AsyncPlugin.do_stop(self)
+
+    def _next_probe(self, now):
+        # A delayed probe already has its slot in host_ready
+        if self.delayed and self.delayed[0][0] <= now:
+            ready, host, port = heapq.heappop(self.delayed)
+            return host, port
+        # Only look ahead as far as the connections allow, so that a sweep of
+        # one host does not queue all of its ports at once
+        while not self.exhausted and len(self.delayed) < self.concurrency:
+            try:
+                host, port = next(self.probes)
+            except StopIteration:
+                self.exhausted = True
+                break
+            ready = self.host_ready.get(host, 0)
+            if ready <= now:
+                self.host_ready[host] = now + 1.0 / self.options['host_rate']
+                return host, port
+            heapq.heappush(self.delayed, (ready, host, port))
+            self.host_ready[host] = ready + 1.0 / self.options['host_rate']
+        return None
+
+    def _pump(self):
+        self.pump_call = None
+        if self.stopped or self.done.called:
+            return
+        now = self.reactor.seconds()
+        rate = self.options['rate']
+        # Allow a burst of a tenth of a second, for when the reactor was busy
+        self.tokens = min(max(1.0, rate / 10.0), self.tokens + (now - self.last_pump) * rate)
+        self.last_pump = now
+        while len(self.connecting) < self.concurrency and self.tokens >= 1:
+            probe = self._next_probe(now)
+            if probe is None:
+                break
+            self.tokens -= 1
+            self._connect(*probe)
+        if self.exhausted and not self.delayed:
+            self._check_done()
+        else:
+            self.pump_call = self.reactor.callLater(self.PUMP_INTERVAL, self._pump)
+
+    def _connect(self, host, port):
+        from twisted.internet.endpoints import TCP4ClientEndpoint
+        from twisted.internet.protocol import Factory, Protocol
+        from twisted.python.failure import Failure
+        factory = Factory()
+        factory.protocol = Protocol
+        endpoint = TCP4ClientEndpoint(self.reactor, host, port, timeout=self.options['timeout'])
+        d = endpoint.connect(factory)
+        self.connecting.add(d)
+        d.addCallbacks(self._connected, self._not_connected, callbackArgs=(host, port))
+        def forget(result):
+            self.connecting.discard(d)
+            # Only a bug in the callbacks above gets here, which ends the sweep
+            if isinstance(result, Failure):
+                logging.error("Failed to handle %s:%d: %s" % (host, port, result.getTraceback()))
+                if not self.done.called:
+                    self.done.errback(result)
+                return
+            self._check_done()
+        d.addBoth(forget)
+
+    def _connected(self, protocol, host, port):
+        protocol.transport.abortConnection()
+        self.open += 1
+        issue = self.format_report('open', [
+            {"Summary": {"port": port}},
+            {"Description": {"host": host, "port": port}}
+        ])
+        issue['URLs'] = [{'URL': host}]
+        issue['Ports'] = [port]
+        self.report_issue(issue)
+
+    def _not_connected(self, failure):
+        from twisted.internet.error import ConnectionRefusedError
+        if failure.check(ConnectionRefusedError):
+            self.closed += 1
+        else:
+            self.filtered += 1
+
+    def _check_done(self):
+        tried = self.open + self.closed + self.filtered
+        if self.total:
+            self.report_progress(100 * tried / self.total, "Tried %d of %d ports" % (tried, self.total))
+        if self.stopped or self.done.called:
+            return
+        if self.exhausted and not self.delayed and not self.connecting:
+            issue = self.format_report('swept', [
+                {"Summary": {"count": self.open}},
+                {"Description": {"ports": len(self.ports), "hosts": self.host_count,
+                                 "duration": int(self.reactor.seconds() - self.started),
+                                 "closed": self.closed, "filtered": self.filtered,
+                                 "timeout": self.options['timeout']}}
+            ])
+            issue['URLs'] = [{'URL': self.configuration['target']}]
+            self.report_issue(issue)
+            self.done.callback(None)
@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# The Twisted side of ExternalProcessPlugin. It lives apart from minion.plugins.base
+# so that blocking plugins can be imported and run without loading Twisted.
+#
+
+import logging
+import socket
+import traceback
+
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.protocol import ProcessProtocol
+
+from minion.plugins.base import AbstractPlugin
+
+
+class ExternalProcessProtocol(ProcessProtocol):
+
+    """
+    Protocol that delegates incoming data on stdout and stderr to the plugin. The
+    plugin can capture the data and wait until the process is finished or process
+    it immediately and report results back.
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def outReceived(self, data):
+        try:
+            self.plugin.do_process_stdout(data)
+        except Exception as e:
+            logging.exception("Plugin threw an uncaught exception in do_process_stdout: " + str(e))
+            fail = {
+                "hostname": socket.gethostname(),
+                "exception": traceback.format_exc(),
+                "message": "Plugin failed"
+            }
+            self.plugin.report_finish(AbstractPlugin.EXIT_STATE_FAILED, fail)
+
+    def errReceived(self, data):
+        try:
+            self.plugin.do_process_stderr(data)
+        except Exception as e:
+            logging.exception("Plugin threw an uncaught exception in do_process_stderr: " + str(e))
+            fail = {
+                "hostname": socket.gethostname(),
+                "exception": traceback.format_exc(),
+                "message": "Plugin failed"
+            }
+            self.plugin.report_finish(AbstractPlugin.EXIT_STATE_FAILED, fail)
+
+    def processEnded(self, reason):
+        logging.debug("ExternalProcessProtocol.processEnded: " + str(reason.value))
+        if isinstance(reason.value, ProcessTerminated):
+            try:
+                self.plugin.close_parsers()
+                self.plugin.do_process_ended(reason.value.status)
+            except Exception as e:
+                logging.exception("Plugin threw an uncaught exception in do_process_ended: " + str(e))
+                fail = {
+                    "hostname": socket.gethostname(),
+                    "exception": traceback.format_exc(),
+                    "message": "Plugin failed"
+                }
+                self.plugin.report_finish(AbstractPlugin.EXIT_STATE_FAILED, fail)
+        elif isinstance(reason.value, ProcessDone):
+            try:
+                self.plugin.close_parsers()
+                self.plugin.do_process_ended(reason.value.status)
+            except Exception as e:
+                logging.exception("Plugin threw an uncaught exception in do_process_ended: " + str(e))
+                fail = {
+                    "hostname": socket.gethostname(),
+                    "exception": traceback.format_exc(),
+                    "message": "Plugin failed"
+                }
+                self.plugin.report_finish(AbstractPlugin.EXIT_STATE_FAILED, fail)
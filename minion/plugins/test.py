@@ -18,7 +18,8 @@ class DelayedPlugin(BlockingPlugin):
 
     """
     This is a test plugin that waits 5 seconds, then emits an Info message
-    and then waits another five seconds before it exits.
+    and then waits another five seconds before it exits. It reports its
+    progress every half second.
     """
 
     def do_run(self):
@@ -26,12 +27,14 @@ class DelayedPlugin(BlockingPlugin):
             if self.stopped:
                 return
             time.sleep(0.5)
+            self.report_progress((n + 1) * 5, "Waiting")
         message = self.configuration.get('message', 'Hello, world')
         self.report_issues([{ "Summary":message, "Severity":"Info" }])
         for n in range(0,10):
             if self.stopped:
                 return
             time.sleep(0.5)
+            self.report_progress(50 + (n + 1) * 5, "Waiting")
         
 
 class ExceptionPlugin(BlockingPlugin):
@@ -0,0 +1,177 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Non-blocking HTTP client for plugins that run on the reactor, see AsyncPlugin
+# in minion.plugins.base. Requests return a Deferred that fires with a Response
+# that looks like the one of minion.curly:
+#
+#  d = self.http.get("https://example.com/")
+#  d.addCallback(lambda r: self.check_headers(r.url, r.status, r.headers, r.body))
+#
+# At most concurrency requests are in flight at a time, and at most per_host to
+# the same host when that is given. The others wait for their turn. Connections
+# are kept open and reused. Redirects are not followed; the status and the
+# location header are in the response.
+#
+# Bodies are read into memory, up to max_body_size bytes; a larger body fails the
+# request with BodyTooLarge, which still has the status and headers. A request can skip the body when it only needs the
+# headers, by passing want_body(status, headers) that returns False. The body of
+# the response is then None.
+#
+
+import urlparse
+
+from twisted.internet.defer import CancelledError, Deferred, DeferredSemaphore, fail
+from twisted.internet.error import TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+
+class BodyTooLarge(Exception):
+
+    """ The response body is larger than the max_body_size of the client. The
+    response attribute holds the response without its body. """
+
+    def __init__(self, message, response=None):
+        Exception.__init__(self, message)
+        self.response = response
+
+
+class Response:
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class _BodyReceiver(Protocol):
+
+    """ Collects a response body of at most max_size bytes and fires finished
+    with it. Cancelling finished closes the connection. """
+
+    def __init__(self, max_size):
+        self.data = []
+        self.size = 0
+        self.max_size = max_size
+        self.finished = Deferred(lambda d: self.transport.stopProducing())
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.finished.errback(BodyTooLarge("The body is larger than %d bytes" % self.max_size))
+            self.transport.stopProducing()
+            return
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback("".join(self.data))
+        else:
+            self.finished.errback(reason)
+
+
+class _BodyDiscarder(Protocol):
+
+    """ Closes the connection instead of reading the body """
+
+    def connectionMade(self):
+        self.transport.stopProducing()
+
+
+class HTTPClient:
+
+    def __init__(self, reactor, concurrency=10, per_host=None, connect_timeout=10, timeout=30, headers=None,
+                 max_body_size=4*1024*1024):
+        self.reactor = reactor
+        self.timeout = timeout
+        self.max_body_size = max_body_size
+        self.headers = headers or {}
+        self.pool = HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = per_host or concurrency
+        self.agent = Agent(reactor, connectTimeout=connect_timeout, pool=self.pool)
+        self.semaphore = DeferredSemaphore(concurrency)
+        self.per_host = per_host
+        self.host_semaphores = {}
+        self.pending = set()
+        self.closed = False
+
+    def get(self, url, headers=None, timeout=None, want_body=None):
+        return self.request('GET', url, headers, timeout, want_body)
+
+    def head(self, url, headers=None, timeout=None):
+        return self.request('HEAD', url, headers, timeout)
+
+    def request(self, method, url, headers=None, timeout=None, want_body=None):
+        """ Queue a request. The timeout, in seconds, starts when the request is
+        sent and covers reading the response. """
+        if self.closed:
+            return fail(CancelledError("The client is closed"))
+        if self.per_host:
+            # A request waits for its host before it takes one of the shared
+            # slots, so that a busy host does not hold up the others
+            host = urlparse.urlparse(url).netloc
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = DeferredSemaphore(self.per_host)
+            d = self.host_semaphores[host].run(self.semaphore.run, self._request, method, url,
+                                               headers, timeout or self.timeout, want_body)
+        else:
+            d = self.semaphore.run(self._request, method, url, headers, timeout or self.timeout, want_body)
+        self.pending.add(d)
+        def forget(result):
+            self.pending.discard(d)
+            return result
+        d.addBoth(forget)
+        return d
+
+    def close(self):
+        """ Cancel all requests, including the ones that did not start yet, and
+        close the connections. """
+        self.closed = True
+        for d in list(self.pending):
+            d.cancel()
+        return self.pool.closeCachedConnections()
+
+    def _request(self, method, url, headers, timeout, want_body):
+        all_headers = dict(self.headers, **(headers or {}))
+        d = self.agent.request(method, url.encode('ascii'),
+                               Headers(dict((k, [v]) for k, v in all_headers.items())))
+        d.addCallback(self._read_response, url, want_body)
+        timer = self.reactor.callLater(timeout, d.cancel)
+        def stop_timer(result):
+            if timer.active():
+                timer.cancel()
+            elif isinstance(result, Failure) and result.check(CancelledError):
+                raise TimeoutError("%s %s took longer than %d seconds" % (method, url, timeout))
+            return result
+        d.addBoth(stop_timer)
+        return d
+
+    def _read_response(self, response, url, want_body):
+        headers = dict((name.lower(), values[-1]) for name, values in response.headers.getAllRawHeaders())
+        if want_body is not None and not want_body(response.code, headers):
+            response.deliverBody(_BodyDiscarder())
+            return Response(url, response.code, headers, None)
+        if response.length is not UNKNOWN_LENGTH and response.length > self.max_body_size:
+            response.deliverBody(_BodyDiscarder())
+            raise BodyTooLarge("The body of %s is %d bytes" % (url, response.length),
+                               Response(url, response.code, headers, None))
+        receiver = _BodyReceiver(self.max_body_size)
+        response.deliverBody(receiver)
+        def too_large(failure):
+            failure.trap(BodyTooLarge)
+            failure.value.response = Response(url, response.code, headers, None)
+            return failure
+        receiver.finished.addCallbacks(lambda body: Response(url, response.code, headers, body), too_large)
+        return receiver.finished
@@ -12,6 +12,7 @@ install_requires = [
     'twisted==13.0.0',
     'pycurl==7.19.0',
     'gunicorn==0.17.4',
+    'gevent==0.13.8',
     'ipaddress==1.0.4',
     'netaddr==0.7.11',
 ]
@@ -40,9 +41,13 @@ setup(name="minion-backend",
       scripts=['scripts/minion-backend-api',
                'scripts/minion-create-plan',
                'scripts/minion-db-init',
+               'scripts/minion-db-migrate',
+               'scripts/minion-plugin-manifest',
                'scripts/minion-create-user',
                'scripts/minion-plugin-worker',
                'scripts/minion-scan',
                'scripts/minion-state-worker',
                'scripts/minion-scan-worker',
+               'scripts/minion-delete-worker',
+               'scripts/minion-reconcile-worker',
                'scripts/minion-plugin-runner'])
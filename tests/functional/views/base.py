@@ -5,7 +5,9 @@
 import os
 import json
 import requests
+import time
 import unittest
+import uuid
 
 from pymongo import MongoClient
 
@@ -104,6 +106,10 @@ class Groups(Resource):
     def get(self):
         return self.session.get(self.api)
 
+    def patch_membership(self, patches):
+        return self.session.patch(self.api + "/membership",
+            data=json.dumps({"groups": patches}), headers=self.json_header)
+
 class Group(Resource):
     def __init__(self, group_name, description=None, sites=None, users=None):
         super(Group, self).__init__()
@@ -158,6 +164,10 @@ class Sites(Resource):
             params["url"] = url
         return self.session.get(self.api, params=params)
 
+    def create(self, sites):
+        return self.session.post(self.api + "/bulk",
+            data=json.dumps({"sites": sites}), headers=self.json_header)
+
 class Site(Resource):
     def __init__(self, url, groups=None, plans=None):
         super(Site, self).__init__()
@@ -269,6 +279,24 @@ class Plan(Resource):
     def delete(self, plan_name):
         return self.session.delete(self.api + "/" + plan_name)
 
+class Artifact(Resource):
+    def __init__(self, sha256):
+        super(Artifact, self).__init__()
+        self.api = self.domain + "/artifacts/" + sha256
+        self.upload = uuid.uuid4().hex
+
+    def get(self):
+        return self.session.get(self.api)
+
+    def put_chunk(self, n, data):
+        return self.session.put(self.api + "/uploads/%s/chunks/%d" % (self.upload, n), data=data,
+            headers={"content-type": "application/octet-stream"})
+
+    def commit(self, length, chunk_size):
+        return self.session.put(self.api,
+            data=json.dumps({"upload": self.upload, "length": length, "chunk_size": chunk_size}),
+            headers=self.json_header)
+
 class Scans(Resource):
     def __init__(self):
         super(Scans, self).__init__()
@@ -282,6 +310,11 @@ class Scans(Resource):
             params["site_id"] = site_id
         return self.session.get(self.api, params=params)
 
+    def batch(self, email, plan_name, **kwargs):
+        data = dict(kwargs, user=email, plan=plan_name)
+        return self.session.post(self.api + "/batch",
+            data=json.dumps(data), headers=self.json_header)
+
 class Scan(Resource):
     def __init__(self, email, plan_name, configuration):
         super(Scan, self).__init__()
@@ -299,9 +332,9 @@ class Scan(Resource):
             }),
             headers=self.json_header)
 
-    def get_scan_details(self, scan_id, email=None):
+    def get_scan_details(self, scan_id, email=None, since=None):
         return self.session.get(self.api + "/" + scan_id,
-            params={"email": email})
+            params={"email": email, "since": since})
 
     def get_summary(self, scan_id, email=None):
         return self.session.get(self.api + "/" + scan_id + "/summary",
@@ -317,6 +350,29 @@ class Scan(Resource):
         return self.session.put(self.api + "/" + scan_id + "/control",
             data=state, params={"email": email})
 
+    def get_artifact(self, scan_id, name, headers=None):
+        return self.session.get(self.api + "/" + scan_id + "/artifact/" + name,
+            headers=headers)
+
+    def events(self, scan_id, since=None):
+        """ Read the event stream of a scan until the server ends it and
+        return the events as (id, type, data) tuples. """
+        params = {}
+        if since is not None:
+            params["since"] = since
+        res = self.session.get(self.api + "/" + scan_id + "/events",
+            params=params, stream=True)
+        events, event = [], {}
+        for line in res.iter_lines(chunk_size=1):
+            if not line:
+                if "data" in event:
+                    events.append((int(event["id"]), event["event"], json.loads(event["data"])))
+                event = {}
+            elif not line.startswith(":"):
+                field, _, value = line.partition(": ")
+                event[field] = value
+        return events
+
 class Issue(Resource):
     def __init__(self, issue_id):
         super(Issue, self).__init__()
@@ -374,6 +430,24 @@ class Reports(Resource):
                 params["group_name"] = group_name
         return self.session.get(self.api + "/issues", params=params)
 
+class Job(Resource):
+    def __init__(self, job_id):
+        super(Job, self).__init__()
+        self.api = self.domain + "/jobs"
+        self.job_id = job_id
+
+    def get(self):
+        return self.session.get(self.api + "/" + self.job_id)
+
+    def wait(self, timeout=30):
+        """ Poll the job until it has finished or failed. """
+        for _ in range(timeout):
+            res = self.get()
+            if res.json()['job']['state'] in ('FINISHED', 'FAILED'):
+                return res
+            time.sleep(1)
+        return res
+
 class TestAPIBaseClass(unittest.TestCase):
     def setUp(self):
         self.mongodb = MongoClient()
@@ -0,0 +1,99 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+
+from base import (TestAPIBaseClass, User, Site, Group, Plan, Scan, Artifact)
+
+class TestArtifactAPIs(TestAPIBaseClass):
+    TEST_PLAN = { "name": "test",
+                  "description": "Test",
+                  "workflow": [ { "plugin_name": "minion.plugins.test.HelloWorldPlugin",
+                                  "description": "",
+                                  "configuration": {}
+                                  } ] }
+
+    CONTENT = "<report>" + "x" * 2500 + "</report>"
+
+    def setUp(self):
+        super(TestArtifactAPIs, self).setUp()
+        self.sha256 = hashlib.sha256(self.CONTENT).hexdigest()
+        self.artifact = Artifact(self.sha256)
+
+    def _upload(self, chunk_size=1000):
+        for n in range(0, len(self.CONTENT), chunk_size):
+            res = self.artifact.put_chunk(n // chunk_size, self.CONTENT[n:n + chunk_size])
+            self.assertEqual(res.json()["success"], True)
+        return self.artifact.commit(len(self.CONTENT), chunk_size)
+
+    def test_upload_artifact(self):
+        res1 = self.artifact.get()
+        self.assertEqual(res1.json()["reason"], "no-such-artifact")
+
+        res2 = self._upload()
+        self.assertEqual(res2.json()["success"], True)
+        res3 = self.artifact.get()
+        self.assertEqual(res3.json()["artifact"], {"sha256": self.sha256, "length": len(self.CONTENT)})
+
+    def test_upload_artifact_checks_content(self):
+        self.artifact.put_chunk(0, self.CONTENT[:1000])
+        res1 = self.artifact.commit(len(self.CONTENT), 1000)
+        self.assertEqual(res1.json()["reason"], "missing-chunks")
+
+        other = Artifact(hashlib.sha256("something else").hexdigest())
+        other.put_chunk(0, self.CONTENT)
+        res2 = other.commit(len(self.CONTENT), 4096)
+        self.assertEqual(res2.json()["reason"], "checksum-mismatch")
+        self.assertEqual(other.get().json()["success"], False)
+
+    def test_stored_artifact_is_not_overwritten(self):
+        # Two workers upload the same file at the same time, in chunks of different sizes
+        other = Artifact(self.sha256)
+        for n in range(0, len(self.CONTENT), 1000):
+            self.artifact.put_chunk(n // 1000, self.CONTENT[n:n + 1000])
+        other.put_chunk(0, self.CONTENT)
+        self.assertEqual(self.artifact.commit(len(self.CONTENT), 1000).json()["success"], True)
+        self.assertEqual(other.commit(len(self.CONTENT), 4096).json()["success"], True)
+        self.assertEqual(self.db.artifacts.find_one({"_id": self.sha256})["chunk_size"], 1000)
+        self.assertEqual(self.db.artifact_chunks.find({"sha256": self.sha256}).count(), 3)
+
+        res = Artifact(self.sha256).put_chunk(0, "something else")
+        self.assertEqual(res.json()["reason"], "artifact-exists")
+
+    def test_download_artifact(self):
+        Plan(self.TEST_PLAN).create()
+        user = User(self.email)
+        user.create()
+        site = Site(self.target_url, plans=[self.TEST_PLAN["name"]])
+        site.create()
+        Group(self.group_name, sites=[site.url], users=[user.email]).create()
+        scan = Scan(user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan_id = scan.create().json()["scan"]["id"]
+
+        # The state worker indexes the files of an artifact when the plugin worker reports it
+        self._upload()
+        self.db.artifact_index.insert({"scan": scan_id, "session": None, "name": "report.xml",
+                                       "sha256": self.sha256, "length": len(self.CONTENT)})
+
+        res1 = scan.get_artifact(scan_id, "report.xml")
+        self.assertEqual(res1.status_code, 200)
+        self.assertEqual(res1.content, self.CONTENT)
+        self.assertEqual(res1.headers["Accept-Ranges"], "bytes")
+
+        res2 = scan.get_artifact(scan_id, "report.xml", headers={"Range": "bytes=990-2009"})
+        self.assertEqual(res2.status_code, 206)
+        self.assertEqual(res2.content, self.CONTENT[990:2010])
+        self.assertEqual(res2.headers["Content-Range"], "bytes 990-2009/%d" % len(self.CONTENT))
+
+        res3 = scan.get_artifact(scan_id, "report.xml", headers={"Range": "bytes=-9"})
+        self.assertEqual(res3.content, "</report>")
+
+        res4 = scan.get_artifact(scan_id, "report.xml", headers={"Range": "bytes=5000-"})
+        self.assertEqual(res4.status_code, 416)
+
+        res5 = scan.get_artifact(scan_id, "report.xml", headers={"If-None-Match": '"%s"' % self.sha256})
+        self.assertEqual(res5.status_code, 304)
+
+        res6 = scan.get_artifact(scan_id, "missing.xml")
+        self.assertEqual(res6.json()["error"], "no-such-artifact")
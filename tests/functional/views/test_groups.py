@@ -178,3 +178,30 @@ class TestGroupAPIs(TestAPIBaseClass):
 
         res2 = group.update(remove_users=[bob.email])
         self.assertEqual(res2.json()['group']['users'], [])
+
+    def test_patch_groups_membership(self):
+        bob = User(self.email)
+        bob.create()
+        site = Site(self.target_url)
+        site.create()
+        group1 = Group(self.group_name)
+        group1.create()
+        group2 = Group("other-group", users=[bob.email])
+        group2.create()
+
+        res1 = Groups().patch_membership({ self.group_name: { "addSites": [self.target_url],
+                                                              "addUsers": [bob.email] },
+                                           "other-group": { "removeUsers": [bob.email] } })
+        self.assertEqual(res1.json()["success"], True)
+        self.assertEqual(res1.json()["groups"][self.group_name],
+            {"addSites": 1, "removeSites": 0, "addUsers": 1, "removeUsers": 0})
+        self.assertEqual(res1.json()["groups"]["other-group"],
+            {"addSites": 0, "removeSites": 0, "addUsers": 0, "removeUsers": 1})
+        self.assertEqual(group1.get().json()["group"]["sites"], [self.target_url])
+        self.assertEqual(group1.get().json()["group"]["users"], [bob.email])
+        self.assertEqual(group2.get().json()["group"]["users"], [])
+
+    def test_patch_groups_membership_with_unknown_group(self):
+        res = Groups().patch_membership({ "nonexistentgroup": { "addUsers": [self.email] } })
+        self.assertEqual(res.json()["success"], False)
+        self.assertEqual(res.json()["reason"], "no-such-group")
@@ -0,0 +1,55 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from base import (TestAPIBaseClass, User, Site, Group, Plan, Scan, Job)
+
+class TestJobAPIs(TestAPIBaseClass):
+    TEST_PLAN = { "name": "test",
+                  "description": "Test",
+                  "workflow": [ { "plugin_name": "minion.plugins.test.HelloWorldPlugin",
+                                  "description": "",
+                                  "configuration": {}
+                                  } ] }
+
+    def setUp(self):
+        super(TestJobAPIs, self).setUp()
+        self.plan = Plan(self.TEST_PLAN)
+        self.plan.create()
+        self.user = User(self.email)
+        self.user.create()
+        self.site = Site(self.target_url, plans=[self.TEST_PLAN["name"]])
+        self.site_id = self.site.create().json()["site"]["id"]
+        self.group = Group(self.group_name, sites=[self.site.url], users=[self.user.email])
+        self.group.create()
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        for _ in range(3):
+            scan.create()
+
+    def test_get_unknown_job(self):
+        res = Job("nonexistentjob").get()
+        self.assertEqual(res.json()["success"], False)
+        self.assertEqual(res.json()["reason"], "no-such-job")
+
+    def test_delete_plan_removes_scans_in_background(self):
+        res1 = self.plan.delete(self.TEST_PLAN["name"])
+        self.assertEqual(res1.json()["success"], True)
+        job = res1.json()["job"]
+        self.assertEqual(job["type"], "remove-plan")
+        self.assertEqual(job["resource"], {"plan": self.TEST_PLAN["name"]})
+
+        res2 = Job(job["id"]).wait()
+        self.assertEqual(res2.json()["job"]["state"], "FINISHED")
+        self.assertEqual(res2.json()["job"]["progress"]["total"], 3)
+        self.assertEqual(res2.json()["job"]["progress"]["scans"], 3)
+        self.assertEqual(self.db.scans.find({"plan.name": self.TEST_PLAN["name"]}).count(), 0)
+
+    def test_delete_site_removes_scans_in_background(self):
+        res1 = self.site.delete(self.site_id)
+        self.assertEqual(res1.json()["success"], True)
+        self.assertEqual(res1.json()["job"]["type"], "remove-site")
+
+        res2 = Job(res1.json()["job"]["id"]).wait()
+        self.assertEqual(res2.json()["job"]["state"], "FINISHED")
+        self.assertEqual(self.db.scans.find({"configuration.target": self.target_url}).count(), 0)
+        self.assertEqual(self.group.get().json()["group"]["sites"], [])
@@ -28,3 +28,9 @@ class TestPluginAPIs(TestAPIBaseClass):
                 set(["class", "name", "version", "weight"]),
                 msg={"Plugin {name} should have class,name,version,weight defined.".format(
                         name=plugin["name"])})        
+
+    def test_get_plugins_not_modified(self):
+        resp1 = Plugins().get()
+        etag = resp1.headers["ETag"]
+        resp2 = Plugins().session.get(Plugins().api, headers={"If-None-Match": etag})
+        self.assertEqual(resp2.status_code, 304)
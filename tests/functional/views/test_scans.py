@@ -199,3 +199,136 @@ class TestScanAPIs(TestAPIBaseClass):
         # Try to tag an issue as ignored
         res10 = issue.tag_issue_as_false_positive()
         self.assertTrue(res10.json()['success'])
+
+    def test_batch_scan_group(self):
+        res1 = Scans().batch(self.user.email, self.TEST_PLAN["name"], group=self.group.group_name)
+        self.assertEqual(res1.json()["success"], True)
+        self.assertEqual(len(res1.json()["scans"]), 1)
+        self.assertEqual(res1.json()["scans"][0]["configuration"]["target"], self.target_url)
+        self.assertEqual(res1.json()["scans"][0]["state"], "CREATED")
+
+        res2 = Scans().batch(self.user.email, self.TEST_PLAN["name"],
+                             sites=[self.target_url, self.target_url], start=True, window=0)
+        self.assertEqual(res2.json()["success"], True)
+        self.assertEqual(len(res2.json()["scans"]), 1)
+        self.assertEqual(res2.json()["scans"][0]["state"], "QUEUED")
+
+        time.sleep(6)
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        res3 = scan.get_scan_details(res2.json()["scans"][0]["id"])
+        self.assertEqual(res3.json()["scan"]["state"], "FINISHED")
+
+    def test_batch_scan_errors(self):
+        res1 = Scans().batch(self.user.email, "nonexistentplan", group=self.group.group_name)
+        self.assertEqual(res1.json()["reason"], "no-such-plan")
+        res2 = Scans().batch(self.user.email, self.TEST_PLAN["name"], group="nonexistentgroup")
+        self.assertEqual(res2.json()["reason"], "no-such-group")
+        res3 = Scans().batch(self.user.email, self.TEST_PLAN["name"], sites=[])
+        self.assertEqual(res3.json()["reason"], "no-sites")
+        res4 = Scans().batch(self.user.email, self.TEST_PLAN["name"], sites=[self.target_url], window="soon")
+        self.assertEqual(res4.json()["reason"], "invalid-window")
+        res5 = Scans().batch(self.user.email, self.TEST_PLAN["name"], sites=[{"url": self.target_url}])
+        self.assertEqual(res5.json()["reason"], "invalid-sites")
+        res6 = Scans().batch(self.user.email, self.TEST_PLAN["name"], sites=self.target_url)
+        self.assertEqual(res6.json()["reason"], "invalid-sites")
+        res7 = Scans().batch(self.user.email, self.TEST_PLAN["name"], sites=[self.target_url], configuration=[1])
+        self.assertEqual(res7.json()["reason"], "invalid-configuration")
+
+    def test_get_scan_details_not_modified(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan_id = scan.create().json()['scan']['id']
+
+        res1 = scan.get_scan_details(scan_id)
+        etag = res1.headers["ETag"]
+        res2 = scan.session.get(scan.api + "/" + scan_id, headers={"If-None-Match": etag})
+        self.assertEqual(res2.status_code, 304)
+        res3 = scan.session.get(scan.api + "/" + scan_id + "/summary", headers={"If-None-Match": etag})
+        self.assertEqual(res3.status_code, 304)
+
+        # Starting the scan changes it
+        scan.start(scan_id)
+        res4 = scan.session.get(scan.api + "/" + scan_id, headers={"If-None-Match": etag})
+        self.assertEqual(res4.status_code, 200)
+        self.assertEqual(res4.json()["scan"]["state"], "QUEUED")
+        self.assertNotEqual(res4.headers["ETag"], etag)
+
+    def test_scan_events(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan_id = scan.create().json()['scan']['id']
+        scan.start(scan_id)
+
+        # The stream starts with the current state and ends when the scan is done
+        events = scan.events(scan_id)
+        self.assertEqual(events[0][1], "scan")
+        self.assertEqual(events[0][2]["scan"], scan_id)
+        self.assertEqual(len(events[0][2]["sessions"]), 1)
+        self.assertEqual(events[-1][1], "scan-state")
+        self.assertEqual(events[-1][2]["state"], "FINISHED")
+        session_states = [data["state"] for _, event_type, data in events if event_type == "session-state"]
+        self.assertEqual(session_states[-1], "FINISHED")
+
+        # A finished scan only returns its final state
+        events = scan.events(scan_id)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0][2]["state"], "FINISHED")
+
+        # Resuming returns the events after the given one
+        all_events = scan.events(scan_id, since=0)
+        self.assertEqual(all_events[-1][2]["state"], "FINISHED")
+        self.assertEqual(scan.events(scan_id, since=all_events[-2][0]), all_events[-1:])
+
+    def test_scan_summary_progress(self):
+        plan = Plan({ "name": "delayed-plan",
+                      "description": "Plan that runs DelayedPlugin",
+                      "workflow": [ { "plugin_name": "minion.plugins.test.DelayedPlugin",
+                                      "description": "",
+                                      "configuration": {} } ] })
+        plan.create()
+        site_id = self.db.sites.find_one({"url": self.target_url})["id"]
+        self.site.update(site_id, plans=[self.TEST_PLAN["name"], "delayed-plan"])
+        scan = Scan(self.user.email, "delayed-plan", {"target": self.target_url})
+        scan_id = scan.create().json()['scan']['id']
+        self.assertEqual(scan.get_summary(scan_id).json()["summary"]["sessions"][0]["progress"], None)
+        scan.start(scan_id)
+
+        # Progress is throttled, so it is reported at most a few times while the plugin runs
+        events = scan.events(scan_id)
+        percentages = [data["percentage"] for _, event_type, data in events if event_type == "session-progress"]
+        self.assertTrue(0 < len(percentages) <= 4)
+        self.assertEqual(percentages[-1], 100)
+
+        progress = scan.get_summary(scan_id).json()["summary"]["sessions"][0]["progress"]
+        self.assertEqual(progress["percentage"], 100)
+        self.assertEqual(progress["description"], "Waiting")
+        self.assertTrue(progress["updated"] > 0)
+
+    def test_get_scan_changes_since_version(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        res1 = scan.create()
+        self.assertEqual(res1.json()["version"], 0)
+        scan_id = res1.json()['scan']['id']
+        scan.start(scan_id)
+        time.sleep(6)
+
+        res2 = scan.get_scan_details(scan_id)
+        self.assertEqual(res2.json()["scan"]["state"], "FINISHED")
+        version = res2.json()["version"]
+        self.assertTrue(version > 0)
+
+        # Everything changed since the scan was created
+        res3 = scan.get_scan_details(scan_id, since=0)
+        self.assertEqual(res3.json()["success"], True)
+        self.assertEqual(res3.json()["version"], version)
+        self.assertEqual(res3.json()["scan"]["state"], "FINISHED")
+        sessions = res3.json()["scan"]["sessions"]
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(sessions[0]["state"], "FINISHED")
+        self.assertEqual(sessions[0]["issues"],
+            [issue["Id"] for issue in res2.json()["scan"]["sessions"][0]["issues"]])
+
+        # Nothing changed since the current version
+        res4 = scan.get_scan_details(scan_id, since=version)
+        self.assertEqual(res4.json()["scan"]["sessions"], [])
+
+        res5 = scan.get_scan_details(scan_id, since="yesterday")
+        self.assertEqual(res5.json()["reason"], "invalid-since")
@@ -213,3 +213,43 @@ class TestSitesAPIs(TestAPIBaseClass):
             set([group1.group_name, group2.group_name]))
         self.assertEqual(res2.json()["site"]["plans"], [group.group_name])
         """
+
+    def test_create_sites_in_bulk(self):
+        group = Group(self.group_name)
+        group.create()
+        self.site.create()
+
+        res = Sites().create([ {"url": "http://foo.com", "groups": [group.group_name],
+                                "plans": [self.TEST_PLAN["name"]]},
+                               {"url": "http://bar.com"},
+                               {"url": "http://foo.com"},
+                               {"url": self.target_url},
+                               {"url": "http://baz.com", "groups": ["nonexistentgroup"]},
+                               {"url": "http://baz.com", "plans": ["nonexistentplan"]},
+                               {"url": "foo"} ])
+        self.assertEqual(res.json()["success"], True)
+        results = res.json()["sites"]
+        self.assertEqual([r["success"] for r in results],
+            [True, True, False, False, False, False, False])
+        self.assertEqual(set(results[0]["site"].keys()), set(self.expected_inner_keys))
+        self.assertEqual(results[0]["site"]["groups"], [group.group_name])
+        self.assertEqual([r.get("reason") for r in results[2:]],
+            ["site-already-exists", "site-already-exists", "unknown-group",
+             "unknown-plan", "invalid-url"])
+        self.assertEqual(group.get().json()["group"]["sites"], ["http://foo.com"])
+        self.assertEqual(len(Sites().get().json()["sites"]), 3)
+
+    def test_create_sites_in_bulk_with_malformed_items(self):
+        res = Sites().create([ {"groups": []},
+                               {"url": None},
+                               {"url": "http://foo.com", "groups": "notalist"},
+                               {"url": "http://foo.com", "groups": [{"name": "x"}]},
+                               {"url": "http://foo.com", "plans": {"basic": True}},
+                               "notasite",
+                               {"url": "http://bar.com"} ])
+        self.assertEqual(res.json()["success"], True)
+        results = res.json()["sites"]
+        self.assertEqual([r.get("reason") for r in results],
+            ["invalid-url", "invalid-url", "invalid-groups", "invalid-groups",
+             "invalid-plans", "invalid-url", None])
+        self.assertEqual(len(Sites().get().json()["sites"]), 1)
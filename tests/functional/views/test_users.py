@@ -94,6 +94,15 @@ class TestUserAPIs(TestAPIBaseClass):
             set(_expected))
         self.assertEqual(1, len(res.json()['users']))
 
+    def test_get_all_users_compressed(self):
+        bob = User(self.email)
+        bob.create()
+
+        res = Users().session.get(Users().api, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertEqual(res.json()['success'], True)
+        self.assertEqual(res.json()['users'][0]['email'], bob.email)
+
     def test_delete_user(self):
         # Create a user
         bob = User(self.email)
@@ -0,0 +1,43 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import signal
+import unittest
+
+from minion.backend.tasks import _open_pipes, _plugin_runner
+
+
+class TestPluginRunnerCleanup(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = lambda signum, frame: None
+        self.previous_handler = signal.signal(signal.SIGUSR1, self.handler)
+
+    def tearDown(self):
+        signal.signal(signal.SIGUSR1, self.previous_handler)
+
+    def test_runner_is_cleaned_up(self):
+        pipes = _open_pipes()
+        with _plugin_runner(["echo", "done"]) as p:
+            self.assertNotEqual(signal.getsignal(signal.SIGUSR1), self.handler)
+            self.assertEqual(p.stdout.read(), "done\n")
+            p.wait()
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), self.handler)
+        self.assertEqual(_open_pipes(), pipes)
+
+    def test_runner_is_killed_on_errors(self):
+        pipes = _open_pipes()
+        try:
+            with _plugin_runner(["sleep", "60"]) as p:
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(p.returncode, -signal.SIGKILL)
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), self.handler)
+        self.assertEqual(_open_pipes(), pipes)
+
+    def test_signal_is_forwarded(self):
+        with _plugin_runner(["sleep", "60"]) as p:
+            signal.getsignal(signal.SIGUSR1)(signal.SIGUSR1, None)
+            self.assertEqual(p.wait(), -signal.SIGUSR1)
@@ -0,0 +1,49 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import MagicMock, patch
+
+from minion.backend import tasks
+
+
+def _scan(scan_id, *sessions):
+    return {"id": scan_id,
+            "sessions": [{"id": "%s-%d" % (scan_id, i), "state": "FINISHED",
+                          "plugin": {"name": name}, "issues": issue_ids}
+                         for i, (name, issue_ids) in enumerate(sessions)]}
+
+
+class TestReconcileIssues(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = [patch('minion.backend.tasks.scans'), patch('minion.backend.tasks.issues'),
+                        patch('minion.backend.tasks._update_scan'), patch('minion.backend.tasks._set_issues_status')]
+        self.scans, self.issues, self.update_scan, self.set_issues_status = [p.start() for p in self.patches]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def reconcile(self, last_scan, second_to_last_scan):
+        cursor = MagicMock()
+        cursor.sort.return_value.limit.return_value = [last_scan, second_to_last_scan]
+        self.scans.find.return_value = cursor
+        tasks._reconcile_issues("http://example.com", "plan")
+
+    def test_issue_ids_by_plugin(self):
+        sessions = tasks._issue_ids_by_plugin(_scan("a", ("P", ["1"]), ("Q", ["2"]), ("P", ["3"])))
+        self.assertEqual(sessions["P"][0]["id"], "a-2")
+        self.assertEqual(sessions["P"][1], set(["1", "3"]))
+        self.assertEqual(sessions["Q"][1], set(["2"]))
+
+    def test_plugin_that_runs_twice(self):
+        self.reconcile(_scan("b", ("P", ["1"]), ("P", ["2"])),
+                       _scan("a", ("P", ["1"]), ("P", ["2", "3"])))
+        # Only the issue that no session of the plugin reported again is carried over,
+        # to the last session of the plugin
+        self.update_scan.assert_called_once_with("b", session_id="b-1", added_issues=["3"])
+        self.set_issues_status.assert_any_call(set(["1", "2"]))
+        self.set_issues_status.assert_any_call(set(["3"]), "Fixed")
+        self.assertFalse(self.issues.update.called)
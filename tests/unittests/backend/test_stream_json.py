@@ -0,0 +1,23 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import unittest
+
+from minion.backend.views.base import JSONStream, _json_chunks
+
+
+class TestJSONChunks(unittest.TestCase):
+
+    def dumps(self, value):
+        return ''.join(_json_chunks(value))
+
+    def test_stream(self):
+        value = {'items': JSONStream(iter([{'a': 1}, [2, 3]])), 'count': 2}
+        self.assertEqual(json.loads(self.dumps(value)), {'items': [{'a': 1}, [2, 3]], 'count': 2})
+
+    def test_keys_like_json_dumps(self):
+        value = {2: 'two', None: 'none', False: 'no', 1.5: 'half', u'caf\xe9': 'u'}
+        self.assertEqual(json.loads(self.dumps(value)), json.loads(json.dumps(value)))
+        self.assertRaises(TypeError, self.dumps, {(1, 2): 'tuple'})
@@ -0,0 +1,70 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+from twisted.python import threadable
+
+from minion.plugins.base import AbstractPlugin, AsyncPlugin
+from test_blocking import RecordingCallbacks
+
+
+class StoppedReactor(Clock):
+
+    running = False
+
+    def __init__(self):
+        Clock.__init__(self)
+        # Like a real reactor, take the thread the plugin runs in as the IO
+        # thread, which the progress reports check
+        threadable.registerAsIOThread()
+
+
+class WaitingPlugin(AsyncPlugin):
+
+    def do_run(self):
+        self.waiting = Deferred()
+        return self.waiting
+
+
+class FailingPlugin(AsyncPlugin):
+
+    def do_run(self):
+        return fail(Exception("Failing plugins gonna fail"))
+
+
+class TestAsyncPlugin(unittest.TestCase):
+
+    def start_plugin(self, plugin_class):
+        plugin = plugin_class()
+        plugin.reactor = StoppedReactor()
+        plugin.callbacks = RecordingCallbacks()
+        plugin.do_start()
+        return plugin
+
+    def test_finished(self):
+        plugin = self.start_plugin(WaitingPlugin)
+        self.assertEqual(plugin.callbacks.messages, [])
+        plugin.waiting.callback(None)
+        self.assertEqual(plugin.callbacks.messages, [('finish', AbstractPlugin.EXIT_STATE_FINISHED)])
+
+    def test_failed(self):
+        plugin = self.start_plugin(FailingPlugin)
+        self.assertEqual(plugin.callbacks.messages,
+                         [('issues', ['Failing plugins gonna fail']), ('finish', AbstractPlugin.EXIT_STATE_FAILED)])
+
+    def test_stop_cancels(self):
+        plugin = self.start_plugin(WaitingPlugin)
+        plugin.do_stop()
+        self.assertTrue(plugin.waiting.called)
+        self.assertTrue(plugin.http.closed)
+        self.assertEqual(plugin.callbacks.messages, [('finish', AbstractPlugin.EXIT_STATE_STOPPED)])
+        self.assertEqual(plugin.reactor.getDelayedCalls(), [])
+
+    def test_stop_before_start(self):
+        plugin = WaitingPlugin()
+        plugin.do_stop()
+        self.assertTrue(plugin.stopped)
@@ -0,0 +1,190 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from minion.plugins.base import AbstractPlugin, BlockingPlugin, ItemTimeout
+
+
+RUNNER = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'scripts', 'minion-plugin-runner')
+
+# Other tests import Twisted, which installs the reactor, so whether running a
+# blocking plugin loads the reactor can only be seen in a fresh interpreter
+
+LOADS_REACTOR = """
+import sys
+from minion.plugins.base import BlockingPlugin
+
+class Callbacks:
+    def report_progress(self, percentage, description=""):
+        pass
+    def report_issues(self, issues):
+        pass
+    def report_finish(self, state=None, failure=""):
+        pass
+
+class ProgressPlugin(BlockingPlugin):
+    def do_run(self):
+        self.report_progress(50)
+
+plugin = ProgressPlugin()
+plugin.callbacks = Callbacks()
+plugin.run_blocking()
+print 'twisted.internet.reactor' in sys.modules
+"""
+
+RUNNER_LOADS_REACTOR = """
+import runpy, sys
+runner, work_root = sys.argv[1:]
+sys.argv = [runner, '-p', 'minion.plugins.test.HelloWorldPlugin', '-c', '{}', '-w', work_root]
+try:
+    runpy.run_path(runner, run_name='__main__')
+except SystemExit:
+    pass
+print 'twisted.internet.reactor' in sys.modules
+"""
+
+
+def _last_line(code, *args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    p = subprocess.Popen([sys.executable, '-c', code] + list(args), stdout=subprocess.PIPE, env=env)
+    output = p.communicate()[0]
+    return output.strip().split('\n')[-1]
+
+
+class RecordingCallbacks:
+
+    def __init__(self):
+        self.messages = []
+
+    def report_progress(self, percentage, description=""):
+        self.messages.append(('progress', percentage))
+
+    def report_issues(self, issues):
+        self.messages.append(('issues', [issue['Summary'] for issue in issues]))
+
+    def report_finish(self, state=None, failure=""):
+        self.messages.append(('finish', state))
+
+
+class ProgressPlugin(BlockingPlugin):
+
+    def do_run(self):
+        for percentage in (10, 20, 30):
+            self.report_progress(percentage)
+
+
+class StoppingPlugin(BlockingPlugin):
+
+    def do_run(self):
+        self.do_stop()
+
+
+class FailingPlugin(BlockingPlugin):
+
+    def do_run(self):
+        raise Exception("Failing plugins gonna fail")
+
+
+class TestRunBlocking(unittest.TestCase):
+
+    def run_plugin(self, plugin_class):
+        plugin = plugin_class()
+        plugin.callbacks = RecordingCallbacks()
+        plugin.run_blocking()
+        return plugin.callbacks.messages
+
+    def test_does_not_need_twisted(self):
+        self.assertEqual(_last_line(LOADS_REACTOR), 'False')
+
+    def test_runner_does_not_need_twisted(self):
+        work_root = tempfile.mkdtemp()
+        try:
+            self.assertEqual(_last_line(RUNNER_LOADS_REACTOR, os.path.abspath(RUNNER), work_root), 'False')
+        finally:
+            shutil.rmtree(work_root)
+
+    def test_progress_is_coalesced(self):
+        self.assertEqual(self.run_plugin(ProgressPlugin),
+                         [('progress', 10), ('progress', 30), ('finish', AbstractPlugin.EXIT_STATE_FINISHED)])
+
+    def test_stopped(self):
+        self.assertEqual(self.run_plugin(StoppingPlugin), [('finish', AbstractPlugin.EXIT_STATE_STOPPED)])
+
+    def test_exception(self):
+        self.assertEqual(self.run_plugin(FailingPlugin),
+                         [('issues', ['Failing plugins gonna fail']), ('finish', AbstractPlugin.EXIT_STATE_FAILED)])
+
+
+class TestParallelMap(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = BlockingPlugin()
+
+    def test_completion_order(self):
+        results = list(self.plugin.parallel_map(lambda delay: time.sleep(delay) or delay * 10,
+                                                [0.3, 0.1, 0.2], concurrency=3))
+        self.assertEqual([(r.item, r.result, r.error) for r in results],
+                         [(0.1, 1.0, None), (0.2, 2.0, None), (0.3, 3.0, None)])
+
+    def test_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0}
+        def work(item):
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+            return item
+        results = list(self.plugin.parallel_map(work, range(10), concurrency=3))
+        self.assertEqual(sorted(r.result for r in results), range(10))
+        self.assertEqual(state['most'], 3)
+
+    def test_errors(self):
+        def work(item):
+            if item == 2:
+                raise ValueError("bad item")
+            return item
+        results = dict((r.item, r) for r in self.plugin.parallel_map(work, [1, 2, 3]))
+        self.assertEqual(results[1].result, 1)
+        self.assertTrue(isinstance(results[2].error, ValueError))
+
+    def test_timeout(self):
+        results = list(self.plugin.parallel_map(time.sleep, [2, 0], concurrency=2, timeout=0.5))
+        self.assertEqual([r.item for r in results], [0, 2])
+        self.assertTrue(isinstance(results[1].error, ItemTimeout))
+
+    def test_items_that_timed_out_keep_their_place(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0}
+        def work(delay):
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(delay)
+            with lock:
+                state['running'] -= 1
+        results = list(self.plugin.parallel_map(work, [0.6, 0.6, 0, 0], concurrency=2, timeout=0.2))
+        self.assertEqual(len(results), 4)
+        self.assertEqual(state['most'], 2)
+
+    def test_stop(self):
+        started = []
+        def work(item):
+            started.append(item)
+            while not self.plugin.stopped:
+                time.sleep(0.01)
+        results = self.plugin.parallel_map(work, range(10), concurrency=2)
+        threading.Timer(0.2, self.plugin.do_stop).start()
+        self.assertEqual(list(results), [])
+        self.assertEqual(started, [0, 1])
@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+from minion.plugins.crawler import _is_page, _origin, _same_site, find_links
+from minion.plugins.webclient import BodyTooLarge, _BodyReceiver
+
+
+PAGE = """<html><body>
+<a href="/about#team">About</a>
+<a href="contact.html">Contact</a>
+<a href="mailto:security@example.com">Mail</a>
+<a href="javascript:void(0)">Nothing</a>
+<iframe src="https://other.example.com/frame"></iframe>
+<a>No link</a>
+</body></html>
+"""
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.producing = True
+
+    def stopProducing(self):
+        self.producing = False
+
+
+class TestCrawler(unittest.TestCase):
+
+    def test_find_links(self):
+        self.assertEqual(find_links("https://example.com/docs/index.html", PAGE),
+                         ["https://example.com/about",
+                          "https://example.com/docs/contact.html",
+                          "https://other.example.com/frame"])
+
+    def test_origin(self):
+        self.assertEqual(_origin("https://example.com/a"), _origin("https://example.com:443/b?c=d"))
+        self.assertNotEqual(_origin("https://example.com/"), _origin("http://example.com/"))
+        self.assertNotEqual(_origin("https://example.com/"), _origin("https://www.example.com/"))
+
+    def test_same_site(self):
+        self.assertTrue(_same_site("http://example.com/", "https://www.example.com:8443/home"))
+        self.assertTrue(_same_site("https://www.example.com/", "https://EXAMPLE.com/"))
+        self.assertFalse(_same_site("https://example.com/", "https://login.example.com/"))
+        self.assertFalse(_same_site("https://example.com/", "https://sso.other.com/?next=example.com"))
+
+    def test_only_pages_are_read(self):
+        self.assertTrue(_is_page(200, {'content-type': 'text/html; charset=utf-8'}))
+        self.assertFalse(_is_page(200, {'content-type': 'application/pdf'}))
+        self.assertFalse(_is_page(302, {'content-type': 'text/html'}))
+
+    def test_body_receiver(self):
+        receiver = _BodyReceiver(10)
+        receiver.makeConnection(FakeTransport())
+        receiver.dataReceived("12345")
+        receiver.dataReceived("67890")
+        receiver.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(receiver.finished.result, "1234567890")
+
+    def test_body_receiver_stops_past_max_size(self):
+        errors = []
+        receiver = _BodyReceiver(10)
+        receiver.makeConnection(FakeTransport())
+        receiver.finished.addErrback(errors.append)
+        receiver.dataReceived("123456")
+        receiver.dataReceived("789012")
+        receiver.connectionLost(Failure(ResponseDone()))
+        self.assertFalse(receiver.transport.producing)
+        self.assertTrue(errors[0].check(BodyTooLarge))
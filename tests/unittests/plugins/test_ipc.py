@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import unittest
+
+from minion.plugins.ipc import FrameError, FrameReader, FrameWriter, HEADER, MAX_FRAME_SIZE, encode_frame
+
+
+class TestFramedMessages(unittest.TestCase):
+
+    def setUp(self):
+        r, w = os.pipe()
+        self.reader = FrameReader(r)
+        self.writer = FrameWriter(w)
+
+    def tearDown(self):
+        os.close(self.reader.fd)
+        if self.writer.fd is not None:
+            os.close(self.writer.fd)
+
+    def close_writer(self):
+        os.close(self.writer.fd)
+        self.writer.fd = None
+
+    def test_read_messages(self):
+        self.writer.write({"msg": "start"})
+        self.writer.write({"msg": "issues", "data": [{"Summary": "Hello\nWorld"}]})
+        self.assertEqual(self.reader.read(), [{"msg": "start"},
+                                              {"msg": "issues", "data": [{"Summary": "Hello\nWorld"}]}])
+        self.assertEqual(self.reader.read(), [])
+        self.close_writer()
+        self.assertEqual(self.reader.read(), [])
+        self.assertEqual(self.reader.closed, True)
+
+    def test_read_partial_frames(self):
+        data = encode_frame({"msg": "finish", "data": {"state": "FINISHED"}})
+        os.write(self.writer.fd, data[:2])
+        self.assertEqual(self.reader.read(), [])
+        os.write(self.writer.fd, data[2:10])
+        self.assertEqual(self.reader.read(), [])
+        os.write(self.writer.fd, data[10:])
+        self.assertEqual(self.reader.read(), [{"msg": "finish", "data": {"state": "FINISHED"}}])
+
+    def test_skip_malformed_frames(self):
+        for payload in ('{"msg": "sta', '["msg"]', '{"data": 1}'):
+            os.write(self.writer.fd, HEADER.pack(len(payload)) + payload)
+        self.writer.write({"msg": "start"})
+        self.assertEqual(self.reader.read(), [{"msg": "start"}])
+        self.assertEqual(self.reader.malformed, 3)
+
+    def test_corrupt_stream(self):
+        os.write(self.writer.fd, HEADER.pack(MAX_FRAME_SIZE + 1) + "{}")
+        self.assertRaises(FrameError, self.reader.read)
+
+    def test_truncated_stream(self):
+        os.write(self.writer.fd, encode_frame({"msg": "start"})[:-1])
+        self.close_writer()
+        self.assertRaises(FrameError, self.reader.read)
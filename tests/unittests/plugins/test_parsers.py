@@ -0,0 +1,58 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+import xml.etree.cElementTree as ElementTree
+
+from minion.plugins.base import LineParser, XMLRecordParser
+
+
+REPORT = """<?xml version="1.0"?>
+<nmaprun scanner="nmap">
+  <host><address addr="10.0.0.1"/><ports><port portid="22"/></ports></host>
+  <host><address addr="10.0.0.2"/><ports><port portid="80"/><port portid="443"/></ports></host>
+  <runstats/>
+</nmaprun>
+"""
+
+
+class TestLineParser(unittest.TestCase):
+
+    def test_lines_across_chunks(self):
+        lines = []
+        parser = LineParser(lines.append)
+        parser.feed("first li")
+        parser.feed("ne\r\nsecond line\nthi")
+        self.assertEqual(lines, ["first line", "second line"])
+        parser.feed("rd")
+        parser.close()
+        self.assertEqual(lines, ["first line", "second line", "third"])
+
+
+class TestXMLRecordParser(unittest.TestCase):
+
+    def test_records_as_they_complete(self):
+        hosts = []
+        def report_host(element):
+            hosts.append((element.find('address').get('addr'),
+                          [port.get('portid') for port in element.iter('port')]))
+        parser = XMLRecordParser(['host'], report_host)
+        middle = REPORT.index('<host>', REPORT.index('</host>'))
+        parser.feed(REPORT[:middle])
+        self.assertEqual(hosts, [("10.0.0.1", ["22"])])
+        parser.feed(REPORT[middle:])
+        parser.close()
+        self.assertEqual(hosts, [("10.0.0.1", ["22"]), ("10.0.0.2", ["80", "443"])])
+
+    def test_records_are_released(self):
+        roots = []
+        parser = XMLRecordParser(['host', 'nmaprun'], roots.append)
+        parser.feed(REPORT)
+        parser.close()
+        self.assertEqual([child.tag for child in roots[-1]], ['runstats'])
+
+    def test_truncated_output(self):
+        parser = XMLRecordParser(['host'], lambda element: None)
+        parser.feed(REPORT[:REPORT.index('</nmaprun>')])
+        self.assertRaises(ElementTree.ParseError, parser.close)
@@ -0,0 +1,152 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from twisted.internet import endpoints
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionRefusedError
+
+from minion.plugins.base import AbstractPlugin
+from minion.plugins.portscan import PortSweepPlugin, parse_ports, target_hosts
+from test_async import StoppedReactor
+from test_blocking import RecordingCallbacks
+
+
+class FakeTransport:
+
+    def abortConnection(self):
+        pass
+
+
+class FakeProtocol:
+
+    def __init__(self):
+        self.transport = FakeTransport()
+
+
+class BrokenSweepPlugin(PortSweepPlugin):
+
+    def _connected(self, protocol, host, port):
+        raise Exception("Broken sweeps gonna break")
+
+
+class TestPortSweep(unittest.TestCase):
+
+    def test_parse_ports(self):
+        self.assertEqual(parse_ports("22, 80,8000-8002,80"), [22, 80, 8000, 8001, 8002])
+        self.assertEqual(parse_ports([443, "8080"]), [443, 8080])
+        self.assertRaises(ValueError, parse_ports, "0")
+        self.assertRaises(ValueError, parse_ports, "65536")
+
+    def test_target_hosts(self):
+        size, hosts = target_hosts("192.168.1.0/30")
+        self.assertEqual((size, list(hosts())), (2, ["192.168.1.1", "192.168.1.2"]))
+        size, hosts = target_hosts("192.168.1.7")
+        self.assertEqual((size, list(hosts())), (1, ["192.168.1.7"]))
+        size, hosts = target_hosts("https://www.example.com:8443/path")
+        self.assertEqual((size, list(hosts())), (1, ["www.example.com"]))
+        size, hosts = target_hosts("10.0.0.0/16")
+        self.assertEqual(size, 65534)
+
+    def test_ports_of_a_host_are_spaced(self):
+        plugin = PortSweepPlugin()
+        plugin.configuration = {'target': "10.0.0.1", 'ports': "1-3", 'host_rate': 10}
+        plugin.do_configure()
+        plugin.probes = plugin._probes()
+        plugin.exhausted = False
+        plugin.delayed = []
+        plugin.host_ready = {}
+        self.assertEqual(plugin._next_probe(0), ("10.0.0.1", 1))
+        self.assertEqual(plugin._next_probe(0), None)
+        self.assertEqual(plugin._next_probe(0.1), ("10.0.0.1", 2))
+        self.assertEqual(plugin._next_probe(0.15), None)
+        self.assertEqual(plugin._next_probe(0.2), ("10.0.0.1", 3))
+        self.assertTrue(plugin.exhausted)
+
+
+class TestPortSweepRun(unittest.TestCase):
+
+    def setUp(self):
+        # (host, port, deferred) of every connection the plugin started
+        self.connections = []
+        connections = self.connections
+        class FakeEndpoint:
+            def __init__(self, reactor, host, port, timeout):
+                self.host, self.port = host, port
+            def connect(self, factory):
+                d = Deferred()
+                connections.append((self.host, self.port, d))
+                return d
+        self.endpoint = endpoints.TCP4ClientEndpoint
+        endpoints.TCP4ClientEndpoint = FakeEndpoint
+
+    def tearDown(self):
+        endpoints.TCP4ClientEndpoint = self.endpoint
+
+    def start_plugin(self, configuration, plugin_class=PortSweepPlugin):
+        plugin = plugin_class()
+        plugin.reactor = StoppedReactor()
+        plugin.callbacks = RecordingCallbacks()
+        plugin.configuration = configuration
+        plugin.do_configure()
+        plugin.do_start()
+        return plugin
+
+    def answer(self, open_ports):
+        for host, port, d in self.connections:
+            if not d.called:
+                if port in open_ports:
+                    d.callback(FakeProtocol())
+                else:
+                    d.errback(ConnectionRefusedError())
+
+    def reports(self, plugin):
+        return [message for message in plugin.callbacks.messages if message[0] != 'progress']
+
+    def test_rate_is_bounded(self):
+        plugin = self.start_plugin({'target': "10.0.0.0/24", 'ports': "22", 'rate': 100})
+        self.assertEqual(len(self.connections), 0)
+        # A busy reactor catches up with at most a tenth of a second of connections
+        plugin.reactor.advance(1)
+        self.assertEqual(len(self.connections), 10)
+        plugin.reactor.advance(0.05)
+        self.assertEqual(len(self.connections), 15)
+
+    def test_sweep(self):
+        plugin = self.start_plugin({'target': "10.0.0.0/30", 'ports': "22,80,443", 'concurrency': 2,
+                                    'host_rate': 1000})
+        while not plugin.deferred.called:
+            plugin.reactor.advance(1)
+            self.assertTrue(len(plugin.connecting) <= 2)
+            self.answer([80])
+        self.assertEqual(sorted((host, port) for host, port, d in self.connections),
+                         [("10.0.0.1", 22), ("10.0.0.1", 80), ("10.0.0.1", 443),
+                          ("10.0.0.2", 22), ("10.0.0.2", 80), ("10.0.0.2", 443)])
+        self.assertEqual(self.reports(plugin),
+                         [('issues', ["Open TCP port 80"]), ('issues', ["Open TCP port 80"]),
+                          ('issues', ["Found 2 open TCP ports"]), ('finish', AbstractPlugin.EXIT_STATE_FINISHED)])
+        self.assertEqual(plugin.callbacks.messages[-2], ('progress', 100))
+        self.assertEqual(plugin.reactor.getDelayedCalls(), [])
+
+    def test_stop(self):
+        plugin = self.start_plugin({'target': "10.0.0.0/24", 'ports': "22,80"})
+        plugin.reactor.advance(1)
+        self.assertTrue(plugin.connecting)
+        plugin.do_stop()
+        self.assertFalse(plugin.connecting)
+        self.assertTrue(all(d.called for host, port, d in self.connections))
+        self.assertEqual(self.reports(plugin), [('finish', AbstractPlugin.EXIT_STATE_STOPPED)])
+        # The cancelled connections count as tried
+        self.assertEqual(plugin.callbacks.messages[0], ('progress', 100 * len(self.connections) / (254 * 2)))
+        self.assertEqual(plugin.reactor.getDelayedCalls(), [])
+
+    def test_errors_end_the_sweep(self):
+        plugin = self.start_plugin({'target': "10.0.0.0/30", 'ports': "22,80"}, BrokenSweepPlugin)
+        plugin.reactor.advance(1)
+        self.answer([22])
+        self.assertEqual(self.reports(plugin),
+                         [('issues', ["Broken sweeps gonna break"]), ('finish', AbstractPlugin.EXIT_STATE_FAILED)])
+        plugin.reactor.advance(1)
+        self.assertEqual(plugin.reactor.getDelayedCalls(), [])